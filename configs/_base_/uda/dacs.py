@@ -7,17 +7,26 @@
 uda = dict(
     type='DACS',
     alpha=0.99,
+    # see EMAUpdater
+    ema_cfg=dict(update_buffers=False, interval=1),
+    # e.g. dict(dtype='bfloat16'), see MixedPrecision
+    mixed_precision=None,
     pseudo_threshold=0.968,
     pseudo_weight_ignore_top=0,
     pseudo_weight_ignore_bottom=0,
     imnet_feature_dist_lambda=0,
     imnet_feature_dist_classes=None,
     imnet_feature_dist_scale_min_ratio=None,
+    # e.g. dict(max_bytes=8 * 1024**3), shared by the ranks of a node, used
+    # with the DeterministicAug source transform, see ImnetFeatureCache
+    imnet_feature_cache=None,
     mix='class',
     blur=True,
     color_jitter_strength=0.2,
     color_jitter_probability=0.2,
     debug_img_interval=1000,
     print_grad_magnitude=False,
+    # forward the source and the augmented target images as one batch
+    fused_forward=False,
 )
 use_ddp_wrapper = True
@@ -7,6 +7,10 @@
 uda = dict(
     type='FMDAMix',
     alpha=0.99,
+    # see EMAUpdater
+    ema_cfg=dict(update_buffers=False, interval=1),
+    # e.g. dict(dtype='bfloat16'), see MixedPrecision
+    mixed_precision=None,
     pseudo_threshold=0.968,
     pseudo_weight_ignore_top=0,
     pseudo_weight_ignore_bottom=0,
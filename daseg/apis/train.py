@@ -11,10 +11,11 @@ import torch
 from mmcv.parallel import MMDataParallel, MMDistributedDataParallel
 from mmcv.runner import build_optimizer, build_runner
 
-from daseg.core import DistEvalHook, EvalHook
+from daseg.core import (DistEvalHook, EvalHook, SharedCacheLoggerHook,
+                        StopTraining)
 from daseg.core.ddp_wrapper import DistributedDataParallelWrapper
 from daseg.datasets import build_dataloader, build_dataset
-from daseg.utils import get_root_logger
+from daseg.utils import get_root_logger, get_shared_caches
 
 
 def set_random_seed(seed, deterministic=False):
@@ -107,6 +108,13 @@ def train_segmentor(model,
                                    cfg.checkpoint_config, cfg.log_config,
                                    cfg.get('momentum_config', None))
 
+    # report decoded-sample cache counters, the caches are created by the
+    # loading pipelines of the datasets built above
+    if get_shared_caches():
+        runner.register_hook(
+            SharedCacheLoggerHook(interval=cfg.log_config.interval),
+            priority='NORMAL')
+
     # an ugly walkaround to make the .log and .log.json filenames the same
     runner.timestamp = timestamp
 
@@ -128,4 +136,10 @@ def train_segmentor(model,
         runner.resume(cfg.resume_from)
     elif cfg.load_from:
         runner.load_checkpoint(cfg.load_from)
-    runner.run(data_loaders, cfg.workflow)
+    try:
+        runner.run(data_loaders, cfg.workflow)
+    except StopTraining as e:
+        logger.info(f'Stopped training at iteration {runner.iter}: {e}')
+        # finish the run like the runner after its last iteration
+        runner.call_hook('after_epoch')
+        runner.call_hook('after_run')
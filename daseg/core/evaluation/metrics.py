@@ -5,6 +5,8 @@ import mmcv
 import numpy as np
 import torch
 
+from ..utils import build_label_lut
+
 
 def f_score(precision, recall, beta=1):
     """calculate the f-score value.
@@ -23,6 +25,96 @@ def f_score(precision, recall, beta=1):
     return score
 
 
+def confusion_matrix(pred_label,
+                     label,
+                     num_classes,
+                     ignore_index,
+                     label_map=dict(),
+                     reduce_zero_label=False,
+                     label_lut=None):
+    """Calculate the confusion matrix between prediction and ground truth.
+
+    The matrix is accumulated with a single ``bincount`` over
+    ``num_classes * label + pred_label``. Pixels labeled with
+    ``ignore_index`` (or any label outside ``[0, num_classes)``) are dropped.
+    Both inputs may be a single map of shape (H, W) or a stack of maps of
+    shape (N, H, W), in which case the matrix is summed over the stack.
+
+    Args:
+        pred_label (ndarray | torch.Tensor | str): Prediction segmentation
+            map(s) or predict result filename.
+        label (ndarray | torch.Tensor | str): Ground truth segmentation map(s)
+            or label filename.
+        num_classes (int): Number of categories.
+        ignore_index (int): Index that will be ignored in evaluation.
+        label_map (dict): Mapping old labels to new labels. The parameter will
+            work only when label is str. Default: dict().
+        reduce_zero_label (bool): Whether ignore zero label. The parameter will
+            work only when label is str. Default: False.
+        label_lut (ndarray, optional): Table of :func:`build_label_lut`
+            applied to the labels instead of ``label_map`` and
+            ``reduce_zero_label``, e.g. the one of the dataset, so that it is
+            not rebuilt per image. Labels beyond the table are kept.
+            Default: None.
+
+     Returns:
+         torch.Tensor: The confusion matrix of shape (num_classes,
+            num_classes) and dtype int64. Rows index the ground truth and
+            columns the prediction.
+    """
+
+    if isinstance(pred_label, str):
+        pred_label = torch.from_numpy(np.load(pred_label))
+    elif not isinstance(pred_label, torch.Tensor):
+        pred_label = torch.from_numpy((pred_label))
+
+    if isinstance(label, str):
+        label = torch.from_numpy(
+            mmcv.imread(label, flag='unchanged', backend='pillow'))
+    elif not isinstance(label, torch.Tensor):
+        label = torch.from_numpy(label)
+
+    label = label.long()
+    if label_lut is None and (label_map or reduce_zero_label):
+        label_lut = build_label_lut(label_map, reduce_zero_label)
+    if label_lut is not None:
+        label_lut = torch.from_numpy(label_lut).long()
+        in_lut = (label >= 0) & (label < len(label_lut))
+        label = torch.where(
+            in_lut, label_lut[label.clamp(0, len(label_lut) - 1)], label)
+    pred_label = pred_label.long()
+    mask = (label != ignore_index) & (label >= 0) & (label < num_classes) \
+        & (pred_label >= 0) & (pred_label < num_classes)
+    # invalid pixels are routed to an extra trailing bin which is dropped
+    index = torch.where(mask, num_classes * label + pred_label,
+                        num_classes**2)
+    conf_mat = torch.bincount(index.flatten(), minlength=num_classes**2 + 1)
+    return conf_mat[:num_classes**2].reshape(num_classes, num_classes)
+
+
+def confusion_matrix_to_areas(conf_mat):
+    """Convert a confusion matrix to intersection and union areas.
+
+    Args:
+        conf_mat (torch.Tensor): Confusion matrix of shape (num_classes,
+            num_classes) with ground truth along the rows.
+
+     Returns:
+         torch.Tensor: The intersection of prediction and ground truth
+            histogram on all classes.
+         torch.Tensor: The union of prediction and ground truth histogram on
+            all classes.
+         torch.Tensor: The prediction histogram on all classes.
+         torch.Tensor: The ground truth histogram on all classes.
+    """
+    conf_mat = conf_mat.to(torch.float64)
+    area_intersect = conf_mat.diagonal()
+    area_pred_label = conf_mat.sum(dim=0)
+    area_label = conf_mat.sum(dim=1)
+    area_union = area_pred_label + area_label - area_intersect
+    return area_intersect, area_union, area_pred_label, area_label
+
+
 def intersect_and_union(pred_label,
                         label,
                         num_classes,
@@ -51,39 +143,9 @@ def intersect_and_union(pred_label,
          torch.Tensor: The prediction histogram on all classes.
          torch.Tensor: The ground truth histogram on all classes.
     """
-
-    if isinstance(pred_label, str):
-        pred_label = torch.from_numpy(np.load(pred_label))
-    else:
-        pred_label = torch.from_numpy((pred_label))
-
-    if isinstance(label, str):
-        label = torch.from_numpy(
-            mmcv.imread(label, flag='unchanged', backend='pillow'))
-    else:
-        label = torch.from_numpy(label)
-
-    if label_map is not None:
-        for old_id, new_id in label_map.items():
-            label[label == old_id] = new_id
-    if reduce_zero_label:
-        label[label == 0] = 255
-        label = label - 1
-        label[label == 254] = 255
-
-    mask = (label != ignore_index)
-    pred_label = pred_label[mask]
-    label = label[mask]
-
-    intersect = pred_label[pred_label == label]
-    area_intersect = torch.histc(
-        intersect.float(), bins=(num_classes), min=0, max=num_classes - 1)
-    area_pred_label = torch.histc(
-        pred_label.float(), bins=(num_classes), min=0, max=num_classes - 1)
-    area_label = torch.histc(
-        label.float(), bins=(num_classes), min=0, max=num_classes - 1)
-    area_union = area_pred_label + area_label - area_intersect
-    return area_intersect, area_union, area_pred_label, area_label
+    conf_mat = confusion_matrix(pred_label, label, num_classes, ignore_index,
+                                label_map, reduce_zero_label)
+    return confusion_matrix_to_areas(conf_mat)
 
 
 def total_intersect_and_union(results,
@@ -112,21 +174,13 @@ def total_intersect_and_union(results,
          ndarray: The prediction histogram on all classes.
          ndarray: The ground truth histogram on all classes.
     """
-    total_area_intersect = torch.zeros((num_classes, ), dtype=torch.float64)
-    total_area_union = torch.zeros((num_classes, ), dtype=torch.float64)
-    total_area_pred_label = torch.zeros((num_classes, ), dtype=torch.float64)
-    total_area_label = torch.zeros((num_classes, ), dtype=torch.float64)
+    total_conf_mat = torch.zeros((num_classes, num_classes),
+                                 dtype=torch.int64)
     for result, gt_seg_map in zip(results, gt_seg_maps):
-        area_intersect, area_union, area_pred_label, area_label = \
-            intersect_and_union(
-                result, gt_seg_map, num_classes, ignore_index,
-                label_map, reduce_zero_label)
-        total_area_intersect += area_intersect
-        total_area_union += area_union
-        total_area_pred_label += area_pred_label
-        total_area_label += area_label
-    return total_area_intersect, total_area_union, total_area_pred_label, \
-        total_area_label
+        total_conf_mat += confusion_matrix(result, gt_seg_map, num_classes,
+                                           ignore_index, label_map,
+                                           reduce_zero_label)
+    return confusion_matrix_to_areas(total_conf_mat)
 
 
 def mean_iou(results,
@@ -300,8 +354,10 @@ def pre_eval_to_metrics(pre_eval_results,
     """Convert pre-eval results to metrics.
 
     Args:
-        pre_eval_results (list[tuple[torch.Tensor]]): per image eval results
-            for computing evaluation metric
+        pre_eval_results (list[torch.Tensor] | list[tuple[torch.Tensor]]):
+            per image confusion matrices, or per image (area_intersect,
+            area_union, area_pred_label, area_label) tuples, for computing
+            evaluation metric
         metrics (list[str] | str): Metrics to be evaluated, 'mIoU' and 'mDice'.
         nan_to_num (int, optional): If specified, NaN values will be replaced
             by the numbers defined by the user. Default: None.
@@ -311,16 +367,21 @@ def pre_eval_to_metrics(pre_eval_results,
         ndarray: Per category evaluation metrics, shape (num_classes, ).
     """
 
-    # convert list of tuples to tuple of lists, e.g.
-    # [(A_1, B_1, C_1, D_1), ...,  (A_n, B_n, C_n, D_n)] to
-    # ([A_1, ..., A_n], ..., [D_1, ..., D_n])
-    pre_eval_results = tuple(zip(*pre_eval_results))
-    assert len(pre_eval_results) == 4
+    if mmcv.is_list_of(pre_eval_results, torch.Tensor):
+        total_area_intersect, total_area_union, total_area_pred_label, \
+            total_area_label = confusion_matrix_to_areas(
+                sum(pre_eval_results))
+    else:
+        # convert list of tuples to tuple of lists, e.g.
+        # [(A_1, B_1, C_1, D_1), ...,  (A_n, B_n, C_n, D_n)] to
+        # ([A_1, ..., A_n], ..., [D_1, ..., D_n])
+        pre_eval_results = tuple(zip(*pre_eval_results))
+        assert len(pre_eval_results) == 4
 
-    total_area_intersect = sum(pre_eval_results[0])
-    total_area_union = sum(pre_eval_results[1])
-    total_area_pred_label = sum(pre_eval_results[2])
-    total_area_label = sum(pre_eval_results[3])
+        total_area_intersect = sum(pre_eval_results[0])
+        total_area_union = sum(pre_eval_results[1])
+        total_area_pred_label = sum(pre_eval_results[2])
+        total_area_label = sum(pre_eval_results[3])
 
     ret_metrics = total_area_to_metrics(total_area_intersect, total_area_union,
                                         total_area_pred_label,
@@ -377,8 +438,7 @@ def total_area_to_metrics(total_area_intersect,
         elif metric == 'mFscore':
             precision = total_area_intersect / total_area_pred_label
             recall = total_area_intersect / total_area_label
-            f_value = torch.tensor(
-                [f_score(x[0], x[1], beta) for x in zip(precision, recall)])
+            f_value = f_score(precision, recall, beta)
             ret_metrics['Fscore'] = f_value
             ret_metrics['Precision'] = precision
             ret_metrics['Recall'] = recall
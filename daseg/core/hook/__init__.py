@@ -6,6 +6,8 @@ from .wandblogger_hook import MMSegWandbHook
 # from .pseudo_labeling_hookv3 import PseudoLabelingHookV3
 # from .pseudo_labeling_hookv4 import PseudoLabelingHookV4
 from .plot_statistics_hook import PlotStatisticsHook
+from .shared_cache_hook import SharedCacheLoggerHook
+from .stop_training import StopTraining
 # from .rare_class_sampling_hook import RareClassSamplingHook
 
 __all__ = [
@@ -16,5 +18,7 @@ __all__ = [
     # 'PseudoLabelingHookV3',
     # 'PseudoLabelingHookV4',
     'PlotStatisticsHook',
+    'SharedCacheLoggerHook',
+    'StopTraining',
     # 'RareClassSamplingHook'
 ]
@@ -19,7 +19,7 @@ from mmcv.runner.hooks.checkpoint import CheckpointHook
 from mmcv.runner.hooks.logger.wandb import WandbLoggerHook
 from mmcv.runner.hooks import Hook
 from mmcv.utils import digit_version
-from daseg.ops import resize
+from daseg.ops import neighborhood_sim, neighborhood_values, resize
 from daseg.core import DistEvalHook, EvalHook
 # from daseg.core.mask.structures import polygon_to_bitmap
 
@@ -133,10 +133,6 @@ class PlotStatisticsHook(Hook):
         dilation = self.sim_feat_cfg['dilation']
         top_k = self.sim_feat_cfg['top_k']
 
-        unfold_fun = torch.nn.Unfold(kernel_size=kernel_size,
-                                     padding=kernel_size // 2 * dilation,
-                                     dilation=dilation)
-
         seg_logits = torch.tensor(seg_logits).unsqueeze(0).cuda()
         gt = torch.tensor(gt).unsqueeze(0).cuda()
         feat = feats[feat_level].cuda().unsqueeze(0)
@@ -149,19 +145,14 @@ class PlotStatisticsHook(Hook):
         gt = F.interpolate(gt.unsqueeze(1).to(torch.uint8), (h, w), mode='nearest')
 
 
-        unf_feat = unfold_fun(feat)
-
-        unf_feat = unf_feat.view(-1, c, kernel_size**2, h, w).permute(0, 1, 3, 4, 2)
-
-        temp_dis = ((unf_feat - feat.unsqueeze(4)) ** 2).sum(dim=1)
-        sim_feat = torch.exp(- temp_dis  / sigma ** 2).permute(0, 3, 1, 2)
+        sim_feat = neighborhood_sim(feat, kernel_size, dilation, 'gaussian',
+                                    sigma)
 
-        unf_logits = unfold_fun(preds.unsqueeze(1).float())
-        unf_logits = unf_logits.view(-1, kernel_size**2, h, w).long()
+        unf_logits = neighborhood_values(preds.unsqueeze(1), kernel_size,
+                                         dilation).squeeze(1)
         rep_logits = preds.unsqueeze(1).repeat(1, kernel_size**2, 1, 1)
 
-        unf_gt = unfold_fun(gt.float())
-        unf_gt = unf_gt.view(-1, kernel_size**2, h, w).long()
+        unf_gt = neighborhood_values(gt, kernel_size, dilation).squeeze(1)
         rep_gt = gt.repeat(1, kernel_size**2, 1, 1)
 
         mask = gt == preds
@@ -20,7 +20,8 @@ from mmcv.runner.hooks import Hook
 from mmcv.utils import digit_version
 
 from daseg.ops import resize
-from daseg.core import DistEvalHook, EvalHook
+from daseg.core import ClassEntropyHistogram, DistEvalHook, EvalHook
+from daseg.utils import AsyncWriter
 # from daseg.core.mask.structures import polygon_to_bitmap
 
 
@@ -35,12 +36,19 @@ class PseudoLabelingHookV2(Hook):
                  interval=50,
                  sim_feat_cfg=None,
                  down_scale=1.0,
+                 thre_num_bins=10000,
+                 writer_cfg=dict(num_workers=2, max_pending=8),
                  **kwargs):
         self.log_dir = log_dir
         self.interval = interval
         self.cls_thre_ratios=cls_thre_ratios
+        # bins of the streaming entropy histogram of every class
+        self.thre_num_bins = thre_num_bins
         self.sim_feat_cfg = sim_feat_cfg
         self.down_scale = down_scale
+        # the files are written by AsyncWriter threads while the model runs
+        # the next batch
+        self.writer_cfg = writer_cfg
 
         if not osp.exists(self.log_dir):
             os.makedirs(self.log_dir)
@@ -87,8 +95,9 @@ class PseudoLabelingHookV2(Hook):
             model = runner.model
             model.eval()
             dataloader = self.eval_hook.dataloader
-            logits = []
+            ent_hist = None
             img_names = []
+            writer = AsyncWriter(**self.writer_cfg)
 
             dataset = self.eval_hook.dataloader.dataset
             prog_bar = mmcv.ProgressBar(len(dataset))
@@ -109,22 +118,23 @@ class PseudoLabelingHookV2(Hook):
                     seg_logits = state['seg_logits']
                     img_name = img_metas['filename'].split('/')[-1].split('.')[0]
 
-                    logits.append(seg_logits)
+                    if ent_hist is None:
+                        ent_hist = ClassEntropyHistogram(
+                            seg_logits.shape[0], self.thre_num_bins,
+                            device=seg_logits.device)
+                    if self.down_scale < 1:
+                        ent_hist.update(F.interpolate(
+                            seg_logits.unsqueeze(0),
+                            scale_factor=(self.down_scale, self.down_scale)))
+                    else:
+                        ent_hist.update(seg_logits)
                     img_names.append(img_name)
 
                     gaussian_sim_feats = self._cal_sim_feat(feats, type='gaussian')
                     cosine_sim_feats = self._cal_sim_feat(feats, type='cosine')
 
-                    with h5py.File(osp.join(self.log_dir, f'{img_name}.h5'), 'w') as hf:
-                        hf.create_dataset('seg_logits', data=seg_logits)
-
-                        for i, gaussian_sim_feat in enumerate(gaussian_sim_feats):
-                            hf.create_dataset(f'gaussian_sim_feat_{i}', data=gaussian_sim_feat)
-
-                        for i, cosine_sim_feat in enumerate(cosine_sim_feats):
-                            hf.create_dataset(f'cosine_sim_feat_{i}', data=cosine_sim_feat)
-
-                        hf.close()
+                    writer.submit(self._write_sample, img_name, seg_logits,
+                                  gaussian_sim_feats, cosine_sim_feats)
 
                     batch_size = len(result)
                     for _ in range(batch_size):
@@ -134,9 +144,9 @@ class PseudoLabelingHookV2(Hook):
                 # if cnt == 10:
                 #     break
 
-            all_seg_logits = [logit for logit in logits]
-            cls_thre_map = self._cal_threshold(torch.stack(all_seg_logits, dim=0),
-                                               down_scale=self.down_scale)
+            # the thresholds are appended once all files have landed
+            writer.close()
+            cls_thre_map = ent_hist.get_thresholds(self.cls_thre_ratios)
 
             for img_name in img_names:
                 with h5py.File(osp.join(self.log_dir, f'{img_name}.h5'), 'a') as hf:
@@ -150,33 +160,17 @@ class PseudoLabelingHookV2(Hook):
         super(PseudoLabelingHookV2, self).after_train_epoch(runner)
         pass
 
-    def _cal_threshold(self, seg_logits, down_scale=1):
-
-        if down_scale < 1:
-            seg_logits = F.interpolate(seg_logits, scale_factor=(down_scale, down_scale))
+    def _write_sample(self, img_name, seg_logits, gaussian_sim_feats,
+                      cosine_sim_feats):
+        with h5py.File(osp.join(self.log_dir, f'{img_name}.h5'), 'w') as hf:
+            hf.create_dataset('seg_logits', data=seg_logits.cpu())
 
-        num_classes = seg_logits.shape[1]
-        prob_maps = F.softmax(seg_logits, dim=1)
-        pred_maps = prob_maps.argmax(dim=1)
-        ent_maps = (- prob_maps * torch.log(prob_maps)).sum(dim=1)
-
-        thre_map = {}
-        for cls_thre_ratio in self.cls_thre_ratios:
-            thre_map[f'thre@{cls_thre_ratio}'] = []
-
-        for cls in range(num_classes):
-            if (pred_maps == cls).sum() == 0:
-                for cls_thre_ratio in self.cls_thre_ratios:
-                    thre_map[f'thre@{cls_thre_ratio}'].append(0)
-
-            else:
-                sorted_map = np.sort(ent_maps[pred_maps==cls].reshape(-1))
-                for cls_thre_ratio in self.cls_thre_ratios:
-                    thre_rank = int(len(sorted_map) * cls_thre_ratio)
-                    cur_thre = sorted_map[thre_rank]
-                    thre_map[f'thre@{cls_thre_ratio}'].append(cur_thre)
+            for i, gaussian_sim_feat in enumerate(gaussian_sim_feats):
+                hf.create_dataset(
+                    f'gaussian_sim_feat_{i}', data=gaussian_sim_feat)
 
-        return thre_map
+            for i, cosine_sim_feat in enumerate(cosine_sim_feats):
+                hf.create_dataset(f'cosine_sim_feat_{i}', data=cosine_sim_feat)
 
     def _cal_sim_feat(self, feats, type='gaussian'):
         kernel_size = self.sim_feat_cfg['kernel_size']
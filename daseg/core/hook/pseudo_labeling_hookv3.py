@@ -21,7 +21,7 @@ from mmcv.utils import digit_version
 from daseg.datasets import build_dataloader, build_dataset 
 
 from daseg.ops import resize
-from daseg.core import DistEvalHook, EvalHook
+from daseg.core import ClassEntropyHistogram, DistEvalHook, EvalHook
 # from daseg.core.mask.structures import polygon_to_bitmap
 
 
@@ -37,10 +37,13 @@ class PseudoLabelingHookV3(Hook):
                  sim_feat_cfg=None,
                  down_scale=1.0,
                  data_cfg=None,
+                 thre_num_bins=10000,
                  **kwargs):
         self.log_dir = log_dir
         self.interval = interval
         self.cls_thre_ratios=cls_thre_ratios
+        # bins of the streaming entropy histogram of every class
+        self.thre_num_bins = thre_num_bins
         self.sim_feat_cfg = sim_feat_cfg
         self.down_scale = down_scale
         self.data_cfg = data_cfg
@@ -93,7 +96,7 @@ class PseudoLabelingHookV3(Hook):
             dataloader = self.test_dataloader
             dataset = self.test_dataloader.dataset
 
-            logits = []
+            ent_hist = None
             img_names = []
 
             prog_bar = mmcv.ProgressBar(len(dataset))
@@ -114,7 +117,16 @@ class PseudoLabelingHookV3(Hook):
                     seg_logits = state['seg_logits']
                     img_name = img_metas['filename'].split('/')[-1].split('.')[0]
 
-                    logits.append(seg_logits)
+                    if ent_hist is None:
+                        ent_hist = ClassEntropyHistogram(
+                            seg_logits.shape[0], self.thre_num_bins,
+                            device=seg_logits.device)
+                    if self.down_scale < 1:
+                        ent_hist.update(F.interpolate(
+                            seg_logits.unsqueeze(0),
+                            scale_factor=(self.down_scale, self.down_scale)))
+                    else:
+                        ent_hist.update(seg_logits)
                     img_names.append(img_name)
 
                     gaussian_sim_feats = self._cal_sim_feat(feats, type='gaussian')
@@ -139,9 +151,7 @@ class PseudoLabelingHookV3(Hook):
                 # if cnt == 10:
                 #     break
 
-            all_seg_logits = [logit for logit in logits]
-            cls_thre_map = self._cal_threshold(torch.stack(all_seg_logits, dim=0),
-                                               down_scale=self.down_scale)
+            cls_thre_map = ent_hist.get_thresholds(self.cls_thre_ratios)
 
             for img_name in img_names:
                 with h5py.File(osp.join(self.log_dir, f'{img_name}.h5'), 'a') as hf:
@@ -155,34 +165,6 @@ class PseudoLabelingHookV3(Hook):
         super(PseudoLabelingHookV3, self).after_train_epoch(runner)
         pass
 
-    def _cal_threshold(self, seg_logits, down_scale=1):
-
-        if down_scale < 1:
-            seg_logits = F.interpolate(seg_logits, scale_factor=(down_scale, down_scale))
-
-        num_classes = seg_logits.shape[1]
-        prob_maps = F.softmax(seg_logits, dim=1)
-        pred_maps = prob_maps.argmax(dim=1)
-        ent_maps = (- prob_maps * torch.log(prob_maps)).sum(dim=1)
-
-        thre_map = {}
-        for cls_thre_ratio in self.cls_thre_ratios:
-            thre_map[f'thre@{cls_thre_ratio}'] = []
-
-        for cls in range(num_classes):
-            if (pred_maps == cls).sum() == 0:
-                for cls_thre_ratio in self.cls_thre_ratios:
-                    thre_map[f'thre@{cls_thre_ratio}'].append(0)
-
-            else:
-                sorted_map = np.sort(ent_maps[pred_maps==cls].reshape(-1))
-                for cls_thre_ratio in self.cls_thre_ratios:
-                    thre_rank = int(len(sorted_map) * cls_thre_ratio)
-                    cur_thre = sorted_map[thre_rank]
-                    thre_map[f'thre@{cls_thre_ratio}'].append(cur_thre)
-
-        return thre_map
-
     def _cal_sim_feat(self, feats, type='gaussian'):
         kernel_size = self.sim_feat_cfg['kernel_size']
         sigmas = self.sim_feat_cfg['sigmas']
@@ -4,31 +4,52 @@ import os
 import os.path as osp
 import sys
 import warnings
-import pdb
 import h5py
 import torch.nn.functional as F
 import torch
+import torch.distributed as dist
 import tqdm
 
 import mmcv
 import numpy as np
 import pycocotools.mask as mask_util
-from mmcv.runner import HOOKS
-from mmcv.runner.dist_utils import master_only
+from mmcv.runner import HOOKS, get_dist_info
 from mmcv.runner.hooks.checkpoint import CheckpointHook
 from mmcv.runner.hooks.logger.wandb import WandbLoggerHook
 from mmcv.runner.hooks import Hook
 from mmcv.utils import digit_version
 from daseg.datasets import build_dataloader, build_dataset 
 
-from daseg.ops import resize
-from daseg.core import DistEvalHook, EvalHook
+from daseg.ops import neighborhood_sq_dist, resize
+from daseg.core import (ClassEntropyHistogram, DistEvalHook, EvalHook,
+                        calibrate_gaussian_sigmas)
+from daseg.utils import AsyncWriter, PseudoLabelStore
+from .stop_training import StopTraining
 # from daseg.core.mask.structures import polygon_to_bitmap
 
 
 @HOOKS.register_module()
 class PseudoLabelingHookV4(Hook):
-    """Enhanced Wandb logger hook for MMDetection.
+    """Generate the pseudo labels of the target dataset every ``interval``
+    iterations.
+
+    In distributed runs, the target dataset is sharded across the ranks with
+    a ``DistributedSampler``. Every rank writes its own part of the
+    :class:`PseudoLabelStore` and the entropy histograms and distance
+    histograms of the thresholds and sigmas are all-reduced, so that all
+    ranks agree on them. The generation can also be run outside of training
+    with ``tools/gen_pseudo_labels.py``.
+
+    The down-scaling, the device to host copies and the store writes of
+    every image run in :class:`AsyncWriter` threads configured by
+    ``writer_cfg``, while the model runs the next batch.
+
+    Args:
+        stop_after_generation (bool): Whether to end the run cleanly after
+            the pseudo labels have been generated. Default: True.
+        writer_cfg (dict): Arguments of the :class:`AsyncWriter`, use
+            ``num_workers=0`` to write synchronously. Default:
+            ``dict(num_workers=2, max_pending=8)``.
     """
 
     def __init__(self,
@@ -39,28 +60,50 @@ class PseudoLabelingHookV4(Hook):
                  thre_sample_ratio=1.0,
                  data_cfg=None,
                  sim_feat_cfg=None,
+                 compression=None,
+                 save_logits=True,
+                 thre_num_bins=10000,
+                 stop_after_generation=True,
+                 writer_cfg=dict(num_workers=2, max_pending=8),
                  **kwargs):
         self.log_dir = log_dir
         self.interval = interval
         self.cls_thre_ratios=cls_thre_ratios
+        # bins of the streaming entropy histogram of every class
+        self.thre_num_bins = thre_num_bins
         self.down_scale = down_scale
-        self.thre_sample_ratio = thre_sample_ratio # to accelerate the sorting process
+        # to accelerate the sigma search
+        self.thre_sample_ratio = thre_sample_ratio
         self.data_cfg = data_cfg
         self.sim_feat_cfg = sim_feat_cfg
+        # all pseudo labels go to one PseudoLabelStore in log_dir
+        self.compression = compression
+        # the loader only needs the argmax and entropy maps stored besides
+        # the logits, disable to shrink the store
+        self.save_logits = save_logits
+        self.stop_after_generation = stop_after_generation
+        # set once the pseudo labels are generated with stop_after_generation
+        self.generated = False
+        self.writer_cfg = writer_cfg
 
         if not osp.exists(self.log_dir):
             os.makedirs(self.log_dir)
 
 
-    @master_only
     def before_run(self, runner):
         super(PseudoLabelingHookV4, self).before_run(runner)
+        self.test_dataloader = self.build_test_dataloader()
+
+    def build_test_dataloader(self):
+        """Build the dataloader of the target images, sharded across the
+        ranks if distributed."""
         test_dataset = build_dataset(self.data_cfg.test)
+        _, world_size = get_dist_info()
 
         loader_cfg = dict(
             # cfg.gpus will be ignored if distributed
             num_gpus=1,
-            dist=False,
+            dist=world_size > 1,
             shuffle=False)
 
         # The overall dataloader settings
@@ -79,130 +122,148 @@ class PseudoLabelingHookV4(Hook):
             **self.data_cfg.get('test_dataloader', {}),
         }
 
-        self.test_dataloader = build_dataloader(test_dataset, **test_loader_cfg)
-
-
+        return build_dataloader(test_dataset, **test_loader_cfg)
 
-    @master_only
     def after_train_iter(self, runner):
         super(PseudoLabelingHookV4, self).after_train_iter(runner)
 
-
         if self.every_n_iters(runner, self.interval):
-
-            model = runner.model
-            model.eval()
-            # dataloader = self.eval_hook.dataloader
-            # dataset = self.eval_hook.dataloader.dataset
-            dataloader = self.test_dataloader
-            dataset = self.test_dataloader.dataset
-            dataset.test_mode = True
-
-
-            logits = []
-            img_names = []
-            feat_level = self.sim_feat_cfg['feat_level']
-
+            self.generate(runner.model, self.test_dataloader)
+            runner.model.train()
+            if self.stop_after_generation:
+                runner.logger.info(
+                    f'Generated the pseudo labels in {self.log_dir}, '
+                    'stopping training.')
+                self.generated = True
+
+    def before_train_iter(self, runner):
+        # stop once all hooks finished the iteration of the generation
+        if self.generated:
+            raise StopTraining(
+                f'Generated the pseudo labels in {self.log_dir}')
+
+    def generate(self, model, dataloader):
+        """Write the pseudo labels of the images of ``dataloader``.
+
+        All ranks have to call it, each with its shard of the dataset.
+        """
+        rank, world_size = get_dist_info()
+        model.eval()
+        # dataloader = self.eval_hook.dataloader
+        # dataset = self.eval_hook.dataloader.dataset
+        dataset = dataloader.dataset
+        dataset.test_mode = True
+
+        device = next(model.parameters()).device
+        ent_hist = ClassEntropyHistogram(
+            len(dataset.CLASSES), self.thre_num_bins, device=device)
+        img_names = []
+        feat_level = self.sim_feat_cfg['feat_level'] \
+            if self.sim_feat_cfg is not None else []
+
+        if rank == 0:
             prog_bar = mmcv.ProgressBar(len(dataset))
-            loader_indices = dataloader.batch_sampler
-
-            cnt = 0
-            loc_dis_list = []
-
-            for batch_indices, data in zip(loader_indices, dataloader):
-                with torch.no_grad():
-                    result, states = model(return_loss=False, **data)
-
-                img_metas = data['img_metas'][0].data[0]
-                for x, y in zip(states, img_metas):
-                    x['img_metas'] = y
-
-                for state in states:
-                    img_metas = state['img_metas']
-                    feats = state['feats']
-                    seg_logits = state['seg_logits']
-                    img_name = img_metas['filename'].split('/')[-1].split('.')[0]
-
-                    if self.sim_feat_cfg is not None:
-                        loc_dis_list.append(self._cal_loc_dis(feats))
-
-                    logits.append(seg_logits)
-                    img_names.append(img_name)
-
-                    with h5py.File(osp.join(self.log_dir, f'{img_name}.h5'), 'w') as hf:
-
-                        seg_logits_down = F.interpolate(seg_logits.unsqueeze(0),
-                                                        scale_factor=(self.down_scale, self.down_scale))
-
-                        hf.create_dataset('seg_logits', data=seg_logits_down.squeeze(0))
-                        # for i, feat in enumerate(feats):
-                        for i in feat_level:
-                            feat = feats[i]
-                            feat_down = F.interpolate(feat.unsqueeze(0),
-                                                      scale_factor=(self.down_scale, self.down_scale))
-                            hf.create_dataset(f'feat_{i}', data=feat_down.squeeze(0))
-
-                        hf.close()
-
-                    batch_size = len(result)
-                    for _ in range(batch_size):
-                        prog_bar.update()
-
-            all_seg_logits = [logit for logit in logits]
-            cls_thre_map = self._cal_threshold(torch.stack(all_seg_logits, dim=0),
-                                               sample_ratio=self.thre_sample_ratio)
-            sigmas = self._cal_sigmas(loc_dis_list, sample_ratio=self.thre_sample_ratio)
-
-            for idx, img_name in enumerate(img_names):
-                with h5py.File(osp.join(self.log_dir, f'{img_name}.h5'), 'a') as hf:
-                    for key, value in cls_thre_map.items():
-                        hf.create_dataset(key, data=value)
-                    for key, value in sigmas.items():
-                        hf.create_dataset(key, data=value)
-                    hf.close()
-
-            raise ValueError('Succesfully generated the pseudo labels, stop training.')
-
-    @master_only
-    def after_train_epoch(self, runner):
-        pdb.set_trace()
-        super(PseudoLabelingHookV4, self).after_train_epoch(runner)
-        pass
-
-    def _cal_threshold(self, seg_logits, sample_ratio):
-
-        B, num_classes, H, W = seg_logits.shape
-        seg_logits = seg_logits.permute(0,2,3,1).contiguous().view(-1, num_classes)
-        num_samples, _ = seg_logits.shape
-
-
-        idx = np.random.permutation(num_samples)[:int(num_samples * sample_ratio)-1]
-        seg_logits = seg_logits[idx, :]
-        # if down_scale < 1:
-        #     seg_logits = F.interpolate(seg_logits, scale_factor=(down_scale, down_scale))
-
-        prob_maps = F.softmax(seg_logits, dim=1)
-        pred_maps = prob_maps.argmax(dim=1)
-        ent_maps = (- prob_maps * torch.log(prob_maps)).sum(dim=1)
-
-        thre_map = {}
-        for cls_thre_ratio in self.cls_thre_ratios:
-            thre_map[f'thre@{cls_thre_ratio}'] = []
-
-        for cls in range(num_classes):
-            if (pred_maps == cls).sum() == 0:
-                for cls_thre_ratio in self.cls_thre_ratios:
-                    thre_map[f'thre@{cls_thre_ratio}'].append(0)
-
-            else:
-                sorted_map = np.sort(ent_maps[pred_maps==cls].reshape(-1))
-                for cls_thre_ratio in self.cls_thre_ratios:
-                    thre_rank = int(len(sorted_map) * cls_thre_ratio)
-                    cur_thre = sorted_map[thre_rank]
-                    thre_map[f'thre@{cls_thre_ratio}'].append(cur_thre)
-
-        return thre_map
-
+        loader_indices = dataloader.batch_sampler
+
+        # the non-shuffled DistributedSampler gives position
+        # rank + k * world_size of the dataset order to the k-th sample of
+        # this rank, positions beyond the dataset are padding
+        position = rank
+        loc_dis_list = []
+        store = PseudoLabelStore(
+            self.log_dir,
+            mode='w',
+            compression=self.compression,
+            part=rank if world_size > 1 else None)
+        try:
+            # all samples must have landed before the global arrays are
+            # written, the writer is closed on exit
+            with AsyncWriter(**self.writer_cfg) as writer:
+                for batch_indices, data in zip(loader_indices, dataloader):
+                    with torch.no_grad():
+                        result, states = model(return_loss=False, **data)
+
+                    img_metas = data['img_metas'][0].data[0]
+                    for x, y in zip(states, img_metas):
+                        x['img_metas'] = y
+
+                    for state in states:
+                        is_padding = position >= len(dataset)
+                        position += world_size
+                        if is_padding:
+                            continue
+                        img_metas = state['img_metas']
+                        feats = state['feats']
+                        seg_logits = state['seg_logits']
+                        img_name = osp.basename(
+                            img_metas['filename']).split('.')[0]
+
+                        if self.sim_feat_cfg is not None:
+                            loc_dis_list.append(self._cal_loc_dis(feats))
+
+                        ent_hist.update(seg_logits)
+                        img_names.append(img_name)
+
+                        writer.submit(self._write_sample, store,
+                                      img_name, seg_logits,
+                                      [feats[i] for i in feat_level],
+                                      feat_level)
+
+                    if rank == 0:
+                        for _ in range(len(result) * world_size):
+                            prog_bar.update()
+        except BaseException:
+            store.close()
+            raise
+        if world_size > 1:
+            store.close()
+
+        ent_hist.all_reduce()
+        cls_thre_map = ent_hist.get_thresholds(self.cls_thre_ratios)
+        sigmas = self._cal_sigmas(
+            loc_dis_list, sample_ratio=self.thre_sample_ratio
+        ) if self.sim_feat_cfg is not None else {}
+
+        if rank == 0:
+            if world_size > 1:
+                store = PseudoLabelStore(self.log_dir, mode='w')
+                store.set_parts(world_size)
+            # thresholds and sigmas are the same for all images
+            store.set_global('down_scale', self.down_scale)
+            for key, value in cls_thre_map.items():
+                store.set_global(key, value)
+            for key, value in sigmas.items():
+                store.set_global(key, value)
+        store.close()
+        if world_size > 1:
+            # the store is complete once rank 0 wrote the global arrays
+            dist.barrier()
+
+    def _write_sample(self, store, img_name, seg_logits, feats, feat_level):
+        seg_logits_down = F.interpolate(
+            seg_logits.unsqueeze(0),
+            scale_factor=(self.down_scale, self.down_scale))
+        seg_logits_down = seg_logits_down.squeeze(0)
+        arrays = self._get_pred_entropy(seg_logits_down)
+        if self.save_logits:
+            arrays['seg_logits'] = seg_logits_down.cpu().numpy()
+        # for i, feat in enumerate(feats):
+        for i, feat in zip(feat_level, feats):
+            feat_down = F.interpolate(
+                feat.unsqueeze(0),
+                scale_factor=(self.down_scale, self.down_scale))
+            arrays[f'feat_{i}'] = feat_down.squeeze(0).cpu().numpy()
+        store.add(img_name, **arrays)
+
+    @staticmethod
+    def _get_pred_entropy(seg_logits):
+        """Get the uint8 argmax and float16 entropy maps of (C, H, W) logits,
+        with the entropy computed like in LoadAnnotationsPseudoLabelsV2."""
+        probs = F.softmax(seg_logits.float(), dim=0)
+        entropy = -(probs * torch.log(probs + 1e-8)).sum(dim=0)
+        return dict(
+            pred=probs.argmax(dim=0).to(torch.uint8).cpu().numpy(),
+            entropy=entropy.half().cpu().numpy())
 
     def _cal_loc_dis(self, feats):
 
@@ -215,15 +276,11 @@ class PseudoLabelingHookV4(Hook):
         loc_dis = dict()
         for level, feat in enumerate(feats):
             C, H, W = feat.shape
-            feat = feat.unsqueeze(0).cuda()
+            feat = feat.unsqueeze(0)
             for dila in dilations:
-                self.unfold_fun = torch.nn.Unfold(kernel_size=kernel_size,
-                                                  padding=kernel_size // 2 * dila,
-                                                  dilation=dila)
-                unf_feat = self.unfold_fun(feat)
-                unf_feat = unf_feat.view(1, -1, kernel_size**2, H, W).permute(0, 1, 3, 4, 2)
-
-                temp_dis = ((unf_feat - feat.unsqueeze(4)) ** 2).sum(dim=1)
+                temp_dis = neighborhood_sq_dist(feat, kernel_size, dila)
+                # (1, H, W, k)
+                temp_dis = temp_dis.permute(0, 2, 3, 1).contiguous()
                 loc_dis[f'level{level}_dila@{dila}'] = temp_dis.cpu()
                 # sim_feat = torch.exp(- temp_dis  / sigmas[i] ** 2).permute(0, 3, 1, 2)
 
@@ -239,39 +296,27 @@ class PseudoLabelingHookV4(Hook):
         if type(mean_sims) != list:
             mean_sims = [mean_sims]
 
-        loc_dis_tensor = dict()
+        sigmas = dict()
         for level in feat_level:
             for dila in dilations:
-                # loc_dis_tensor[f'level{level}_dila@{dila}'] = []
-                cur_tensor = []
+                key = f'level{level}_dila@{dila}'
+                dis_list = []
                 for loc_dis in loc_dis_list:
-                    cur_tensor.append(loc_dis[f'level{level}_dila@{dila}'])
-
-                # loc_dis_tensor[f'level{level}_dila@{dila}'] = torch.cat(loc_dis_tensor[f'level{level}_dila@{dila}'], dim=0)
-                cur_tensor = torch.cat(cur_tensor, dim=0) # B, 9, H, W
-                B, H, W, C = cur_tensor.shape
-
-                cur_tensor = cur_tensor.view(-1, C)
-                num_samples = cur_tensor.shape[0]
-                idx = np.random.permutation(num_samples)[:int(num_samples * sample_ratio)-1]
-                loc_dis_tensor[f'level{level}_dila@{dila}'] = cur_tensor[idx, :]
-
-        sigmas = dict()
-        for key, dis in loc_dis_tensor.items():
-
-            for mean_sim in tqdm.tqdm(mean_sims):
-                # start binary search
-                left = 0
-                right = 1000
-                while abs(left - right) > 1e-6:
-                    sigma = (left + right) / 2
-                    sim_feat = torch.exp(- dis  / sigma ** 2)
-                    if sim_feat.mean() < mean_sim:
-                        left = sigma
-                    else:
-                        right = sigma
-
-                sigmas[f'{key}_mean@{mean_sim}'] = left
+                    cur_tensor = loc_dis[key]
+                    cur_tensor = cur_tensor.view(-1, cur_tensor.shape[-1])
+                    if sample_ratio < 1:
+                        num_samples = cur_tensor.shape[0]
+                        num_keep = int(num_samples * sample_ratio)
+                        idx = torch.randperm(num_samples)[:num_keep]
+                        cur_tensor = cur_tensor[idx, :]
+                    dis_list.append(cur_tensor)
+
+                # all targets are searched at once on a histogram of the
+                # distances, without concatenating them
+                key_sigmas = calibrate_gaussian_sigmas(
+                    dis_list, mean_sims, all_reduce=True)
+                for mean_sim, sigma in zip(mean_sims, key_sigmas):
+                    sigmas[f'{key}_mean@{mean_sim}'] = sigma
 
         return sigmas
 
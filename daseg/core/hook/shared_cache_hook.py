@@ -0,0 +1,42 @@
+from mmcv.runner import HOOKS
+from mmcv.runner.hooks import Hook
+
+from daseg.utils import get_shared_caches
+
+
+@HOOKS.register_module()
+class SharedCacheLoggerHook(Hook):
+    """Report the counters of the shared decoded-sample caches.
+
+    Every ``interval`` iterations, the hits, misses and evictions of every
+    :class:`daseg.utils.SharedArrayCache` since the last report, their hit
+    rate and the cached GiB are put into the log buffer, so that they are
+    printed by the logger hooks of lower priority.
+
+    Args:
+        interval (int): Logging interval, which should be the one of the
+            logger hooks. Default: 50.
+    """
+
+    def __init__(self, interval=50):
+        self.interval = interval
+        self.last_stats = {}
+
+    def after_train_iter(self, runner):
+        if not self.every_n_iters(runner, self.interval):
+            return
+        for name, cache in get_shared_caches().items():
+            stats = cache.get_stats()
+            last = self.last_stats.get(
+                name, dict(hits=0, misses=0, evictions=0))
+            self.last_stats[name] = stats
+            hits = stats['hits'] - last['hits']
+            misses = stats['misses'] - last['misses']
+            runner.log_buffer.update({
+                f'cache.{name}.hit_rate': hits / max(hits + misses, 1),
+                f'cache.{name}.hits': hits,
+                f'cache.{name}.misses': misses,
+                f'cache.{name}.evictions':
+                stats['evictions'] - last['evictions'],
+                f'cache.{name}.gb': stats['bytes'] / 1024**3,
+            })
@@ -0,0 +1,6 @@
+class StopTraining(Exception):
+    """Raised by a hook to end the run before ``max_iters``.
+
+    :func:`daseg.apis.train_segmentor` catches it and finishes the run like
+    the runner does after its last iteration.
+    """
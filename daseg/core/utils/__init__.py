@@ -1,5 +1,10 @@
 # Obtained from: https://github.com/open-mmlab/dasegmentation/tree/v0.16.0
 
-from .misc import add_prefix
+from .entropy_histogram import ClassEntropyHistogram
+from .misc import add_prefix, build_label_lut
+from .sigma_calibration import calibrate_gaussian_sigmas
 
-__all__ = ['add_prefix']
+__all__ = [
+    'add_prefix', 'build_label_lut', 'ClassEntropyHistogram',
+    'calibrate_gaussian_sigmas'
+]
@@ -0,0 +1,106 @@
+import math
+
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+
+
+class ClassEntropyHistogram(object):
+    """Streaming per-class histograms of the prediction entropy.
+
+    Every pixel is counted in the histogram of its predicted class, in one of
+    ``num_bins`` equal bins over ``[0, log(num_classes)]``, the range of the
+    entropy. The memory is therefore ``num_classes * num_bins`` counters
+    whatever the number of images. Quantiles are interpolated linearly within
+    their bin, so their error is bounded by the bin width
+    ``log(num_classes) / num_bins``.
+
+    With a ``momentum``, the counters decay by ``momentum`` at every update,
+    so that the histograms follow a model that changes during training.
+
+    Args:
+        num_classes (int): Number of classes.
+        num_bins (int): Number of bins per class. Default: 10000.
+        device (str | torch.device): Device of the counters, usually the one
+            of the logits. Default: 'cpu'.
+        momentum (float, optional): Decay of the counters per update.
+            Default: None.
+    """
+
+    def __init__(self, num_classes, num_bins=10000, device='cpu',
+                 momentum=None):
+        # the entropy range, and thus the bin width, is 0 for a single class
+        assert num_classes > 1, 'The entropy needs at least two classes'
+        self.num_classes = num_classes
+        self.num_bins = num_bins
+        self.max_entropy = math.log(num_classes)
+        self.momentum = momentum
+        self.hist = torch.zeros(
+            num_classes * num_bins,
+            dtype=torch.int64 if momentum is None else torch.float64,
+            device=device)
+
+    @staticmethod
+    def get_pred_entropy(seg_logits):
+        """Get the argmax and entropy maps of (N, C, H, W) logits."""
+        probs = F.softmax(seg_logits.float(), dim=1)
+        preds = probs.argmax(dim=1)
+        # p * log(p) is 0 for p == 0
+        ent_maps = -(probs * torch.log(
+            probs.clamp(min=torch.finfo(probs.dtype).tiny))).sum(dim=1)
+        return preds, ent_maps
+
+    def update(self, seg_logits):
+        """Count the pixels of (C, H, W) or (N, C, H, W) logits."""
+        if seg_logits.dim() == 3:
+            seg_logits = seg_logits.unsqueeze(0)
+        self.update_maps(*self.get_pred_entropy(seg_logits))
+
+    def update_maps(self, preds, ent_maps, all_reduce=False):
+        """Count the pixels of argmax and entropy maps of any shape.
+
+        With ``all_reduce``, the pixels of all ranks are counted, every rank
+        passing its own.
+        """
+        bins = (ent_maps * (self.num_bins / self.max_entropy)).long().clamp(
+            0, self.num_bins - 1)
+        flat = (preds.long() * self.num_bins + bins).view(-1).to(
+            self.hist.device)
+        counts = torch.bincount(flat, minlength=self.hist.numel())
+        if all_reduce and dist.is_available() and dist.is_initialized():
+            counts = counts.to(self.hist.dtype)
+            dist.all_reduce(counts)
+        if self.momentum is not None:
+            self.hist.mul_(self.momentum)
+        self.hist += counts
+
+    def all_reduce(self):
+        """Sum the histograms of all ranks, if distributed."""
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(self.hist)
+
+    def get_thresholds(self, ratios):
+        """Get the per-class entropy below which ``ratio`` of the pixels of
+        the class lie, for every ratio.
+
+        Returns:
+            dict[str, list[float]]: The thresholds under ``thre@{ratio}``,
+                0 for classes that were never predicted.
+        """
+        hist = self.hist.view(self.num_classes, self.num_bins).cpu().double()
+        cum = hist.cumsum(dim=1)
+        counts = cum[:, -1]
+        bin_width = self.max_entropy / self.num_bins
+        thre_map = {}
+        for ratio in ratios:
+            # rank of the threshold among the sorted entropies of a class
+            ranks = (counts * ratio).floor().clamp(max=counts - 1)
+            idx = torch.searchsorted(cum, ranks.unsqueeze(1), right=True)
+            idx = idx.clamp(max=self.num_bins - 1)
+            in_bin = hist.gather(1, idx).squeeze(1)
+            before = cum.gather(1, idx).squeeze(1) - in_bin
+            frac = (ranks - before + 0.5) / in_bin.clamp(min=1)
+            thre = (idx.squeeze(1).double() + frac) * bin_width
+            thre[counts == 0] = 0
+            thre_map[f'thre@{ratio}'] = thre.tolist()
+        return thre_map
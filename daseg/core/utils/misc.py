@@ -1,4 +1,7 @@
 # Obtained from: https://github.com/open-mmlab/dasegmentation/tree/v0.16.0
+# Modifications: Add build_label_lut
+
+import numpy as np
 
 
 def add_prefix(inputs, prefix):
@@ -18,3 +21,33 @@ def add_prefix(inputs, prefix):
         outputs[f'{prefix}.{name}'] = value
 
     return outputs
+
+
+def build_label_lut(label_map=None, reduce_zero_label=False):
+    """Build a lookup table that remaps uint8 segmentation labels.
+
+    The table reproduces applying ``label_map`` entry by entry followed by
+    ``reduce_zero_label``, so that a label map can be remapped with a single
+    ``np.take(lut, label)`` regardless of the number of remapped classes.
+
+    Args:
+        label_map (dict, optional): Mapping old labels to new labels. New
+            labels of -1 are mapped to 255. Default: None.
+        reduce_zero_label (bool): Whether to mark label zero as ignored (255)
+            and reduce all other labels by 1. Default: False.
+
+    Returns:
+        ndarray: The lookup table of shape (256, ) and dtype uint8.
+    """
+
+    lut = np.arange(256, dtype=np.int64)
+    if label_map is not None:
+        for old_id, new_id in label_map.items():
+            lut[lut == old_id] = new_id
+        # wrap around like assigning to a uint8 label map, e.g. -1 to 255
+        lut %= 256
+    if reduce_zero_label:
+        lut[lut == 0] = 255
+        lut = lut - 1
+        lut[lut == 254] = 255
+    return lut.astype(np.uint8)
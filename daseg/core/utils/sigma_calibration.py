@@ -0,0 +1,94 @@
+import torch
+import torch.distributed as dist
+
+
+def calibrate_gaussian_sigmas(dis_list,
+                              mean_sims,
+                              num_bins=65536,
+                              max_sigma=1000.,
+                              tol=1e-6,
+                              chunk_size=2**24,
+                              all_reduce=False):
+    """Find the sigmas for which ``exp(-dis / sigma**2)`` has the requested
+    means.
+
+    The squared distances are first compressed, chunk by chunk, into a
+    histogram with ``num_bins`` log-spaced bins that keeps the count and the
+    sum of the distances of every bin; zero distances get a bin of their own.
+    Evaluating the mean similarity at the bin means then costs
+    ``O(num_bins)`` instead of a pass over all distances, and since the
+    similarity is smooth in the distance the error of this approximation is
+    second order in the relative bin width. All ``mean_sims`` are bisected
+    in parallel on ``[0, max_sigma]`` until the intervals are smaller than
+    ``tol``, like the scalar search it replaces.
+
+    Args:
+        dis_list (Tensor | list[Tensor]): Squared feature distances, of any
+            shape.
+        mean_sims (list[float]): Target mean similarities.
+        num_bins (int): Number of histogram bins. Default: 65536.
+        max_sigma (float): Upper end of the search interval. Default: 1000.
+        tol (float): Width of the final search intervals. Default: 1e-6.
+        chunk_size (int): Number of distances binned at once. Default: 2**24.
+        all_reduce (bool): Whether to calibrate on the distances of all
+            ranks, every rank passing its own. Default: False.
+
+    Returns:
+        list[float]: The lower end of the final interval of every target.
+    """
+    if torch.is_tensor(dis_list):
+        dis_list = [dis_list]
+    chunks = [
+        chunk for dis in dis_list
+        for chunk in dis.detach().reshape(-1).split(chunk_size)
+    ]
+    device = chunks[0].device if chunks else torch.device('cpu')
+    all_reduce = all_reduce and dist.is_available() and dist.is_initialized()
+    if all_reduce and dist.get_backend() == 'nccl':
+        # NCCL only reduces CUDA tensors, the distances may be on the CPU
+        device = torch.device('cuda', torch.cuda.current_device())
+    positive = [chunk[chunk > 0] for chunk in chunks]
+    log_range = torch.tensor([
+        min([chunk.min().log().item() for chunk in positive if chunk.numel()],
+            default=float('inf')),
+        -max([chunk.max().log().item() for chunk in positive if chunk.numel()],
+             default=float('-inf'))
+    ], dtype=torch.float64, device=device)
+    if all_reduce:
+        # the bins of all ranks must be the same
+        dist.all_reduce(log_range, op=dist.ReduceOp.MIN)
+    log_min, log_max = log_range[0].item(), -log_range[1].item()
+    if log_min > log_max:
+        # no positive distance at all
+        log_min, log_max = 0., 0.
+    log_max += 1e-6
+    scale = (num_bins - 1) / max(log_max - log_min, 1e-12)
+
+    counts = torch.zeros(num_bins + 1, dtype=torch.float64, device=device)
+    sums = torch.zeros(num_bins + 1, dtype=torch.float64, device=device)
+    for chunk in positive:
+        # bin 0 holds the zero distances
+        idx = ((chunk.log() - log_min) * scale).long().clamp(
+            0, num_bins - 1) + 1
+        counts += torch.bincount(
+            idx, minlength=num_bins + 1).double().to(device)
+        sums += torch.bincount(
+            idx, weights=chunk.double(), minlength=num_bins + 1).to(device)
+    counts[0] = sum(chunk.numel() for chunk in chunks) - counts[1:].sum()
+    if all_reduce:
+        dist.all_reduce(counts)
+        dist.all_reduce(sums)
+    valid = counts > 0
+    weights = counts[valid] / counts.sum()
+    centers = sums[valid] / counts[valid]
+
+    targets = torch.tensor(mean_sims, dtype=torch.float64, device=device)
+    left = torch.zeros_like(targets)
+    right = torch.full_like(targets, max_sigma)
+    while (right - left).max() > tol:
+        sigma = (left + right) / 2
+        sims = (weights * torch.exp(-centers / sigma.unsqueeze(1)**2)).sum(1)
+        lower = sims < targets
+        left = torch.where(lower, sigma, left)
+        right = torch.where(lower, right, sigma)
+    return left.tolist()
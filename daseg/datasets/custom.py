@@ -4,6 +4,7 @@
 
 import os
 import os.path as osp
+import warnings
 from collections import OrderedDict
 from functools import reduce
 
@@ -13,7 +14,8 @@ from mmcv.utils import print_log
 from prettytable import PrettyTable
 from torch.utils.data import Dataset
 
-from daseg.core import eval_metrics
+from daseg.core import (build_label_lut, confusion_matrix, eval_metrics,
+                        pre_eval_to_metrics)
 from daseg.utils import get_root_logger
 from .builder import DATASETS
 from .pipelines import Compose, LoadAnnotations
@@ -55,6 +57,10 @@ class EODataset(Dataset):
         self.CLASSES = self._dataset.CLASSES
         self.PALETTE = self._dataset.PALETTE
         self.custom_classes = False
+        # shared by the training pipeline and the gt loader for evaluation
+        self.label_lut = build_label_lut(self.label_map)
+        self.gt_label_lut = self.gt_seg_map_loader.get_label_lut(
+            self.label_lut if self.custom_classes else None)
 
         if test_mode:
             assert self.CLASSES is not None, \
@@ -78,6 +84,9 @@ class EODataset(Dataset):
     def pre_pipeline(self, results):
         """Prepare results dict for pipeline."""
         results['seg_fields'] = []
+        if self.custom_classes:
+            results['label_map'] = self.label_map
+            results['label_lut'] = self.label_lut
         return results
 
     def __getitem__(self, idx):
@@ -94,10 +103,11 @@ class EODataset(Dataset):
         else:
             return self.prepare_train_img(idx)
 
-    def prepare_train_img(self, idx):
+    def prepare_train_img(self, idx, rcs=None):
         """Get training data and annotations after pipeline.
         Args:
             idx (int): Index of data.
+            rcs (dict, optional): Rare class crop request for RandomCrop.
         Returns:
             dict: Training data and annotation after pipeline with new keys
                 introduced by pipeline.
@@ -106,6 +116,8 @@ class EODataset(Dataset):
         img_info = self.img_infos[idx]
         ann_info = self.get_ann_info(idx)
         results = dict(img_info=img_info, ann_info=ann_info)
+        if rcs is not None:
+            results['rcs'] = rcs
         self.pre_pipeline(results)
         return self.pipeline(results)
 
@@ -169,8 +181,8 @@ class EODataset(Dataset):
             indices (list[int] | int): the prediction related ground truth
                 indices.
         Returns:
-            list[torch.Tensor]: (area_intersect, area_union, area_prediction,
-                area_ground_truth).
+            list[torch.Tensor]: Per image confusion matrices of shape
+                (num_classes, num_classes).
         """
         # In order to compat with batch inference
         if not isinstance(indices, list):
@@ -181,9 +193,12 @@ class EODataset(Dataset):
         pre_eval_results = []
 
         for pred, index in zip(preds, indices):
-            seg_map = self.get_gt_seg_map_by_idx(index)
+            results = dict(ann_info=self.get_ann_info(index))
+            self.pre_pipeline(results)
+            # remapped with the table shared with the pipeline below
+            seg_map = self.gt_seg_map_loader.load(results)
             pre_eval_results.append(
-                intersect_and_union(
+                confusion_matrix(
                     pred,
                     seg_map,
                     len(self.CLASSES),
@@ -194,6 +209,7 @@ class EODataset(Dataset):
                     # https://github.com/open-mmlab/mmsegmentation/issues/1415
                     # for more ditails
                     label_map=dict(),
+                    label_lut=self.gt_label_lut,
                     # reduce_zero_label=self.reduce_zero_label))
                     reduce_zero_label=False))
 
@@ -850,9 +866,13 @@ class CustomDataset(Dataset):
         self.label_map = None
         self.CLASSES, self.PALETTE = self.get_classes_and_palette(
             classes, palette)
+        # shared by the training pipeline and the gt loader for evaluation
+        self.label_lut = build_label_lut(self.label_map)
         self.gt_seg_map_loader = LoadAnnotations(
         ) if gt_seg_map_loader_cfg is None else LoadAnnotations(
             **gt_seg_map_loader_cfg)
+        self.gt_label_lut = self.gt_seg_map_loader.get_label_lut(
+            self.label_lut if self.custom_classes else None)
 
         self.file_client_args = file_client_args
         self.file_client = mmcv.FileClient.infer_client(self.file_client_args)
@@ -942,6 +962,7 @@ class CustomDataset(Dataset):
         results['seg_prefix'] = self.ann_dir
         if self.custom_classes:
             results['label_map'] = self.label_map
+            results['label_lut'] = self.label_lut
 
     def __getitem__(self, idx):
         """Get training/test data after pipeline.
@@ -959,11 +980,12 @@ class CustomDataset(Dataset):
         else:
             return self.prepare_train_img(idx)
 
-    def prepare_train_img(self, idx):
+    def prepare_train_img(self, idx, rcs=None):
         """Get training data and annotations after pipeline.
 
         Args:
             idx (int): Index of data.
+            rcs (dict, optional): Rare class crop request for RandomCrop.
 
         Returns:
             dict: Training data and annotation after pipeline with new keys
@@ -973,6 +995,8 @@ class CustomDataset(Dataset):
         img_info = self.img_infos[idx]
         ann_info = self.get_ann_info(idx)
         results = dict(img_info=img_info, ann_info=ann_info)
+        if rcs is not None:
+            results['rcs'] = rcs
         self.pre_pipeline(results)
         return self.pipeline(results)
 
@@ -1038,8 +1062,8 @@ class CustomDataset(Dataset):
                 indices.
 
         Returns:
-            list[torch.Tensor]: (area_intersect, area_union, area_prediction,
-                area_ground_truth).
+            list[torch.Tensor]: Per image confusion matrices of shape
+                (num_classes, num_classes).
         """
         # In order to compat with batch inference
         if not isinstance(indices, list):
@@ -1050,9 +1074,12 @@ class CustomDataset(Dataset):
         pre_eval_results = []
 
         for pred, index in zip(preds, indices):
-            seg_map = self.get_gt_seg_map_by_idx(index)
+            results = dict(ann_info=self.get_ann_info(index))
+            self.pre_pipeline(results)
+            # remapped with the table shared with the pipeline below
+            seg_map = self.gt_seg_map_loader.load(results)
             pre_eval_results.append(
-                intersect_and_union(
+                confusion_matrix(
                     pred,
                     seg_map,
                     len(self.CLASSES),
@@ -1063,6 +1090,7 @@ class CustomDataset(Dataset):
                     # https://github.com/open-mmlab/mmsegmentation/issues/1415
                     # for more ditails
                     label_map=dict(),
+                    label_lut=self.gt_label_lut,
                     reduce_zero_label=False))
                     # reduce_zero_label=self.reduce_zero_label))
 
@@ -1,11 +1,12 @@
 # Obtained from: https://github.com/open-mmlab/dasegmentation/tree/v0.16.0
 
 from .compose import Compose
+from .deterministic_aug import DeterministicAug
 from .formating import (Collect, ImageToTensor, ToDataContainer, ToTensor,
                         Transpose, to_tensor)
 from .loading import LoadAnnotations, LoadImageFromFile, LoadAnnotationsPseudoLabelsV2
 from .test_time_aug import MultiScaleFlipAug
-from .transforms import (CLAHE, AdjustGamma, Normalize, Pad,
+from .transforms import (CLAHE, AddPixelIndex, AdjustGamma, Normalize, Pad,
                          PhotoMetricDistortion, RandomCrop, RandomFlip,
                          RandomRotate, Rerange, Resize, RGB2Gray, SegRescale,
                          ClipNormalize)
@@ -17,5 +18,6 @@ __all__ = [
     'MultiScaleFlipAug', 'Resize', 'RandomFlip', 'Pad', 'RandomCrop',
     'Normalize', 'SegRescale', 'PhotoMetricDistortion', 'RandomRotate',
     'AdjustGamma', 'CLAHE', 'Rerange', 'RGB2Gray', 'RandomRotate90',
-    'LoadAnnotationsPseudoLabelsV2', 'ClipNormalize'
+    'LoadAnnotationsPseudoLabelsV2', 'ClipNormalize', 'AddPixelIndex',
+    'DeterministicAug'
 ]
@@ -0,0 +1,83 @@
+import zlib
+
+import numpy as np
+
+from ..builder import PIPELINES
+from .compose import Compose
+
+
+@PIPELINES.register_module()
+class DeterministicAug(object):
+    """Apply random transforms with one of a few fixed random states per
+    image.
+
+    Every call draws one of ``num_variants`` variants and runs
+    ``transforms`` with the numpy random state seeded by the image name, the
+    variant and ``seed``, so that an image only ever takes ``num_variants``
+    different crops, flips, rotations, scales and color distortions. The
+    variant is recorded as ``aug_key``, which identifies the output of the
+    transforms, e.g. to cache the features of the crop. The global random
+    state is restored afterwards, so the transforms after this one stay
+    random. With rare class sampling, the sampled class is part of the
+    seed and of ``aug_key``, since it changes the crop.
+
+    An example configuration of a source pipeline is as followed:
+
+    .. code-block::
+
+        dict(
+            type='DeterministicAug',
+            num_variants=4,
+            transforms=[
+                dict(type='Resize', img_scale=(512, 512),
+                     ratio_range=(0.5, 2.0)),
+                dict(type='RandomCrop', crop_size=crop_size),
+                dict(type='RandomFlip', flip_ratio=0.5),
+                dict(type='PhotoMetricDistortion'),
+            ]),
+        ...
+        dict(type='Collect', keys=['img', 'gt_semantic_seg'],
+             meta_keys=(..., 'aug_key')),
+
+    The transforms must only draw from the numpy random state, which is the
+    case for the transforms of this package.
+
+    Args:
+        transforms (list[dict]): Transforms to apply.
+        num_variants (int): Number of variants per image. Default: 1.
+        seed (int): Seed shared by all images. Default: 0.
+    """
+
+    def __init__(self, transforms, num_variants=1, seed=0):
+        assert num_variants >= 1
+        self.transforms = Compose(transforms)
+        self.num_variants = num_variants
+        self.seed = seed
+
+    def __call__(self, results):
+        """Call function to apply the transforms with a fixed random state.
+
+        Args:
+            results (dict): Result dict contains the data to transform.
+
+        Returns:
+            dict: Transformed results with the ``aug_key`` key.
+        """
+        variant = np.random.randint(self.num_variants)
+        aug_key = f'{results["ori_filename"]}#{variant}'
+        if 'rcs' in results:
+            aug_key += f'@rcs{results["rcs"]["cls"]}'
+        state = np.random.get_state()
+        np.random.seed(zlib.crc32(f'{aug_key}:{self.seed}'.encode()))
+        try:
+            results = self.transforms(results)
+        finally:
+            np.random.set_state(state)
+        results['aug_key'] = aug_key
+        return results
+
+    def __repr__(self):
+        repr_str = self.__class__.__name__
+        repr_str += f'(transforms={self.transforms}, '
+        repr_str += f'num_variants={self.num_variants}, seed={self.seed})'
+        return repr_str
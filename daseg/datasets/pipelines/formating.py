@@ -186,6 +186,8 @@ class DefaultFormatBundle(object):
     - img: (1)transpose, (2)to tensor, (3)to DataContainer (stack=True)
     - gt_semantic_seg: (1)unsqueeze dim-0 (2)to tensor,
                        (3)to DataContainer (stack=True)
+    - pixel_index: (1)unsqueeze dim-0 (2)to tensor,
+                   (3)to DataContainer (stack=True)
     """
 
     def __call__(self, results):
@@ -211,6 +213,9 @@ class DefaultFormatBundle(object):
                 to_tensor(results['gt_semantic_seg'][None,
                                                      ...].astype(np.int64)),
                 stack=True)
+        if 'pixel_index' in results:
+            results['pixel_index'] = DC(
+                to_tensor(results['pixel_index'][None, ...]), stack=True)
         return results
 
     def __repr__(self):
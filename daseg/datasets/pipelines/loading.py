@@ -2,13 +2,28 @@
 
 import os.path as osp
 
+import h5py
 import mmcv
 import numpy as np
 import pdb
 
+from daseg.core import build_label_lut
+from daseg.utils import (OnlinePseudoLabelStore, PseudoLabelStore,
+                         get_packed_reader, get_shared_cache)
 from ..builder import PIPELINES
 
 
+def check_packed_meta(packed, **settings):
+    """Check that the arrays of ``packed`` were decoded with the decode
+    ``settings`` of a loader, as recorded in their ``meta.json``."""
+    for name, value in settings.items():
+        packed_value = packed.meta.get(name)
+        if packed_value is not None and packed_value != value:
+            raise ValueError(
+                f'{packed.packed_dir} was packed with {name}={packed_value}'
+                f', but the loader uses {name}={value}')
+
+
 @PIPELINES.register_module()
 class LoadImageFromFile(object):
     """Load an image from file.
@@ -29,18 +44,54 @@ class LoadImageFromFile(object):
             Defaults to ``dict(backend='disk')``.
         imdecode_backend (str): Backend for :func:`mmcv.imdecode`. Default:
             'cv2'
+        cache_cfg (dict, optional): Config of the
+            :class:`daseg.utils.SharedArrayCache` of decoded images, e.g.
+            ``dict(name='gta', max_bytes=16 * 1024**3)``. Default: None.
+        packed_dir (str, optional): Directory of shards written by
+            ``tools/pack_dataset.py``. Images found there are returned as
+            zero-copy views of the shards instead of being decoded, others
+            are decoded from file. It must have been packed with the same
+            ``color_type`` and ``imdecode_backend``. Default: None.
     """
 
     def __init__(self,
                  to_float32=False,
                  color_type='color',
                  file_client_args=dict(backend='disk'),
-                 imdecode_backend='cv2'):
+                 imdecode_backend='cv2',
+                 cache_cfg=None,
+                 packed_dir=None):
         self.to_float32 = to_float32
         self.color_type = color_type
         self.file_client_args = file_client_args.copy()
         self.file_client = None
         self.imdecode_backend = imdecode_backend
+        self.cache = get_shared_cache(
+            **cache_cfg) if cache_cfg is not None else None
+        self.packed_dir = packed_dir
+        self.packed = get_packed_reader(
+            packed_dir) if packed_dir is not None else None
+        if self.packed is not None:
+            check_packed_meta(
+                self.packed,
+                color_type=color_type,
+                img_decode_backend=imdecode_backend)
+
+    @staticmethod
+    def get_filename(results):
+        """Get the path of the image of ``results``."""
+        if results.get('img_prefix') is not None:
+            return osp.join(results['img_prefix'],
+                            results['img_info']['filename'])
+        return results['img_info']['filename']
+
+    def decode(self, filename):
+        """Read and decode the image ``filename``."""
+        if self.file_client is None:
+            self.file_client = mmcv.FileClient(**self.file_client_args)
+        img_bytes = self.file_client.get(filename)
+        return mmcv.imfrombytes(
+            img_bytes, flag=self.color_type, backend=self.imdecode_backend)
 
     def __call__(self, results):
         """Call functions to load image and get image meta information.
@@ -51,18 +102,19 @@ class LoadImageFromFile(object):
         Returns:
             dict: The dict contains loaded image and meta information.
         """
-
-        if self.file_client is None:
-            self.file_client = mmcv.FileClient(**self.file_client_args)
-
-        if results.get('img_prefix') is not None:
-            filename = osp.join(results['img_prefix'],
-                                results['img_info']['filename'])
-        else:
-            filename = results['img_info']['filename']
-        img_bytes = self.file_client.get(filename)
-        img = mmcv.imfrombytes(
-            img_bytes, flag=self.color_type, backend=self.imdecode_backend)
+        filename = self.get_filename(results)
+        img = None
+        if self.packed is not None:
+            img = self.packed.get(f'img:{filename}')
+        if img is None and self.cache is not None:
+            cache_key = f'img:{self.color_type}:{self.imdecode_backend}:' \
+                f'{filename}'
+            img = self.cache.get(cache_key)
+            if img is None:
+                img = self.decode(filename)
+                self.cache.put(cache_key, img)
+        if img is None:
+            img = self.decode(filename)
         if self.to_float32:
             img = img.astype(np.float32)
 
@@ -102,16 +154,82 @@ class LoadAnnotations(object):
             Defaults to ``dict(backend='disk')``.
         imdecode_backend (str): Backend for :func:`mmcv.imdecode`. Default:
             'pillow'
+        cache_cfg (dict, optional): Config of the
+            :class:`daseg.utils.SharedArrayCache` of decoded label maps. It
+            may share its name with the image cache. Default: None.
+        packed_dir (str, optional): Directory of shards written by
+            ``tools/pack_dataset.py``. It holds the label maps before the
+            label remapping, which is applied on load. Default: None.
     """
 
     def __init__(self,
                  reduce_zero_label=False,
                  file_client_args=dict(backend='disk'),
-                 imdecode_backend='pillow'):
+                 imdecode_backend='pillow',
+                 cache_cfg=None,
+                 packed_dir=None):
         self.reduce_zero_label = reduce_zero_label
+        self.reduce_zero_label_lut = build_label_lut(
+            reduce_zero_label=True) if reduce_zero_label else None
         self.file_client_args = file_client_args.copy()
         self.file_client = None
         self.imdecode_backend = imdecode_backend
+        self.cache = get_shared_cache(
+            **cache_cfg) if cache_cfg is not None else None
+        self.packed_dir = packed_dir
+        self.packed = get_packed_reader(
+            packed_dir) if packed_dir is not None else None
+        if self.packed is not None:
+            check_packed_meta(
+                self.packed, ann_decode_backend=imdecode_backend)
+
+    @staticmethod
+    def get_filename(results):
+        """Get the path of the label map of ``results``."""
+        if results.get('seg_prefix', None) is not None:
+            return osp.join(results['seg_prefix'],
+                            results['ann_info']['seg_map'])
+        return results['ann_info']['seg_map']
+
+    def decode(self, filename):
+        """Read and decode the label map ``filename``, without any label
+        remapping."""
+        if self.file_client is None:
+            self.file_client = mmcv.FileClient(**self.file_client_args)
+        img_bytes = self.file_client.get(filename)
+        return mmcv.imfrombytes(
+            img_bytes, flag='unchanged',
+            backend=self.imdecode_backend).squeeze().astype(np.uint8)
+
+    def load(self, results):
+        """Load the label map of ``results`` from the packed shards, the
+        cache or the file, without any label remapping."""
+        filename = self.get_filename(results)
+        gt_semantic_seg = None
+        if self.packed is not None:
+            gt_semantic_seg = self.packed.get(f'ann:{filename}')
+        if gt_semantic_seg is None and self.cache is not None:
+            cache_key = f'ann:{self.imdecode_backend}:{filename}'
+            gt_semantic_seg = self.cache.get(cache_key)
+            if gt_semantic_seg is None:
+                gt_semantic_seg = self.decode(filename)
+                self.cache.put(cache_key, gt_semantic_seg)
+        if gt_semantic_seg is None:
+            gt_semantic_seg = self.decode(filename)
+        return gt_semantic_seg
+
+    def get_label_lut(self, label_lut=None):
+        """Fold ``reduce_zero_label`` into the label map table
+        ``label_lut`` of the dataset.
+
+        Returns:
+            ndarray | None: The table applied to the loaded label maps, or
+                None if they are not remapped.
+        """
+        if self.reduce_zero_label:
+            label_lut = self.reduce_zero_label_lut if label_lut is None \
+                else self.reduce_zero_label_lut[label_lut]
+        return label_lut
 
     def __call__(self, results):
         """Call function to load multiple types annotations.
@@ -122,28 +240,14 @@ class LoadAnnotations(object):
         Returns:
             dict: The dict contains loaded semantic segmentation annotations.
         """
-        if self.file_client is None:
-            self.file_client = mmcv.FileClient(**self.file_client_args)
-
-        if results.get('seg_prefix', None) is not None:
-            filename = osp.join(results['seg_prefix'],
-                                results['ann_info']['seg_map'])
-        else:
-            filename = results['ann_info']['seg_map']
-        img_bytes = self.file_client.get(filename)
-        gt_semantic_seg = mmcv.imfrombytes(
-            img_bytes, flag='unchanged',
-            backend=self.imdecode_backend).squeeze().astype(np.uint8)
-        # modify if custom classes
-        if results.get('label_map', None) is not None:
-            for old_id, new_id in results['label_map'].items():
-                gt_semantic_seg[gt_semantic_seg == old_id] = new_id
-        # reduce zero_label
-        if self.reduce_zero_label:
-            # avoid using underflow conversion
-            gt_semantic_seg[gt_semantic_seg == 0] = 255
-            gt_semantic_seg = gt_semantic_seg - 1
-            gt_semantic_seg[gt_semantic_seg == 254] = 255
+        gt_semantic_seg = self.load(results)
+        # modify if custom classes and reduce zero_label in a single lookup
+        label_lut = results.get('label_lut', None)
+        if label_lut is None and results.get('label_map', None) is not None:
+            label_lut = build_label_lut(results['label_map'])
+        label_lut = self.get_label_lut(label_lut)
+        if label_lut is not None:
+            gt_semantic_seg = np.take(label_lut, gt_semantic_seg)
         results['gt_semantic_seg'] = gt_semantic_seg
         results['seg_fields'].append('gt_semantic_seg')
         return results
@@ -167,6 +271,14 @@ class LoadAnnotationsPseudoLabelsV2(object):
             Defaults to ``dict(backend='disk')``.
         imdecode_backend (str): Backend for :func:`mmcv.imdecode`. Default:
             'pillow'
+        pseudo_labels_dir (str, optional): Directory of the pseudo labels,
+            either a :class:`daseg.utils.PseudoLabelStore` or one ``.h5``
+            file per image. Default: None.
+        updated_pseudo_labels_dir (str, optional): Directory of pseudo labels
+            taking precedence over the ones of ``pseudo_labels_dir`` for the
+            images they contain, e.g. a
+            :class:`daseg.utils.OnlinePseudoLabelStore` refreshed during
+            training. Default: None.
     """
 
     def __init__(self,
@@ -189,6 +301,89 @@ class LoadAnnotationsPseudoLabelsV2(object):
         self.sim_feat_names = sim_feat_names
         self.updated_pseudo_labels_dir = updated_pseudo_labels_dir
         self.filename_mapper_type = filename_mapper_type
+        # the stores open their file lazily once per worker
+        self.store = self._get_store(pseudo_labels_dir)
+        self.updated_store = self._get_store(updated_pseudo_labels_dir)
+        if load_feats and isinstance(self.store, OnlinePseudoLabelStore):
+            raise ValueError(
+                f'{pseudo_labels_dir} is an OnlinePseudoLabelStore, which '
+                'has no features to load')
+        for store in [self.store, self.updated_store]:
+            if isinstance(store, OnlinePseudoLabelStore) and \
+                    float(pseudo_ratio) not in store.ratio_to_row:
+                raise ValueError(
+                    f'{store.path} has no thresholds for pseudo_ratio='
+                    f'{pseudo_ratio}, only for {store.meta["ratios"]}')
+
+    @staticmethod
+    def _get_store(pseudo_labels_dir):
+        if pseudo_labels_dir is None:
+            return None
+        if OnlinePseudoLabelStore.exists(pseudo_labels_dir):
+            return OnlinePseudoLabelStore(pseudo_labels_dir)
+        if PseudoLabelStore.exists(pseudo_labels_dir):
+            return PseudoLabelStore(pseudo_labels_dir)
+        return None
+
+    @staticmethod
+    def _get_pred_entropy(logits):
+        preds = logits.argmax(axis=0)
+        probs = np.exp(logits) / np.exp(logits).sum(axis=0)
+        ent_map = - (probs * np.log(probs + 1e-8)).sum(axis=0)
+        return preds, ent_map
+
+    def _load_labels(self, store, filename):
+        """Get the argmax, entropy and threshold maps of ``filename`` from
+        ``store``."""
+        if store.has('pred') and store.has('entropy'):
+            # precomputed by the pseudo labeling hook
+            preds = store.get(filename, 'pred')
+            ent_map = store.get(filename, 'entropy')
+        else:
+            preds, ent_map = self._get_pred_entropy(
+                store.get(filename, 'seg_logits'))
+        thres = store.get_global(f'thre@{self.pseudo_ratio}')
+        return preds, ent_map, thres
+
+    def _is_updated(self, filename):
+        return self.updated_store is not None and \
+            filename in self.updated_store
+
+    def _load_from_store(self, filename):
+        store = self.updated_store if self._is_updated(
+            filename) else self.store
+        preds, ent_map, thres = self._load_labels(store, filename)
+        feats = {}
+        if self.load_feats:
+            # an online store of updated pseudo labels has no features
+            for name in self.sim_feat_names:
+                feats[name] = self.store.get(filename, name)
+        return preds, ent_map, thres, feats
+
+    def _load_from_file(self, filename):
+        file_path = osp.join(self.pseudo_labels_dir, filename + '.h5')
+        if self.updated_pseudo_labels_dir is not None and \
+                self.updated_store is None:
+            updated_file_path = osp.join(self.updated_pseudo_labels_dir, filename + '.h5')
+            if osp.exists(updated_file_path):
+                file_path = updated_file_path
+
+        updated = self._is_updated(filename)
+        if updated:
+            preds, ent_map, thres = self._load_labels(self.updated_store,
+                                                      filename)
+            if not self.load_feats:
+                return preds, ent_map, thres, {}
+        with h5py.File(file_path, 'r') as f:
+            if not updated:
+                preds, ent_map = self._get_pred_entropy(
+                    np.array(f['seg_logits']))
+                thres = np.array(f[f'thre@{self.pseudo_ratio}'])
+            feats = {}
+            if self.load_feats:
+                for name in self.sim_feat_names:
+                    feats[name] = np.array(f[name])
+        return preds, ent_map, thres, feats
 
 
     def filename_mapper(self, filename):
@@ -231,54 +426,25 @@ class LoadAnnotationsPseudoLabelsV2(object):
 
             return results
 
-        file_path = osp.join(self.pseudo_labels_dir, filename + '.h5')
-        if self.updated_pseudo_labels_dir is not None:
-            updated_file_path = osp.join(self.updated_pseudo_labels_dir, filename + '.h5')
-            if osp.exists(updated_file_path):
-                file_path = updated_file_path
-
-
-        with h5py.File(file_path, 'r') as f:
-            logits = np.array(f['seg_logits'])
-            thres = np.array(f[f'thre@{self.pseudo_ratio}'])
-
-
-            preds = logits.argmax(axis=0)
-            probs = np.exp(logits) / np.exp(logits).sum(axis=0)
-            ent_map = - (probs * np.log(probs + 1e-8)).sum(axis=0)
-            thre_map = thres[preds]
-            mask = ent_map < thre_map
-
-            pse_labels = np.where(mask, preds, 255)
-
-            if self.reduce_zero_label:
-                # avoid using underflow conversion
-                pse_labels[pse_labels == 0] = 255
-                pse_labels = pse_labels - 1
-                pse_labels[pse_labels == 254] = 255
-
-            results['gt_semantic_seg'] = pse_labels.astype(np.uint8)
-            results['seg_fields'].append('gt_semantic_seg')
-
-            if self.load_feats:
-                gaussian_feats = []
-                cosine_feats = []
-
-                for name in self.sim_feat_names:
-                    results[name] = np.array(f[name])
-                    # results[name] = np.zeros((9, 128, 128))
+        if self.store is not None:
+            preds, ent_map, thres, feats = self._load_from_store(filename)
+        else:
+            preds, ent_map, thres, feats = self._load_from_file(filename)
 
-                # for level in range(4):
-                #     gaussian_feat = np.array(f[f'gaussian_sim_feat_{level}'])
-                #     # gaussian_feats.append(gaussian_feat)
+        thre_map = thres[preds]
+        mask = ent_map < thre_map
 
-                #     cosine_feat = np.array(f[f'cosine_sim_feat_{level}'])
-                #     # cosine_feats.append(cosine_feat)
+        pse_labels = np.where(mask, preds, 255)
 
-                #     results[f'gaussian_sim_feat_{level}'] = gaussian_feat
-                #     results[f'cosine_sim_feat_{level}'] = cosine_feat
+        if self.reduce_zero_label:
+            # avoid using underflow conversion
+            pse_labels[pse_labels == 0] = 255
+            pse_labels = pse_labels - 1
+            pse_labels[pse_labels == 254] = 255
 
-            f.close()
+        results['gt_semantic_seg'] = pse_labels.astype(np.uint8)
+        results['seg_fields'].append('gt_semantic_seg')
+        results.update(feats)
 
         # t2 = time.time()
         # print('loading time: {}'.format(t2-t1))
@@ -5,6 +5,7 @@ import numpy as np
 from mmcv.utils import deprecated_api_warning, is_tuple_of
 from numpy import random
 
+from daseg.utils import PIXEL_INDEX_OFFSET
 from ..builder import PIPELINES
 
 
@@ -502,6 +503,12 @@ class CLAHE(object):
 class RandomCrop(object):
     """Random crop the image & seg.
 
+    If ``results['rcs']`` is set by rare class sampling, the crop is drawn
+    uniformly from the windows containing more than ``rcs['min_pixels']``
+    pixels of class ``rcs['cls']``, which are found with a summed-area table
+    of the label map. The fraction of such windows among all windows is
+    written back to ``rcs['valid_crop_ratio']``.
+
     Args:
         crop_size (tuple): Expected size after cropping, (h, w).
         cat_max_ratio (float): The maximum ratio that single category could
@@ -514,12 +521,42 @@ class RandomCrop(object):
         self.cat_max_ratio = cat_max_ratio
         self.ignore_index = ignore_index
 
-    def get_crop_bbox(self, img):
-        """Randomly get a crop bounding box."""
+    def get_rcs_crop_offsets(self, results):
+        """Get the flattened crop offsets which contain enough pixels of the
+        rare class requested in ``results['rcs']``."""
+        rcs = results['rcs']
+        seg = results['gt_semantic_seg']
+        h, w = seg.shape[:2]
+        crop_h, crop_w = min(self.crop_size[0], h), min(self.crop_size[1], w)
+        sat = np.zeros((h + 1, w + 1), dtype=np.int32)
+        np.cumsum(
+            np.cumsum(seg == rcs['cls'], axis=0, dtype=np.int32),
+            axis=1,
+            out=sat[1:, 1:])
+        counts = sat[crop_h:, crop_w:] - sat[:h - crop_h + 1, crop_w:] \
+            - sat[crop_h:, :w - crop_w + 1] + sat[:h - crop_h + 1,
+                                                  :w - crop_w + 1]
+        valid = counts > rcs['min_pixels']
+        rcs['valid_crop_ratio'] = valid.mean()
+        if valid.any():
+            return np.flatnonzero(valid)
+        # fall back to the window with the most rare class pixels
+        return np.array([counts.argmax()])
+
+    def get_crop_bbox(self, img, offsets=None):
+        """Randomly get a crop bounding box.
+
+        If ``offsets`` is given, the top-left corner is drawn from these
+        flattened offsets instead of the whole image.
+        """
         margin_h = max(img.shape[0] - self.crop_size[0], 0)
         margin_w = max(img.shape[1] - self.crop_size[1], 0)
-        offset_h = np.random.randint(0, margin_h + 1)
-        offset_w = np.random.randint(0, margin_w + 1)
+        if offsets is not None:
+            offset_h, offset_w = divmod(
+                int(np.random.choice(offsets)), margin_w + 1)
+        else:
+            offset_h = np.random.randint(0, margin_h + 1)
+            offset_w = np.random.randint(0, margin_w + 1)
         crop_y1, crop_y2 = offset_h, offset_h + self.crop_size[0]
         crop_x1, crop_x2 = offset_w, offset_w + self.crop_size[1]
 
@@ -543,7 +580,9 @@ class RandomCrop(object):
         """
 
         img = results['img']
-        crop_bbox = self.get_crop_bbox(img)
+        offsets = self.get_rcs_crop_offsets(results) \
+            if 'rcs' in results else None
+        crop_bbox = self.get_crop_bbox(img, offsets)
         if self.cat_max_ratio < 1.:
             # Repeat 10 times
             for _ in range(10):
@@ -553,7 +592,7 @@ class RandomCrop(object):
                 if len(cnt) > 1 and np.max(cnt) / np.sum(
                         cnt) < self.cat_max_ratio:
                     break
-                crop_bbox = self.get_crop_bbox(img)
+                crop_bbox = self.get_crop_bbox(img, offsets)
 
         # crop the image
         img = self.crop(img, crop_bbox)
@@ -775,6 +814,42 @@ class SegRescale(object):
         return self.__class__.__name__ + f'(scale_factor={self.scale_factor})'
 
 
+@PIPELINES.register_module()
+class AddPixelIndex(object):
+    """Add the map of the flat pixel indices of the loaded image.
+
+    The map ``pixel_index`` is added to the segmentation fields, so that the
+    following geometric transforms resize, crop, rotate, flip and pad it like
+    the segmentation maps. Every pixel of the final crop then holds the index
+    of the pixel of the loaded image it was taken from, which is how the
+    pseudo labels predicted on the crop are written back to the image. The
+    indices are stored as float32, exact up to 2**24 pixels, and offset by
+    ``PIXEL_INDEX_OFFSET`` so that any padding value below it marks padded
+    pixels.
+    """
+
+    def __call__(self, results):
+        """Call function to add the pixel index map.
+
+        Args:
+            results (dict): Result dict from loading pipeline.
+
+        Returns:
+            dict: Result dict with the ``pixel_index`` map.
+        """
+        h, w = results['img_shape'][:2]
+        assert h * w + PIXEL_INDEX_OFFSET <= 2**24
+        results['pixel_index'] = np.arange(
+            PIXEL_INDEX_OFFSET,
+            h * w + PIXEL_INDEX_OFFSET,
+            dtype=np.float32).reshape(h, w)
+        results['seg_fields'].append('pixel_index')
+        return results
+
+    def __repr__(self):
+        return self.__class__.__name__
+
+
 @PIPELINES.register_module()
 class PhotoMetricDistortion(object):
     """Apply photometric distortion to image sequentially, every transformation
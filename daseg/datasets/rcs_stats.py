@@ -0,0 +1,275 @@
+import json
+import os
+import os.path as osp
+import shutil
+from functools import partial
+from multiprocessing import Pool
+
+import mmcv
+import numpy as np
+
+
+def save_class_stats(out_dir, sample_class_stats):
+    """Write the rare class sampling statistics consumed by UDADataset.
+
+    Args:
+        out_dir (str): Directory of the json files.
+        sample_class_stats (list[dict]): Per sample dict mapping class ids to
+            pixel counts, with the annotation file name under ``'file'``.
+    """
+    with open(osp.join(out_dir, 'sample_class_stats.json'), 'w') as of:
+        json.dump(sample_class_stats, of, indent=2)
+
+    sample_class_stats_dict = {}
+    for stats in sample_class_stats:
+        stats = dict(stats)
+        f = stats.pop('file')
+        sample_class_stats_dict[f] = stats
+    with open(osp.join(out_dir, 'sample_class_stats_dict.json'), 'w') as of:
+        json.dump(sample_class_stats_dict, of, indent=2)
+
+    samples_with_class = {}
+    for file, stats in sample_class_stats_dict.items():
+        for c, n in stats.items():
+            if c not in samples_with_class:
+                samples_with_class[c] = [(file, n)]
+            else:
+                samples_with_class[c].append((file, n))
+    with open(osp.join(out_dir, 'samples_with_class.json'), 'w') as of:
+        json.dump(samples_with_class, of, indent=2)
+
+
+class RCSIndex(object):
+    """Memory-mapped index of the rare class sampling statistics.
+
+    For every class ``c``, the entries ``class_ptr[c]:class_ptr[c + 1]`` of
+    ``sample_idx`` (int32) and ``pixels`` (int64) hold the dataset indices of
+    the samples containing ``c`` and their number of ``c`` pixels, sorted by
+    ascending pixel count. ``class_pixels`` (int64) holds the total number of
+    pixels per class. The arrays are opened with ``mmap_mode='r'`` so that
+    they are shared between dataloader workers instead of being copied.
+
+    Args:
+        index_dir (str): Directory written by :func:`save_rcs_index`.
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.meta = mmcv.load(osp.join(index_dir, 'meta.json'))
+        for name in ('class_ptr', 'sample_idx', 'pixels', 'class_pixels'):
+            setattr(self, name,
+                    np.load(osp.join(index_dir, f'{name}.npy'), mmap_mode='r'))
+
+    @property
+    def num_samples(self):
+        return self.meta['num_samples']
+
+    def get_sample_range(self, class_id, min_pixels=0):
+        """Get the index range of the samples with more than ``min_pixels``
+        pixels of class ``class_id``."""
+        start, end = int(self.class_ptr[class_id]), int(
+            self.class_ptr[class_id + 1])
+        start += int(
+            np.searchsorted(
+                self.pixels[start:end], min_pixels, side='right'))
+        return start, end
+
+
+def save_rcs_index(out_dir,
+                   sample_class_stats,
+                   num_classes,
+                   sample_indices=None,
+                   num_samples=None):
+    """Write the :class:`RCSIndex` of rare class sampling statistics.
+
+    Args:
+        out_dir (str): Directory of the index, usually ``rcs_index`` in the
+            data root.
+        sample_class_stats (list[dict]): Per sample class statistics as
+            written to ``sample_class_stats.json``.
+        num_classes (int): Number of classes.
+        sample_indices (list[int], optional): Dataset index of every entry of
+            ``sample_class_stats``. Defaults to their position in the list.
+        num_samples (int, optional): Number of samples of the dataset.
+            Defaults to ``len(sample_class_stats)``.
+    """
+    classes, samples, pixels = [], [], []
+    for i, stats in enumerate(sample_class_stats):
+        idx = i if sample_indices is None else sample_indices[i]
+        for c, n in stats.items():
+            if c == 'file':
+                continue
+            classes.append(int(c))
+            samples.append(idx)
+            pixels.append(n)
+    classes = np.array(classes, dtype=np.int64)
+    samples = np.array(samples, dtype=np.int32)
+    pixels = np.array(pixels, dtype=np.int64)
+    order = np.lexsort((pixels, classes))
+
+    class_ptr = np.zeros(num_classes + 1, dtype=np.int64)
+    class_ptr[1:] = np.cumsum(np.bincount(classes, minlength=num_classes))
+    class_pixels = np.bincount(
+        classes, weights=pixels, minlength=num_classes).astype(np.int64)
+
+    mmcv.mkdir_or_exist(out_dir)
+    np.save(osp.join(out_dir, 'class_ptr.npy'), class_ptr)
+    np.save(osp.join(out_dir, 'sample_idx.npy'), samples[order])
+    np.save(osp.join(out_dir, 'pixels.npy'), pixels[order])
+    np.save(osp.join(out_dir, 'class_pixels.npy'), class_pixels)
+    if num_samples is None:
+        num_samples = len(sample_class_stats)
+    mmcv.dump(
+        dict(num_samples=num_samples, num_classes=num_classes),
+        osp.join(out_dir, 'meta.json'))
+
+
+def rcs_index_from_json(data_root, dataset, out_dir=None):
+    """Convert an existing ``sample_class_stats.json`` to an
+    :class:`RCSIndex`.
+
+    Like ``UDADataset``, the stored files are matched to the samples of
+    ``dataset`` by the base name of their ``seg_map``.
+
+    Args:
+        data_root (str): Directory of ``sample_class_stats.json``.
+        dataset (CustomDataset): The source dataset the statistics belong
+            to.
+        out_dir (str, optional): Directory of the index. Defaults to
+            ``data_root/rcs_index``.
+    """
+    sample_class_stats = mmcv.load(
+        osp.join(data_root, 'sample_class_stats.json'))
+    file_to_idx = {}
+    for i, dic in enumerate(dataset.img_infos):
+        file_to_idx[dic['ann']['seg_map'].split('/')[-1]] = i
+    sample_indices = [
+        file_to_idx[s['file'].split('/')[-1]] for s in sample_class_stats
+    ]
+    out_dir = out_dir if out_dir else osp.join(data_root, 'rcs_index')
+    save_rcs_index(out_dir, sample_class_stats, len(dataset.CLASSES),
+                   sample_indices, len(dataset))
+
+
+def _get_ann_results(dataset, idx):
+    """Prepare the result dict to load the annotation of sample ``idx``."""
+    results = dict(ann_info=dataset.get_ann_info(idx))
+    dataset.pre_pipeline(results)
+    if results.get('seg_prefix', None) is not None:
+        file = osp.join(results['seg_prefix'], results['ann_info']['seg_map'])
+    else:
+        file = results['ann_info']['seg_map']
+    return file, results
+
+
+def _get_chunk_class_stats(chunk, gt_seg_map_loader, num_classes):
+    sample_class_stats = []
+    for file, results in chunk:
+        gt = gt_seg_map_loader(results)['gt_semantic_seg']
+        counts = np.bincount(gt.ravel(), minlength=num_classes)[:num_classes]
+        stats = {
+            int(c): int(counts[c])
+            for c in np.flatnonzero(counts)
+        }
+        stats['file'] = file
+        sample_class_stats.append(stats)
+    return sample_class_stats
+
+
+def _run_chunk(args):
+    worker, chunk_id, chunk = args
+    return chunk_id, worker(chunk)
+
+
+def build_rcs_stats(dataset,
+                    out_dir,
+                    num_classes,
+                    nproc=8,
+                    chunk_size=256,
+                    resume=True):
+    """Build the rare class sampling statistics of a dataset.
+
+    Only the annotation files are read, through the dataset's
+    ``gt_seg_map_loader`` so that ``label_map`` and ``reduce_zero_label``
+    are respected. The class histogram of each sample is computed with a
+    single ``np.bincount``. The samples are split into chunks of
+    ``chunk_size`` which are processed by ``nproc`` worker processes. Every
+    finished chunk is checkpointed to ``out_dir/rcs_stats_parts`` so that an
+    interrupted run resumes with the missing chunks only. Besides the json
+    files, an :class:`RCSIndex` is written to ``out_dir/rcs_index``.
+
+    Args:
+        dataset (CustomDataset | EODataset): Dataset with annotations.
+        out_dir (str): Directory to write the json files to.
+        num_classes (int): Number of classes to count. Labels outside
+            ``[0, num_classes)`` (e.g. the ignore index) are not counted.
+        nproc (int): Number of worker processes. Default: 8.
+        chunk_size (int): Number of samples per checkpointed chunk.
+            Default: 256.
+        resume (bool): Whether to reuse the chunks of a previous run.
+            Default: True.
+
+    Returns:
+        list[dict]: Per sample class statistics, in dataset order.
+    """
+    mmcv.mkdir_or_exist(out_dir)
+    part_dir = osp.join(out_dir, 'rcs_stats_parts')
+    meta = dict(
+        num_samples=len(dataset),
+        num_classes=num_classes,
+        chunk_size=chunk_size)
+    meta_file = osp.join(part_dir, 'meta.json')
+    if osp.exists(part_dir) and not (resume and osp.exists(meta_file)
+                                     and mmcv.load(meta_file) == meta):
+        shutil.rmtree(part_dir)
+    mmcv.mkdir_or_exist(part_dir)
+    mmcv.dump(meta, meta_file)
+
+    def part_file(chunk_id):
+        return osp.join(part_dir, f'{chunk_id:06d}.json')
+
+    num_chunks = (len(dataset) + chunk_size - 1) // chunk_size
+    todo = [i for i in range(num_chunks) if not osp.exists(part_file(i))]
+    mmcv.print_log(
+        f'RCS stats: {num_chunks - len(todo)}/{num_chunks} chunks already '
+        f'done, processing {len(todo)} chunks with {nproc} processes',
+        'daseg')
+
+    def get_chunk(chunk_id):
+        start = chunk_id * chunk_size
+        end = min(start + chunk_size, len(dataset))
+        return [_get_ann_results(dataset, i) for i in range(start, end)]
+
+    worker = partial(
+        _get_chunk_class_stats,
+        gt_seg_map_loader=dataset.gt_seg_map_loader,
+        num_classes=num_classes)
+
+    def save_part(chunk_id, stats):
+        # write to a temporary file first so that a crash never leaves a
+        # truncated part behind
+        tmp_file = part_file(chunk_id) + '.tmp'
+        mmcv.dump(stats, tmp_file, file_format='json')
+        os.replace(tmp_file, part_file(chunk_id))
+
+    prog_bar = mmcv.ProgressBar(len(todo))
+    if nproc > 1:
+        with Pool(nproc) as pool:
+            results = pool.imap_unordered(
+                _run_chunk, ((worker, i, get_chunk(i)) for i in todo))
+            for chunk_id, stats in results:
+                save_part(chunk_id, stats)
+                prog_bar.update()
+    else:
+        for chunk_id in todo:
+            save_part(chunk_id, worker(get_chunk(chunk_id)))
+            prog_bar.update()
+
+    sample_class_stats = []
+    for chunk_id in range(num_chunks):
+        sample_class_stats.extend(mmcv.load(part_file(chunk_id)))
+    save_class_stats(out_dir, sample_class_stats)
+    save_rcs_index(
+        osp.join(out_dir, 'rcs_index'), sample_class_stats, num_classes)
+    shutil.rmtree(part_dir)
+    return sample_class_stats
@@ -3,6 +3,7 @@
 # Licensed under the Apache License, Version 2.0
 # ---------------------------------------------------------------
 
+import bisect
 import json
 import os.path as osp
 import pdb
@@ -13,6 +14,23 @@ import torch
 
 from . import CityscapesDataset
 from .builder import DATASETS
+from .dataset_wrappers import ConcatDataset, RepeatDataset
+from .rcs_stats import RCSIndex
+
+
+def get_class_probs(overall_class_stats, temperature):
+    overall_class_stats = {
+        k: v
+        for k, v in sorted(
+            overall_class_stats.items(), key=lambda item: item[1])
+    }
+    freq = torch.tensor(list(overall_class_stats.values()))
+    freq = freq / torch.sum(freq)
+    freq = 1 - freq
+    freq = torch.softmax(freq / temperature, dim=-1)
+
+
+    return list(overall_class_stats.keys()), freq.numpy()
 
 
 def get_rcs_class_probs(data_root, temperature):
@@ -27,18 +45,15 @@ def get_rcs_class_probs(data_root, temperature):
                 overall_class_stats[c] = n
             else:
                 overall_class_stats[c] += n
-    overall_class_stats = {
-        k: v
-        for k, v in sorted(
-            overall_class_stats.items(), key=lambda item: item[1])
-    }
-    freq = torch.tensor(list(overall_class_stats.values()))
-    freq = freq / torch.sum(freq)
-    freq = 1 - freq
-    freq = torch.softmax(freq / temperature, dim=-1)
+    return get_class_probs(overall_class_stats, temperature)
 
 
-    return list(overall_class_stats.keys()), freq.numpy()
+def get_rcs_index_class_probs(rcs_index, temperature):
+    overall_class_stats = {
+        c: int(n)
+        for c, n in enumerate(rcs_index.class_pixels) if n > 0
+    }
+    return get_class_probs(overall_class_stats, temperature)
 
 
 @DATASETS.register_module()
@@ -61,58 +76,150 @@ class UDADataset(object):
             self.rcs_class_temp = rcs_cfg['class_temp']
             self.rcs_min_crop_ratio = rcs_cfg['min_crop_ratio']
             self.rcs_min_pixels = rcs_cfg['min_pixels']
+            # Let RandomCrop pick a window with enough rare class pixels
+            # instead of re-running the source pipeline until one is found.
+            self.rcs_crop_aware = rcs_cfg.get('crop_aware', False)
+            self.rcs_log_interval = rcs_cfg.get('log_interval', 1000)
+            self.rcs_counters = dict(
+                samples=0, retries=0, retries_avoided=0.)
 
             data_root = cfg['source']['data_root'] if not 'rcs_root' in cfg['source'] else cfg['source']['rcs_root']
-            self.rcs_classes, self.rcs_classprob = get_rcs_class_probs(data_root, self.rcs_class_temp)
+            index_dir = osp.join(data_root, 'rcs_index')
+            self.rcs_index = RCSIndex(index_dir) if osp.exists(
+                index_dir) else None
+            if self.rcs_index is not None:
+                assert self.rcs_index.num_samples == len(self.source), \
+                    f'{index_dir} does not match the source dataset'
+                self.rcs_classes, self.rcs_classprob = \
+                    get_rcs_index_class_probs(self.rcs_index,
+                                              self.rcs_class_temp)
+            else:
+                self.rcs_classes, self.rcs_classprob = get_rcs_class_probs(
+                    data_root, self.rcs_class_temp)
             mmcv.print_log(f'RCS Classes: {self.rcs_classes}', 'daseg')
             mmcv.print_log(f'RCS ClassProb: {self.rcs_classprob}', 'daseg')
 
-            with open(
-                    osp.join(data_root, 'samples_with_class.json'), 'r') as of:
-                samples_with_class_and_n = json.load(of)
-            samples_with_class_and_n = {
-                int(k): v
-                for k, v in samples_with_class_and_n.items()
-                if int(k) in self.rcs_classes
-            }
-            self.samples_with_class = {}
-            for c in self.rcs_classes:
-                self.samples_with_class[c] = []
-                for file, pixels in samples_with_class_and_n[c]:
-                    if pixels > self.rcs_min_pixels:
-                        self.samples_with_class[c].append(file.split('/')[-1])
-                assert len(self.samples_with_class[c]) > 0
-            self.file_to_idx = {}
-            for i, dic in enumerate(self.source.img_infos):
-                file = dic['ann']['seg_map']
-                # if isinstance(self.source, CityscapesDataset):
-                if self.path2name:
-                    file = file.split('/')[-1]
-                self.file_to_idx[file] = i
+            if self.rcs_index is not None:
+                # only the (start, end) range of the eligible samples of each
+                # class is kept, the sample indices stay memory-mapped
+                self.samples_with_class = {}
+                for c in self.rcs_classes:
+                    self.samples_with_class[c] = \
+                        self.rcs_index.get_sample_range(c, self.rcs_min_pixels)
+                    start, end = self.samples_with_class[c]
+                    assert end > start
+            else:
+                self._init_rcs_from_json(data_root)
+
+    def _init_rcs_from_json(self, data_root):
+        with open(
+                osp.join(data_root, 'samples_with_class.json'), 'r') as of:
+            samples_with_class_and_n = json.load(of)
+        samples_with_class_and_n = {
+            int(k): v
+            for k, v in samples_with_class_and_n.items()
+            if int(k) in self.rcs_classes
+        }
+        self.samples_with_class = {}
+        for c in self.rcs_classes:
+            self.samples_with_class[c] = []
+            for file, pixels in samples_with_class_and_n[c]:
+                if pixels > self.rcs_min_pixels:
+                    self.samples_with_class[c].append(file.split('/')[-1])
+            assert len(self.samples_with_class[c]) > 0
+        self.file_to_idx = {}
+        for i, dic in enumerate(self.source.img_infos):
+            file = dic['ann']['seg_map']
+            # if isinstance(self.source, CityscapesDataset):
+            if self.path2name:
+                file = file.split('/')[-1]
+            self.file_to_idx[file] = i
+
+    def _prepare_source_img(self, idx, rcs=None):
+        """Get the source sample ``idx`` with the rare class crop request
+        ``rcs``, through the ConcatDataset and RepeatDataset wrappers of the
+        source dataset."""
+        dataset = self.source
+        while not hasattr(dataset, 'prepare_train_img'):
+            if isinstance(dataset, RepeatDataset):
+                idx = idx % dataset._ori_len
+                dataset = dataset.dataset
+            elif isinstance(dataset, ConcatDataset):
+                dataset_idx = bisect.bisect_right(dataset.cumulative_sizes,
+                                                  idx)
+                if dataset_idx > 0:
+                    idx -= dataset.cumulative_sizes[dataset_idx - 1]
+                dataset = dataset.datasets[dataset_idx]
+            else:
+                # unknown wrapper, crop without the rare class request
+                return dataset[idx]
+        return dataset.prepare_train_img(idx, rcs=rcs)
 
     def get_rare_class_sample(self):
         c = np.random.choice(self.rcs_classes, p=self.rcs_classprob)
-        f1 = np.random.choice(self.samples_with_class[c])
-        i1 = self.file_to_idx[f1]
-        s1 = self.source[i1]
+        if self.rcs_index is not None:
+            i1 = int(self.rcs_index.sample_idx[np.random.randint(
+                *self.samples_with_class[c])])
+        else:
+            f1 = np.random.choice(self.samples_with_class[c])
+            i1 = self.file_to_idx[f1]
+        min_crop_pixels = self.rcs_min_pixels * self.rcs_min_crop_ratio
+        rcs = None
+        if self.rcs_crop_aware and self.rcs_min_crop_ratio > 0:
+            rcs = dict(cls=c, min_pixels=min_crop_pixels)
+        s1 = self._prepare_source_img(i1, rcs=rcs)
+        retries = 0
         if self.rcs_min_crop_ratio > 0:
             for j in range(10):
                 n_class = torch.sum(s1['gt_semantic_seg'].data == c)
                 # mmcv.print_log(f'{j}: {n_class}', 'daseg')
-                if n_class > self.rcs_min_pixels * self.rcs_min_crop_ratio:
+                if n_class > min_crop_pixels:
                     break
                 # Sample a new random crop from source image i1.
                 # Please note, that self.source.__getitem__(idx) applies the
                 # preprocessing pipeline to the loaded image, which includes
                 # RandomCrop, and results in a new crop of the image.
-                s1 = self.source[i1]
+                s1 = self._prepare_source_img(i1, rcs=rcs)
+                retries += 1
+        self._update_rcs_counters(rcs, retries)
         i2 = np.random.choice(range(len(self.target)))
         s2 = self.target[i2]
 
-        return {
+        return self._merge_samples(s1, s2)
+
+    @staticmethod
+    def _merge_samples(s1, s2):
+        sample = {
             **s1, 'target_img_metas': s2['img_metas'],
             'target_img': s2['img']
         }
+        if 'pixel_index' in s2:
+            # for the online pseudo labels, see AddPixelIndex
+            sample['target_pixel_index'] = s2['pixel_index']
+        return sample
+
+    def _update_rcs_counters(self, rcs, retries):
+        """Count the source pipeline retries of rare class sampling.
+
+        For crop-aware sampling, the retries avoided are the expected number
+        of retries of uniformly random crops, i.e. sum_{k=1}^{10} (1 - p)^k
+        with p the fraction of valid crop windows, minus the actual retries.
+        The counters are per dataloader worker and logged every
+        ``log_interval`` samples.
+        """
+        counters = self.rcs_counters
+        counters['samples'] += 1
+        counters['retries'] += retries
+        if rcs is not None and 'valid_crop_ratio' in rcs:
+            p_fail = 1 - rcs['valid_crop_ratio']
+            expected_retries = sum(p_fail**k for k in range(1, 11))
+            counters['retries_avoided'] += expected_retries - retries
+        if self.rcs_log_interval and \
+                counters['samples'] % self.rcs_log_interval == 0:
+            mmcv.print_log(
+                f'RCS: {counters["samples"]} samples, '
+                f'{counters["retries"]} source retries, '
+                f'{counters["retries_avoided"]:.1f} retries avoided', 'daseg')
 
     def __getitem__(self, idx):
         if self.rcs_enabled:
@@ -120,10 +227,7 @@ class UDADataset(object):
         else:
             s1 = self.source[idx // len(self.target)]
             s2 = self.target[idx % len(self.target)]
-            return {
-                **s1, 'target_img_metas': s2['img_metas'],
-                'target_img': s2['img']
-            }
+            return self._merge_samples(s1, s2)
 
     def __len__(self):
         return len(self.source) * len(self.target)
@@ -12,7 +12,10 @@ from functools import partial
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+import torch.utils.checkpoint as cp
 from mmcv.runner import BaseModule, _load_checkpoint
+from mmcv.utils import digit_version
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
 
 from daseg.models.builder import BACKBONES
@@ -55,7 +58,8 @@ class Attention(nn.Module):
                  qk_scale=None,
                  attn_drop=0.,
                  proj_drop=0.,
-                 sr_ratio=1):
+                 sr_ratio=1,
+                 attn_backend='matmul'):
         super().__init__()
         assert dim % num_heads == 0, f'dim {dim} should be divided by ' \
                                      f'num_heads {num_heads}.'
@@ -64,6 +68,14 @@ class Attention(nn.Module):
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = qk_scale or head_dim**-0.5
+        assert attn_backend in ('matmul', 'sdpa'), \
+            f'Unsupported attention backend {attn_backend}'
+        if attn_backend == 'sdpa' and \
+                digit_version(torch.__version__) < digit_version('2.1.0'):
+            warnings.warn('The sdpa attention backend needs torch >= 2.1, '
+                          'falling back to matmul')
+            attn_backend = 'matmul'
+        self.attn_backend = attn_backend
 
         self.q = nn.Linear(dim, dim, bias=qkv_bias)
         self.kv = nn.Linear(dim, dim * 2, bias=qkv_bias)
@@ -80,27 +92,37 @@ class Attention(nn.Module):
     def forward(self, x, H, W):
         B, N, C = x.shape
         q = self.q(x).reshape(B, N, self.num_heads,
-                              C // self.num_heads).permute(0, 2, 1,
-                                                           3).contiguous()
+                              C // self.num_heads).permute(0, 2, 1, 3)
 
         if self.sr_ratio > 1:
-            x_ = x.permute(0, 2, 1).contiguous().reshape(B, C, H, W)
-            x_ = self.sr(x_).reshape(B, C, -1).permute(0, 2, 1).contiguous()
+            x_ = x.permute(0, 2, 1).reshape(B, C, H, W)
+            x_ = self.sr(x_).reshape(B, C, -1).permute(0, 2, 1)
             x_ = self.norm(x_)
             kv = self.kv(x_).reshape(B, -1, 2, self.num_heads,
                                      C // self.num_heads).permute(
-                                         2, 0, 3, 1, 4).contiguous()
+                                         2, 0, 3, 1, 4)
         else:
             kv = self.kv(x).reshape(B, -1, 2, self.num_heads,
                                     C // self.num_heads).permute(
-                                        2, 0, 3, 1, 4).contiguous()
+                                        2, 0, 3, 1, 4)
         k, v = kv[0], kv[1]
 
-        attn = (q @ k.transpose(-2, -1).contiguous()) * self.scale
-        attn = attn.softmax(dim=-1)
-        attn = self.attn_drop(attn)
+        if self.attn_backend == 'sdpa':
+            # dispatches to the flash, memory-efficient or math kernel,
+            # which do not keep the attention matrix for the backward pass
+            x = F.scaled_dot_product_attention(
+                q,
+                k,
+                v,
+                dropout_p=self.attn_drop.p if self.training else 0.,
+                scale=self.scale)
+        else:
+            attn = (q @ k.transpose(-2, -1)) * self.scale
+            attn = attn.softmax(dim=-1)
+            attn = self.attn_drop(attn)
+            x = attn @ v
 
-        x = (attn @ v).transpose(1, 2).contiguous().reshape(B, N, C)
+        x = x.transpose(1, 2).reshape(B, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
 
@@ -120,8 +142,11 @@ class Block(nn.Module):
                  drop_path=0.,
                  act_layer=nn.GELU,
                  norm_layer=nn.LayerNorm,
-                 sr_ratio=1):
+                 sr_ratio=1,
+                 with_cp=False,
+                 attn_backend='matmul'):
         super().__init__()
+        self.with_cp = with_cp
         self.norm1 = norm_layer(dim)
         self.attn = Attention(
             dim,
@@ -130,7 +155,8 @@ class Block(nn.Module):
             qk_scale=qk_scale,
             attn_drop=attn_drop,
             proj_drop=drop,
-            sr_ratio=sr_ratio)
+            sr_ratio=sr_ratio,
+            attn_backend=attn_backend)
         # NOTE: drop path for stochastic depth, we shall see if this is better
         # than dropout here
         self.drop_path = DropPath(
@@ -144,8 +170,16 @@ class Block(nn.Module):
             drop=drop)
 
     def forward(self, x, H, W):
-        x = x + self.drop_path(self.attn(self.norm1(x), H, W))
-        x = x + self.drop_path(self.mlp(self.norm2(x), H, W))
+
+        def _inner_forward(x):
+            x = x + self.drop_path(self.attn(self.norm1(x), H, W))
+            x = x + self.drop_path(self.mlp(self.norm2(x), H, W))
+            return x
+
+        if self.with_cp and x.requires_grad:
+            x = cp.checkpoint(_inner_forward, x)
+        else:
+            x = _inner_forward(x)
 
         return x
 
@@ -207,7 +241,9 @@ class MixVisionTransformer(BaseModule):
                  style=None,
                  pretrained=None,
                  init_cfg=None,
-                 freeze_patch_embed=False):
+                 freeze_patch_embed=False,
+                 with_cp=False,
+                 attn_backend='matmul'):
         super().__init__(init_cfg)
 
         assert not (init_cfg and pretrained), \
@@ -222,6 +258,15 @@ class MixVisionTransformer(BaseModule):
         self.depths = depths
         self.pretrained = pretrained
         self.init_cfg = init_cfg
+        # recompute the activations of the blocks of the stages with with_cp
+        # in the backward pass to save memory, e.g. [True, True, False, False]
+        if isinstance(with_cp, bool):
+            with_cp = [with_cp] * len(depths)
+        assert len(with_cp) == len(depths)
+        self.with_cp = with_cp
+        # 'matmul' computes the attention matrix explicitly, 'sdpa' uses the
+        # fused scaled_dot_product_attention kernels of torch >= 2.1
+        self.attn_backend = attn_backend
 
         # patch_embed
         self.patch_embed1 = OverlapPatchEmbed(
@@ -267,7 +312,9 @@ class MixVisionTransformer(BaseModule):
                 attn_drop=attn_drop_rate,
                 drop_path=dpr[cur + i],
                 norm_layer=norm_layer,
-                sr_ratio=sr_ratios[0]) for i in range(depths[0])
+                sr_ratio=sr_ratios[0],
+                with_cp=with_cp[0],
+                attn_backend=attn_backend) for i in range(depths[0])
         ])
         self.norm1 = norm_layer(embed_dims[0])
 
@@ -283,7 +330,9 @@ class MixVisionTransformer(BaseModule):
                 attn_drop=attn_drop_rate,
                 drop_path=dpr[cur + i],
                 norm_layer=norm_layer,
-                sr_ratio=sr_ratios[1]) for i in range(depths[1])
+                sr_ratio=sr_ratios[1],
+                with_cp=with_cp[1],
+                attn_backend=attn_backend) for i in range(depths[1])
         ])
         self.norm2 = norm_layer(embed_dims[1])
 
@@ -299,7 +348,9 @@ class MixVisionTransformer(BaseModule):
                 attn_drop=attn_drop_rate,
                 drop_path=dpr[cur + i],
                 norm_layer=norm_layer,
-                sr_ratio=sr_ratios[2]) for i in range(depths[2])
+                sr_ratio=sr_ratios[2],
+                with_cp=with_cp[2],
+                attn_backend=attn_backend) for i in range(depths[2])
         ])
         self.norm3 = norm_layer(embed_dims[2])
 
@@ -315,7 +366,9 @@ class MixVisionTransformer(BaseModule):
                 attn_drop=attn_drop_rate,
                 drop_path=dpr[cur + i],
                 norm_layer=norm_layer,
-                sr_ratio=sr_ratios[3]) for i in range(depths[3])
+                sr_ratio=sr_ratios[3],
+                with_cp=with_cp[3],
+                attn_backend=attn_backend) for i in range(depths[3])
         ])
         self.norm4 = norm_layer(embed_dims[3])
 
@@ -4,17 +4,52 @@ import warnings
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint as cp
 
+from daseg.ops import neighborhood_dot, neighborhood_sim, neighborhood_values
 from ..builder import LOSSES
 from .utils import get_class_weight, weight_reduce_loss
 import pdb
 
 
+def neighborhood_cross_prob(prob_map, kernel_size, dilation):
+    """Probabilities that every pixel and each of its neighbors have the same
+    and different classes.
+
+    The class dot products give the (B, k*k, H, W) maps directly, without
+    the (B, C, C, H, W, k*k) tensor of all class pairs: the probability of
+    different classes is the product of the total probabilities minus the
+    one of the same class.
+
+    Returns:
+        tuple[Tensor]: The same and different class probabilities.
+    """
+    cross_prob_pos = neighborhood_dot(prob_map, prob_map, kernel_size,
+                                      dilation)
+    prob_sum = prob_map.sum(dim=1, keepdim=True)
+    cross_prob_neg = prob_sum * neighborhood_values(
+        prob_sum, kernel_size, dilation).squeeze(1) - cross_prob_pos
+    return cross_prob_pos, cross_prob_neg
+
+
+def checkpoint_neighborhood_sim(feats, kernel_size, dilation, sim_type,
+                                sigma=None, with_cp=False):
+    """:func:`neighborhood_sim`, whose intermediate maps are recomputed in
+    the backward pass instead of being stored if ``with_cp``."""
+
+    def _inner_forward(feats):
+        return neighborhood_sim(feats, kernel_size, dilation, sim_type, sigma)
+
+    if with_cp and feats.requires_grad:
+        return cp.checkpoint(_inner_forward, feats)
+    return _inner_forward(feats)
+
+
 @LOSSES.register_module()
 class FeatSimLoss(nn.Module):
 
     def __init__(self, top_k, dilation, kernel_size, sigma, weights, feat_level=2,
-                 sim_type='gaussian'):
+                 sim_type='gaussian', with_cp=False):
         super(FeatSimLoss, self).__init__()
 
         self.top_k = top_k
@@ -24,9 +59,7 @@ class FeatSimLoss(nn.Module):
         self.weights = weights
         self.sim_type = sim_type
         self.feat_level = feat_level
-        self.unfold_fun = nn.Unfold(kernel_size=self.kernel_size,
-                                    padding=self.kernel_size // 2 * self.dilation,
-                                    dilation=self.dilation)
+        self.with_cp = with_cp
 
     # def forward(self, ori_feats_list, seg_logits):
     def forward(self, tensors):
@@ -40,47 +73,14 @@ class FeatSimLoss(nn.Module):
         B, C, H, W = logits_trg.shape
 
         prob_map = F.softmax(logits_trg, dim=1)
-        unf_prob_map = self.unfold_fun(prob_map)
-        unf_prob_map = unf_prob_map.view(B, -1, self.kernel_size**2, H, W).permute(0, 1, 3, 4, 2)
-
-        p = prob_map.unsqueeze(4).repeat(1, 1, 1, 1, self.kernel_size ** 2)
-        q = unf_prob_map # (B, c, h, w, k)
-
-        sim_prob_map = torch.gather(p, 1, q.max(dim=1, keepdim=True)[1])
-        sim_prob_map = sim_prob_map.squeeze(1).permute(0, 3, 1, 2) ** 2
-
-        cross_prob_map = p.unsqueeze(2) * q.unsqueeze(1) # (B, C, C, h, w, k)
-        cross_prob_map = cross_prob_map.permute(0, 5, 3, 4, 1, 2)
-        cross_prob_map_diag = (p * q) # (B, C, h, w, k)
-
-        # diag_mask = torch.eye(C).view(1,1,1,1,C,C).repeat(B,
-        #                                                   self.kernel_size**2,
-        #                                                   H, W, 1, 1).bool().to(cross_prob_map.device)
-
-        # cross_prob_pos_mat = cross_prob_map[diag_mask].view(B, self.kernel_size**2, H, W, -1)
-        # cross_prob_neg_mat = cross_prob_map[diag_mask == False].view(B, self.kernel_size**2, H, W, -1)
-        # cross_prob_pos = (cross_prob_pos_mat).sum(dim=-1)
-        # cross_prob_neg = (cross_prob_neg_mat).sum(dim=-1)
-        cross_prob_pos = (cross_prob_map_diag).sum(dim=1).permute(0,3,1,2)
-        cross_prob_neg = cross_prob_map.sum(dim=[-2,-1]) - cross_prob_pos
+        cross_prob_pos, cross_prob_neg = neighborhood_cross_prob(
+            prob_map, self.kernel_size, self.dilation) # (B, k, h, w)
 
         losses = {}
-        channels = x_ema.shape[1]
         feats = F.interpolate(x_ema, size=(H, W), mode='nearest')
-        unf_feats = self.unfold_fun(feats)
-        unf_feats = unf_feats.view(B, channels, self.kernel_size**2, H, W).permute(0, 1, 3, 4, 2)
-
-        if self.sim_type == 'gaussian':
-            temp_dis = ((unf_feats - feats.unsqueeze(4)) ** 2).sum(dim=1)
-            sim_feat = torch.exp(- temp_dis  / self.sigma ** 2).permute(0, 3, 1, 2)
-
-        elif self.sim_type == 'cosine':
-
-            sim_feat = F.cosine_similarity(unf_feats, feats.unsqueeze(4), dim=1)
-            sim_feat = sim_feat.permute(0, 3, 1, 2)
-
-        else:
-            raise ValueError()
+        sim_feat = checkpoint_neighborhood_sim(
+            feats, self.kernel_size, self.dilation, self.sim_type, self.sigma,
+            self.with_cp)
 
         _, top_idx_max = torch.topk(sim_feat, self.top_k+1, dim=1)
         _, top_idx_min = torch.topk(sim_feat, self.top_k, dim=1, largest=False)
@@ -111,7 +111,8 @@ class FeatSimLoss(nn.Module):
 class AdaptiveFeatSimLoss(nn.Module):
 
     def __init__(self, top_k, dilation, kernel_size, weights, sigma=30, mean_sim=0.6, feat_level=2,
-                 sim_type='gaussian', num_bins=100, apply_ignore=False):
+                 sim_type='gaussian', num_bins=100, apply_ignore=False,
+                 with_cp=False):
         super(AdaptiveFeatSimLoss, self).__init__()
 
         self.top_k = top_k
@@ -122,10 +123,8 @@ class AdaptiveFeatSimLoss(nn.Module):
         self.feat_level = feat_level
         self.num_bins = num_bins
         self.sigma = sigma
-        self.unfold_fun = nn.Unfold(kernel_size=self.kernel_size,
-                                    padding=self.kernel_size // 2 * self.dilation,
-                                    dilation=self.dilation)
         self.apply_ignore = apply_ignore
+        self.with_cp = with_cp
 
     # def forward(self, ori_feats_list, seg_logits):
     def forward(self, tensors):
@@ -143,13 +142,12 @@ class AdaptiveFeatSimLoss(nn.Module):
         ignore_mask = gt_src_ != 255 if self.apply_ignore else None
 
 
-        src_cross_prob_map_diag = self.get_cross_prob_map_diag(logits_src) # (B, C, H, W, k)
-        trg_cross_prob_map_diag = self.get_cross_prob_map_diag(logits_trg) # (B, C, H, W, k)
+        trg_cross_prob_pos = self.get_cross_prob_pos(logits_trg) # (B, k, H, W)
 
         x_ema, ema_sim_feat = self.get_sim_feat(x_ema, size=(H, W)) # (B, k, H, W)
         _, src_sim_feat = self.get_sim_feat(x_src, size=(H, W)) 
-        unf_gt_src = self.unfold_fun(gt_src_.float())
-        unf_gt_src = unf_gt_src.view(-1, self.kernel_size**2, H, W).long()
+        unf_gt_src = neighborhood_values(gt_src_, self.kernel_size,
+                                         self.dilation).squeeze(1).long()
         rep_gt_src = gt_src_.repeat(1, self.kernel_size**2, 1, 1)
 
         pos_gt_pair = unf_gt_src == rep_gt_src
@@ -163,7 +161,8 @@ class AdaptiveFeatSimLoss(nn.Module):
             src_neg_sim = src_sim_feat[neg_gt_pair & ignore_mask.repeat(1, neg_gt_pair.shape[1], 1, 1)]
 
 
-        loss_sim_pos, loss_sim_neg = self.get_sim_losses(x_ema, ema_sim_feat, trg_cross_prob_map_diag, ignore_mask)
+        loss_sim_pos, loss_sim_neg = self.get_sim_losses(
+            x_ema, ema_sim_feat, trg_cross_prob_pos, ignore_mask)
 
         losses.update({
             'loss_src_pos': - src_pos_sim.mean() * self.weights['src_pos'],
@@ -177,60 +176,31 @@ class AdaptiveFeatSimLoss(nn.Module):
 
         return losses
 
-    def get_cross_prob_map_diag(self, logits):
-
-        B, C, H, W = logits.shape
+    def get_cross_prob_pos(self, logits):
+        """Get the (B, k, H, W) probabilities that every pixel and each of its
+        neighbors have the same class."""
         prob_map = F.softmax(logits, dim=1)
-        unf_prob_map = self.unfold_fun(prob_map)
-        unf_prob_map = unf_prob_map.view(B, -1, self.kernel_size**2, H, W).permute(0, 1, 3, 4, 2)
-
-        p = prob_map.unsqueeze(4).repeat(1, 1, 1, 1, self.kernel_size ** 2)
-        q = unf_prob_map # (B, c, h, w, k)
-
-        sim_prob_map = torch.gather(p, 1, q.max(dim=1, keepdim=True)[1])
-        sim_prob_map = sim_prob_map.squeeze(1).permute(0, 3, 1, 2) ** 2
-
-        # cross_prob_map = p.unsqueeze(2) * q.unsqueeze(1) # (B, C, C, h, w, k)
-        # cross_prob_map = cross_prob_map.permute(0, 5, 3, 4, 1, 2)
-        cross_prob_map_diag = (p * q) # (B, C, h, w, k)
-
-        # diag_mask = torch.eye(C).view(1,1,1,1,C,C).repeat(B,
-        #                                                   self.kernel_size**2,
-        #                                                   H, W, 1, 1).bool().to(cross_prob_map.device)
-        # cross_prob_pos_mat = cross_prob_map[diag_mask].view(B, self.kernel_size**2, H, W, -1)
-        # cross_prob_neg_mat = cross_prob_map[diag_mask == False].view(B, self.kernel_size**2, H, W, -1)
-        # cross_prob_pos = (cross_prob_pos_mat).sum(dim=-1)
-        # cross_prob_neg = (cross_prob_neg_mat).sum(dim=-1)
-        # cross_prob_pos = (cross_prob_map_diag).sum(dim=1).permute(0,3,1,2)
-        # cross_prob_neg = cross_prob_map.sum(dim=[-2,-1]) - cross_prob_pos
-
-        return cross_prob_map_diag
+        cross_prob_pos, _ = neighborhood_cross_prob(prob_map, self.kernel_size,
+                                                    self.dilation)
+        return cross_prob_pos
 
     def get_sim_feat(self, x, size=None):
 
-        B, channels, _, _ = x.shape
+        feats = x
         if size is not None:
             feats = F.interpolate(x, size=size, mode='nearest')
-        unf_feats = self.unfold_fun(feats)
-        unf_feats = unf_feats.view(B, channels, self.kernel_size**2, size[0], size[1]).permute(0, 1, 3, 4, 2)
-
-        if self.sim_type == 'gaussian':
-            temp_dis = ((unf_feats - feats.unsqueeze(4)) ** 2).sum(dim=1)
-            sim_feat = torch.exp(- temp_dis  / self.sigma ** 2).permute(0, 3, 1, 2)
-
-        elif self.sim_type == 'cosine':
-
-            sim_feat = F.cosine_similarity(unf_feats, feats.unsqueeze(4), dim=1)
-            sim_feat = sim_feat.permute(0, 3, 1, 2)
-
-        else:
-            raise ValueError()
+        sim_feat = checkpoint_neighborhood_sim(
+            feats, self.kernel_size, self.dilation, self.sim_type, self.sigma,
+            self.with_cp)
 
         return feats, sim_feat
 
-    def get_sim_losses(self, feats, sim_feat, cross_prob_map_diag, ignore_mask=None):
+    def get_sim_losses(self,
+                       feats,
+                       sim_feat,
+                       cross_prob_pos,
+                       ignore_mask=None):
 
-        cross_prob_pos = (cross_prob_map_diag).sum(dim=1).permute(0,3,1,2)
         cross_prob_neg = 1 - cross_prob_pos
 
         if self.top_k is not None:
@@ -12,6 +12,16 @@ from ..builder import SEGMENTORS
 from .base import BaseSegmentor
 
 
+def _split_outputs(outputs, sizes):
+    """Split the head outputs of concatenated batches into the outputs of
+    every batch, element-wise for heads returning a tuple such as DAHead."""
+    if isinstance(outputs, torch.Tensor):
+        return outputs.split(sizes)
+    assert isinstance(outputs, (tuple, list)), \
+        f'Unsupported head outputs of type {type(outputs)}'
+    return list(zip(*[_split_outputs(out, sizes) for out in outputs]))
+
+
 @SEGMENTORS.register_module()
 class EncoderDecoder(BaseSegmentor):
     """Encoder Decoder segmentors.
@@ -178,22 +188,79 @@ class EncoderDecoder(BaseSegmentor):
 
         return losses
 
-    # TODO refactor
-    def slide_inference(self, img, img_meta, rescale):
-        """Inference by sliding-window with overlap.
+    def forward_train_batches(self,
+                              batches,
+                              return_feat=False,
+                              return_logits=False):
+        """Forward function for training on several batches at once.
 
-        If h_crop > h_img or w_crop > w_img, the small patch will be used to
-        decode without padding.
-        """
+        The images of all batches go through the backbone and the heads as
+        one concatenated batch, and the outputs are split, element-wise for
+        heads returning a tuple, to compute the losses of every batch like
+        :meth:`forward_train`. This saves one pass of kernel launches per
+        batch. The batch statistics of batch norm layers are then computed
+        over all batches.
 
+        Args:
+            batches (list[dict]): The ``img``, ``img_metas``,
+                ``gt_semantic_seg`` and optional ``seg_weight`` of every
+                batch.
+            return_feat (bool): Whether to return the features of every
+                batch. Default: False.
+            return_logits (bool): Whether to return the decode head logits
+                of every batch. Default: False.
+
+        Returns:
+            list[dict[str, Tensor]]: The loss components of every batch.
+        """
+        sizes = [batch['img'].shape[0] for batch in batches]
+        x = self.extract_feat(torch.cat([batch['img'] for batch in batches]))
+        batch_feats = list(zip(*[feat.split(sizes) for feat in x]))
+        batch_logits = _split_outputs(self.decode_head(x), sizes)
+        if self.with_auxiliary_head:
+            aux_heads = self.auxiliary_head if isinstance(
+                self.auxiliary_head, nn.ModuleList) else [self.auxiliary_head]
+            batch_aux_logits = list(
+                zip(*[
+                    _split_outputs(aux_head(x), sizes)
+                    for aux_head in aux_heads
+                ]))
+
+        batch_losses = []
+        for i, batch in enumerate(batches):
+            gt_semantic_seg = batch['gt_semantic_seg']
+            seg_weight = batch.get('seg_weight')
+            losses = dict()
+            if return_feat:
+                losses['features'] = list(batch_feats[i])
+
+            loss_decode = self.decode_head.losses(batch_logits[i],
+                                                  gt_semantic_seg, seg_weight)
+            if return_logits:
+                loss_decode['logits'] = batch_logits[i]
+            losses.update(add_prefix(loss_decode, 'decode'))
+
+            if self.with_auxiliary_head:
+                if isinstance(self.auxiliary_head, nn.ModuleList):
+                    for idx, aux_head in enumerate(self.auxiliary_head):
+                        loss_aux = aux_head.losses(batch_aux_logits[i][idx],
+                                                   gt_semantic_seg, seg_weight)
+                        losses.update(add_prefix(loss_aux, f'aux_{idx}'))
+                else:
+                    loss_aux = self.auxiliary_head.losses(
+                        batch_aux_logits[i][0], gt_semantic_seg)
+                    losses.update(add_prefix(loss_aux, 'aux'))
+            batch_losses.append(losses)
+
+        return batch_losses
+
+    def _get_slide_windows(self, h_img, w_img):
+        """Compute the (y1, y2, x1, x2) coordinates of all sliding windows."""
         h_stride, w_stride = self.test_cfg.stride
         h_crop, w_crop = self.test_cfg.crop_size
-        batch_size, _, h_img, w_img = img.size()
-        num_classes = self.num_classes
         h_grids = max(h_img - h_crop + h_stride - 1, 0) // h_stride + 1
         w_grids = max(w_img - w_crop + w_stride - 1, 0) // w_stride + 1
-        preds = img.new_zeros((batch_size, num_classes, h_img, w_img))
-        count_mat = img.new_zeros((batch_size, 1, h_img, w_img))
+        windows = []
         for h_idx in range(h_grids):
             for w_idx in range(w_grids):
                 y1 = h_idx * h_stride
@@ -202,12 +269,37 @@ class EncoderDecoder(BaseSegmentor):
                 x2 = min(x1 + w_crop, w_img)
                 y1 = max(y2 - h_crop, 0)
                 x1 = max(x2 - w_crop, 0)
-                crop_img = img[:, :, y1:y2, x1:x2]
-                crop_seg_logit = self.encode_decode(crop_img, img_meta)
-                preds += F.pad(crop_seg_logit,
-                               (int(x1), int(preds.shape[3] - x2), int(y1),
-                                int(preds.shape[2] - y2)))
+                windows.append((y1, y2, x1, x2))
+        return windows
+
+    def slide_inference(self, img, img_meta, rescale):
+        """Inference by sliding-window with overlap.
+
+        If h_crop > h_img or w_crop > w_img, the small patch will be used to
+        decode without padding. If ``test_cfg.slide_batch_size`` is set, up to
+        that many windows are stacked along the batch dimension and decoded
+        in a single forward pass.
+        """
 
+        batch_size, _, h_img, w_img = img.size()
+        num_classes = self.num_classes
+        slide_batch_size = self.test_cfg.get('slide_batch_size', None) or 1
+        windows = self._get_slide_windows(h_img, w_img)
+        preds = img.new_zeros((batch_size, num_classes, h_img, w_img))
+        count_mat = img.new_zeros((batch_size, 1, h_img, w_img))
+        for i in range(0, len(windows), slide_batch_size):
+            batch_windows = windows[i:i + slide_batch_size]
+            # All windows share the same size, so they can be concatenated
+            # along the batch dimension as (num_windows * batch_size, ...).
+            crop_img = torch.cat([
+                img[:, :, y1:y2, x1:x2] for y1, y2, x1, x2 in batch_windows
+            ])
+            crop_seg_logits = self.encode_decode(
+                crop_img, img_meta * len(batch_windows))
+            crop_seg_logits = crop_seg_logits.split(batch_size)
+            for (y1, y2, x1, x2), crop_seg_logit in zip(
+                    batch_windows, crop_seg_logits):
+                preds[:, :, y1:y2, x1:x2] += crop_seg_logit
                 count_mat[:, :, y1:y2, x1:x2] += 1
         assert (count_mat == 0).sum() == 0
         if torch.onnx.is_in_onnx_export():
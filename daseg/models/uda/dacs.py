@@ -24,8 +24,10 @@ from torch.nn.modules.dropout import _DropoutNd
 from daseg.core import add_prefix
 from daseg.models import UDA, build_segmentor
 from daseg.models.uda.uda_decorator import UDADecorator, get_module
-from daseg.models.utils.dacs_transforms import (denorm, get_class_masks,
-                                                get_mean_std, strong_transform)
+from daseg.models.utils.dacs_transforms import (BatchStrongTransform, denorm,
+                                                get_class_masks, get_mean_std)
+from daseg.models.utils.ema import EMAUpdater
+from daseg.models.utils.imnet_feature_cache import ImnetFeatureCache
 from daseg.models.utils.visualization import subplotimg
 from daseg.utils.utils import downscale_label_ratio
 
@@ -58,6 +60,7 @@ class DACS(UDADecorator):
         self.local_iter = 0
         self.max_iters = cfg['max_iters']
         self.alpha = cfg['alpha']
+        self.ema = EMAUpdater(self.alpha, **cfg.get('ema_cfg', {}))
         self.pseudo_threshold = cfg['pseudo_threshold']
         self.psweight_ignore_top = cfg['pseudo_weight_ignore_top']
         self.psweight_ignore_bottom = cfg['pseudo_weight_ignore_bottom']
@@ -69,9 +72,16 @@ class DACS(UDADecorator):
         self.blur = cfg['blur']
         self.color_jitter_s = cfg['color_jitter_strength']
         self.color_jitter_p = cfg['color_jitter_probability']
+        self.batch_strong_transform = BatchStrongTransform(
+            self.color_jitter_s, self.color_jitter_p,
+            seed=cfg.get('strong_transform_seed'))
         self.debug_img_interval = cfg['debug_img_interval']
         self.print_grad_magnitude = cfg['print_grad_magnitude']
+        self.fused_forward = cfg.get('fused_forward', False)
         assert self.mix == 'class'
+        assert not (self.fused_forward and self.print_grad_magnitude), \
+            'The gradient magnitudes of the source losses are not ' \
+            'available with a fused forward pass'
 
         self.debug_fdist_mask = None
         self.debug_gt_rescale = None
@@ -84,6 +94,9 @@ class DACS(UDADecorator):
             self.imnet_model = build_segmentor(deepcopy(cfg['model']))
         else:
             self.imnet_model = None
+        feat_cache_cfg = cfg.get('imnet_feature_cache')
+        self.imnet_feat_cache = ImnetFeatureCache(**feat_cache_cfg) \
+            if self.enable_fdist and feat_cache_cfg is not None else None
 
     def get_ema_model(self):
         return get_module(self.ema_model)
@@ -92,28 +105,10 @@ class DACS(UDADecorator):
         return get_module(self.imnet_model)
 
     def _init_ema_weights(self):
-        for param in self.get_ema_model().parameters():
-            param.detach_()
-        mp = list(self.get_model().parameters())
-        mcp = list(self.get_ema_model().parameters())
-        for i in range(0, len(mp)):
-            if not mcp[i].data.shape:  # scalar tensor
-                mcp[i].data = mp[i].data.clone()
-            else:
-                mcp[i].data[:] = mp[i].data[:].clone()
+        self.ema.init_weights(self.get_ema_model(), self.get_model())
 
     def _update_ema(self, iter):
-        alpha_teacher = min(1 - 1 / (iter + 1), self.alpha)
-        for ema_param, param in zip(self.get_ema_model().parameters(),
-                                    self.get_model().parameters()):
-            if not param.data.shape:  # scalar tensor
-                ema_param.data = \
-                    alpha_teacher * ema_param.data + \
-                    (1 - alpha_teacher) * param.data
-            else:
-                ema_param.data[:] = \
-                    alpha_teacher * ema_param[:].data[:] + \
-                    (1 - alpha_teacher) * param[:].data[:]
+        self.ema.update(self.get_ema_model(), self.get_model(), iter)
 
     def train_step(self, data_batch, optimizer, **kwargs):
         """The iteration step during training.
@@ -143,8 +138,9 @@ class DACS(UDADecorator):
         """
 
         optimizer.zero_grad()
-        log_vars = self(**data_batch)
-        optimizer.step()
+        with self._autocast():
+            log_vars = self(**data_batch)
+        self._optimizer_step(optimizer, log_vars)
 
         log_vars.pop('loss', None)  # remove the unnecessary 'loss'
         outputs = dict(
@@ -162,11 +158,18 @@ class DACS(UDADecorator):
             # mmcv.print_log(f'fd masked: {pw_feat_dist.shape}', 'daseg')
         return torch.mean(pw_feat_dist)
 
-    def calc_feat_dist(self, img, gt, feat=None):
+    def calc_feat_dist(self, img, gt, feat=None, img_metas=None):
         assert self.enable_fdist
         with torch.no_grad():
             self.get_imnet_model().eval()
-            feat_imnet = self.get_imnet_model().extract_feat(img)
+            if self.imnet_feat_cache is not None and img_metas is not None:
+                # only the last stage is compared
+                feat_imnet = [
+                    self.imnet_feat_cache.extract_feat(
+                        self.get_imnet_model(), img, img_metas)
+                ]
+            else:
+                feat_imnet = self.get_imnet_model().extract_feat(img)
             feat_imnet = [f.detach() for f in feat_imnet]
         lay = -1
         if self.fdist_classes is not None:
@@ -187,8 +190,54 @@ class DACS(UDADecorator):
         feat_loss, feat_log = self._parse_losses(
             {'loss_imnet_feat_dist': feat_dist})
         feat_log.pop('loss', None)
+        if self.imnet_feat_cache is not None:
+            feat_log.update(self.imnet_feat_cache.get_log_vars())
         return feat_loss, feat_log
 
+    def _get_mixed_batch(self, img, gt_semantic_seg, target_img,
+                         target_img_metas, strong_parameters):
+        """Get the pseudo labels of the target images, and the class mix
+        masks, images, labels and pixel weights of the mixed images."""
+        # Generate pseudo-label
+        for m in self.get_ema_model().modules():
+            if isinstance(m, _DropoutNd):
+                m.training = False
+            if isinstance(m, DropPath):
+                m.training = False
+        ema_logits = self.get_ema_model().encode_decode(
+            target_img, target_img_metas)
+
+        ema_softmax = torch.softmax(ema_logits.detach().float(), dim=1)
+        pseudo_prob, pseudo_label = torch.max(ema_softmax, dim=1)
+        ps_large_p = pseudo_prob.ge(self.pseudo_threshold).long() == 1
+        ps_size = np.size(np.array(pseudo_label.cpu()))
+        pseudo_weight = torch.sum(ps_large_p).item() / ps_size
+        pseudo_weight = pseudo_weight * torch.ones(
+            pseudo_prob.shape, device=img.device)
+
+        if self.psweight_ignore_top > 0:
+            # Don't trust pseudo-labels in regions with potential
+            # rectification artifacts. This can lead to a pseudo-label
+            # drift from sky towards building or traffic light.
+            pseudo_weight[:, :self.psweight_ignore_top, :] = 0
+        if self.psweight_ignore_bottom > 0:
+            pseudo_weight[:, -self.psweight_ignore_bottom:, :] = 0
+        gt_pixel_weight = torch.ones((pseudo_weight.shape), device=img.device)
+
+        # Apply mixing
+        mix_masks = get_class_masks(gt_semantic_seg)
+        strong_parameters['mix'] = mix_masks
+        mixed_img, mixed_lbl = self.batch_strong_transform(
+            strong_parameters,
+            data=torch.stack((img, target_img)),
+            target=torch.stack((gt_semantic_seg[:, 0], pseudo_label)))
+        _, pseudo_weight = self.batch_strong_transform(
+            strong_parameters,
+            target=torch.stack((gt_pixel_weight, pseudo_weight)))
+        pseudo_weight = pseudo_weight[:, 0]
+
+        return pseudo_label, mix_masks, mixed_img, mixed_lbl, pseudo_weight
+
     def forward_train(self, img, img_metas, gt_semantic_seg, target_img,
                       target_img_metas):
         """Forward function for training.
@@ -231,13 +280,34 @@ class DACS(UDADecorator):
             'std': stds[0].unsqueeze(0)
         }
 
-        # Train on source images
-        clean_losses = self.get_model().forward_train(
-            img, img_metas, gt_semantic_seg, return_feat=True)
+        if self.fused_forward:
+            pseudo_label, mix_masks, mixed_img, mixed_lbl, pseudo_weight = \
+                self._get_mixed_batch(img, gt_semantic_seg, target_img,
+                                      target_img_metas, strong_parameters)
+
+            # Train on source and mixed images in one pass
+            clean_losses, mix_losses = self.get_model().forward_train_batches(
+                [
+                    dict(
+                        img=img,
+                        img_metas=img_metas,
+                        gt_semantic_seg=gt_semantic_seg),
+                    dict(
+                        img=mixed_img,
+                        img_metas=img_metas,
+                        gt_semantic_seg=mixed_lbl,
+                        seg_weight=pseudo_weight)
+                ],
+                return_feat=True)
+        else:
+            # Train on source images
+            clean_losses = self.get_model().forward_train(
+                img, img_metas, gt_semantic_seg, return_feat=True)
         src_feat = clean_losses.pop('features')
         clean_loss, clean_log_vars = self._parse_losses(clean_losses)
         log_vars.update(clean_log_vars)
-        clean_loss.backward(retain_graph=self.enable_fdist)
+        if not self.fused_forward:
+            self._backward(clean_loss, retain_graph=self.enable_fdist)
         if self.print_grad_magnitude:
             params = self.get_model().backbone.parameters()
             seg_grads = [
@@ -249,8 +319,9 @@ class DACS(UDADecorator):
         # ImageNet feature distance
         if self.enable_fdist:
             feat_loss, feat_log = self.calc_feat_dist(img, gt_semantic_seg,
-                                                      src_feat)
-            feat_loss.backward()
+                                                      src_feat, img_metas)
+            if not self.fused_forward:
+                self._backward(feat_loss)
             log_vars.update(add_prefix(feat_log, 'src'))
             if self.print_grad_magnitude:
                 params = self.get_model().backbone.parameters()
@@ -261,56 +332,26 @@ class DACS(UDADecorator):
                 grad_mag = calc_grad_magnitude(fd_grads)
                 mmcv.print_log(f'Fdist Grad.: {grad_mag}', 'daseg')
 
-        # Generate pseudo-label
-        for m in self.get_ema_model().modules():
-            if isinstance(m, _DropoutNd):
-                m.training = False
-            if isinstance(m, DropPath):
-                m.training = False
-        ema_logits = self.get_ema_model().encode_decode(
-            target_img, target_img_metas)
-
-        ema_softmax = torch.softmax(ema_logits.detach(), dim=1)
-        pseudo_prob, pseudo_label = torch.max(ema_softmax, dim=1)
-        ps_large_p = pseudo_prob.ge(self.pseudo_threshold).long() == 1
-        ps_size = np.size(np.array(pseudo_label.cpu()))
-        pseudo_weight = torch.sum(ps_large_p).item() / ps_size
-        pseudo_weight = pseudo_weight * torch.ones(
-            pseudo_prob.shape, device=dev)
-
-        if self.psweight_ignore_top > 0:
-            # Don't trust pseudo-labels in regions with potential
-            # rectification artifacts. This can lead to a pseudo-label
-            # drift from sky towards building or traffic light.
-            pseudo_weight[:, :self.psweight_ignore_top, :] = 0
-        if self.psweight_ignore_bottom > 0:
-            pseudo_weight[:, -self.psweight_ignore_bottom:, :] = 0
-        gt_pixel_weight = torch.ones((pseudo_weight.shape), device=dev)
-
-        # Apply mixing
-        mixed_img, mixed_lbl = [None] * batch_size, [None] * batch_size
-        mix_masks = get_class_masks(gt_semantic_seg)
+        if not self.fused_forward:
+            pseudo_label, mix_masks, mixed_img, mixed_lbl, pseudo_weight = \
+                self._get_mixed_batch(img, gt_semantic_seg, target_img,
+                                      target_img_metas, strong_parameters)
 
-        for i in range(batch_size):
-            strong_parameters['mix'] = mix_masks[i]
-            mixed_img[i], mixed_lbl[i] = strong_transform(
-                strong_parameters,
-                data=torch.stack((img[i], target_img[i])),
-                target=torch.stack((gt_semantic_seg[i][0], pseudo_label[i])))
-            _, pseudo_weight[i] = strong_transform(
-                strong_parameters,
-                target=torch.stack((gt_pixel_weight[i], pseudo_weight[i])))
-        mixed_img = torch.cat(mixed_img)
-        mixed_lbl = torch.cat(mixed_lbl)
-
-        # Train on mixed images
-        mix_losses = self.get_model().forward_train(
-            mixed_img, img_metas, mixed_lbl, pseudo_weight, return_feat=True)
+            # Train on mixed images
+            mix_losses = self.get_model().forward_train(
+                mixed_img, img_metas, mixed_lbl, pseudo_weight,
+                return_feat=True)
         mix_losses.pop('features')
         mix_losses = add_prefix(mix_losses, 'mix')
         mix_loss, mix_log_vars = self._parse_losses(mix_losses)
         log_vars.update(mix_log_vars)
-        mix_loss.backward()
+        if self.fused_forward:
+            # one backward pass through the fused forward pass
+            src_loss = clean_loss + feat_loss if self.enable_fdist \
+                else clean_loss
+            self._backward(src_loss + mix_loss)
+        else:
+            self._backward(mix_loss)
 
         if self.local_iter % self.debug_img_interval == 0:
             out_dir = os.path.join(self.train_cfg['work_dir'],
@@ -26,8 +26,11 @@ import torch.nn.functional as F
 from daseg.core import add_prefix
 from daseg.models import UDA, build_segmentor, builder
 from daseg.models.uda.uda_decorator import UDADecorator, get_module
-from daseg.models.utils.dacs_transforms import (denorm, get_class_masks,
-                                                get_mean_std, strong_transform)
+from daseg.models.utils.dacs_transforms import (BatchStrongTransform, denorm,
+                                                get_class_masks, get_mean_std)
+from daseg.models.utils.ema import EMAUpdater
+from daseg.models.utils.imnet_feature_cache import ImnetFeatureCache
+from daseg.models.utils.online_pseudo_labels import OnlinePseudoLabeler
 from daseg.models.utils.visualization import subplotimg
 from daseg.utils.utils import downscale_label_ratio
 
@@ -60,6 +63,7 @@ class FMDA(UDADecorator):
         self.local_iter = 0
         self.max_iters = cfg['max_iters']
         self.alpha = cfg['alpha']
+        self.ema = EMAUpdater(self.alpha, **cfg.get('ema_cfg', {}))
         self.pseudo_threshold = cfg['pseudo_threshold']
         self.psweight_ignore_top = cfg['pseudo_weight_ignore_top']
         self.psweight_ignore_bottom = cfg['pseudo_weight_ignore_bottom']
@@ -71,10 +75,23 @@ class FMDA(UDADecorator):
         self.blur = cfg['blur']
         self.color_jitter_s = cfg['color_jitter_strength']
         self.color_jitter_p = cfg['color_jitter_probability']
+        self.batch_strong_transform = BatchStrongTransform(
+            self.color_jitter_s, self.color_jitter_p,
+            seed=cfg.get('strong_transform_seed'))
         self.debug_img_interval = cfg['debug_img_interval']
         self.print_grad_magnitude = cfg['print_grad_magnitude']
         self.trg_loss_weight = cfg.get('trg_loss_weight', 1.)
+        self.fused_forward = cfg.get('fused_forward', False)
         assert self.mix == 'class'
+        assert not (self.fused_forward and self.print_grad_magnitude), \
+            'The gradient magnitudes of the source losses are not ' \
+            'available with a fused forward pass'
+
+        # refresh the pseudo labels of the target pipeline with ema_logits
+        self.online_pseudo_labeler = None
+        if cfg.get('online_pseudo_labels') is not None:
+            self.online_pseudo_labeler = OnlinePseudoLabeler(
+                **cfg['online_pseudo_labels'])
 
         self.debug_fdist_mask = None
         self.debug_gt_rescale = None
@@ -87,6 +104,9 @@ class FMDA(UDADecorator):
             self.imnet_model = build_segmentor(deepcopy(cfg['model']))
         else:
             self.imnet_model = None
+        feat_cache_cfg = cfg.get('imnet_feature_cache')
+        self.imnet_feat_cache = ImnetFeatureCache(**feat_cache_cfg) \
+            if self.enable_fdist and feat_cache_cfg is not None else None
 
         aux_losses = cfg['aux_losses']
         if not type(aux_losses) == list:
@@ -102,28 +122,10 @@ class FMDA(UDADecorator):
         return get_module(self.imnet_model)
 
     def _init_ema_weights(self):
-        for param in self.get_ema_model().parameters():
-            param.detach_()
-        mp = list(self.get_model().parameters())
-        mcp = list(self.get_ema_model().parameters())
-        for i in range(0, len(mp)):
-            if not mcp[i].data.shape:  # scalar tensor
-                mcp[i].data = mp[i].data.clone()
-            else:
-                mcp[i].data[:] = mp[i].data[:].clone()
+        self.ema.init_weights(self.get_ema_model(), self.get_model())
 
     def _update_ema(self, iter):
-        alpha_teacher = min(1 - 1 / (iter + 1), self.alpha)
-        for ema_param, param in zip(self.get_ema_model().parameters(),
-                                    self.get_model().parameters()):
-            if not param.data.shape:  # scalar tensor
-                ema_param.data = \
-                    alpha_teacher * ema_param.data + \
-                    (1 - alpha_teacher) * param.data
-            else:
-                ema_param.data[:] = \
-                    alpha_teacher * ema_param[:].data[:] + \
-                    (1 - alpha_teacher) * param[:].data[:]
+        self.ema.update(self.get_ema_model(), self.get_model(), iter)
 
     def train_step(self, data_batch, optimizer, **kwargs):
         """The iteration step during training.
@@ -153,8 +155,9 @@ class FMDA(UDADecorator):
         """
 
         optimizer.zero_grad()
-        log_vars, vis_states = self(**data_batch)
-        optimizer.step()
+        with self._autocast():
+            log_vars, vis_states = self(**data_batch)
+        self._optimizer_step(optimizer, log_vars)
 
         log_vars.pop('loss', None)  # remove the unnecessary 'loss'
         outputs = dict(
@@ -175,11 +178,18 @@ class FMDA(UDADecorator):
             # mmcv.print_log(f'fd masked: {pw_feat_dist.shape}', 'daseg')
         return torch.mean(pw_feat_dist)
 
-    def calc_feat_dist(self, img, gt, feat=None):
+    def calc_feat_dist(self, img, gt, feat=None, img_metas=None):
         assert self.enable_fdist
         with torch.no_grad():
             self.get_imnet_model().eval()
-            feat_imnet = self.get_imnet_model().extract_feat(img)
+            if self.imnet_feat_cache is not None and img_metas is not None:
+                # only the last stage is compared
+                feat_imnet = [
+                    self.imnet_feat_cache.extract_feat(
+                        self.get_imnet_model(), img, img_metas)
+                ]
+            else:
+                feat_imnet = self.get_imnet_model().extract_feat(img)
             feat_imnet = [f.detach() for f in feat_imnet]
         lay = -1
         if self.fdist_classes is not None:
@@ -200,10 +210,52 @@ class FMDA(UDADecorator):
         feat_loss, feat_log = self._parse_losses(
             {'loss_imnet_feat_dist': feat_dist})
         feat_log.pop('loss', None)
+        if self.imnet_feat_cache is not None:
+            feat_log.update(self.imnet_feat_cache.get_log_vars())
         return feat_loss, feat_log
 
+    def _get_pseudo_label(self, target_img, target_img_metas,
+                          target_pixel_index, log_vars):
+        """Get the EMA teacher features, pseudo labels and pseudo weights of
+        the target images."""
+        # Generate pseudo-label
+        for m in self.get_ema_model().modules():
+            if isinstance(m, _DropoutNd):
+                m.training = False
+            if isinstance(m, DropPath):
+                m.training = False
+        # ema_logits = self.get_ema_model().encode_decode(
+        #     target_img, target_img_metas)
+        ema_logits, ema_feats = self.get_ema_model().encode_decode(
+            target_img, target_img_metas, return_feats=True)
+        if self.online_pseudo_labeler is not None:
+            assert target_pixel_index is not None, \
+                'The online pseudo labels need AddPixelIndex in the target ' \
+                'pipeline'
+            log_vars.update(
+                self.online_pseudo_labeler.update(ema_logits, target_img_metas,
+                                                  target_pixel_index))
+
+        ema_softmax = torch.softmax(ema_logits.detach().float(), dim=1)
+        pseudo_prob, pseudo_label = torch.max(ema_softmax, dim=1)
+        ps_large_p = pseudo_prob.ge(self.pseudo_threshold).long() == 1
+        ps_size = np.size(np.array(pseudo_label.cpu()))
+        pseudo_weight = torch.sum(ps_large_p).item() / ps_size
+        pseudo_weight = pseudo_weight * torch.ones(
+            pseudo_prob.shape, device=target_img.device)
+
+        if self.psweight_ignore_top > 0:
+            # Don't trust pseudo-labels in regions with potential
+            # rectification artifacts. This can lead to a pseudo-label
+            # drift from sky towards building or traffic light.
+            pseudo_weight[:, :self.psweight_ignore_top, :] = 0
+        if self.psweight_ignore_bottom > 0:
+            pseudo_weight[:, -self.psweight_ignore_bottom:, :] = 0
+
+        return ema_feats, pseudo_label, pseudo_weight
+
     def forward_train(self, img, img_metas, gt_semantic_seg, target_img,
-                      target_img_metas):
+                      target_img_metas, target_pixel_index=None):
         """Forward function for training.
 
         Args:
@@ -215,6 +267,8 @@ class FMDA(UDADecorator):
                 `daseg/datasets/pipelines/formatting.py:Collect`.
             gt_semantic_seg (Tensor): Semantic segmentation masks
                 used if the architecture supports semantic segmentation task.
+            target_pixel_index (Tensor, optional): Pixel index maps of the
+                target images, needed by the online pseudo labels.
 
         Returns:
             dict[str, Tensor]: a dictionary of loss components
@@ -245,9 +299,32 @@ class FMDA(UDADecorator):
             'std': stds[0].unsqueeze(0)
         }
 
-        # Train on source images
-        clean_losses = self.get_model().forward_train(
-            img, img_metas, gt_semantic_seg, return_feat=True, return_logits=True)
+        if self.fused_forward:
+            ema_feats, pseudo_label, pseudo_weight = self._get_pseudo_label(
+                target_img, target_img_metas, target_pixel_index, log_vars)
+            aug_trg_img, aug_trg_lbl = self.batch_strong_transform(
+                strong_parameters, data=target_img, target=pseudo_label)
+            aug_trg_lbl = aug_trg_lbl.unsqueeze(1)
+
+            # Train on source and augmented target images in one pass
+            clean_losses, trg_losses = self.get_model().forward_train_batches(
+                [
+                    dict(
+                        img=img,
+                        img_metas=img_metas,
+                        gt_semantic_seg=gt_semantic_seg),
+                    dict(
+                        img=aug_trg_img,
+                        img_metas=target_img_metas,
+                        gt_semantic_seg=aug_trg_lbl,
+                        seg_weight=pseudo_weight)
+                ],
+                return_feat=True,
+                return_logits=True)
+        else:
+            # Train on source images
+            clean_losses = self.get_model().forward_train(
+                img, img_metas, gt_semantic_seg, return_feat=True, return_logits=True)
         src_feat = clean_losses.pop('features')
 
         src_logits = clean_losses.pop('decode.logits')
@@ -266,7 +343,7 @@ class FMDA(UDADecorator):
         # ImageNet feature distance
         if self.enable_fdist:
             feat_loss, feat_log = self.calc_feat_dist(img, gt_semantic_seg,
-                                                      src_feat)
+                                                      src_feat, img_metas)
             # feat_loss.backward()
             total_loss += feat_loss
             log_vars.update(add_prefix(feat_log, 'src'))
@@ -279,72 +356,15 @@ class FMDA(UDADecorator):
                 grad_mag = calc_grad_magnitude(fd_grads)
                 mmcv.print_log(f'Fdist Grad.: {grad_mag}', 'daseg')
 
-        # Generate pseudo-label
-        for m in self.get_ema_model().modules():
-            if isinstance(m, _DropoutNd):
-                m.training = False
-            if isinstance(m, DropPath):
-                m.training = False
-        # ema_logits = self.get_ema_model().encode_decode(
-        #     target_img, target_img_metas)
-        ema_logits, ema_feats = self.get_ema_model().encode_decode(
-            target_img, target_img_metas, return_feats=True)
-
+        if not self.fused_forward:
+            ema_feats, pseudo_label, pseudo_weight = self._get_pseudo_label(
+                target_img, target_img_metas, target_pixel_index, log_vars)
+            aug_trg_img, aug_trg_lbl = self.batch_strong_transform(
+                strong_parameters, data=target_img, target=pseudo_label)
+            aug_trg_lbl = aug_trg_lbl.unsqueeze(1)
 
-        ema_softmax = torch.softmax(ema_logits.detach(), dim=1)
-        pseudo_prob, pseudo_label = torch.max(ema_softmax, dim=1)
-        ps_large_p = pseudo_prob.ge(self.pseudo_threshold).long() == 1
-        ps_size = np.size(np.array(pseudo_label.cpu()))
-        pseudo_weight = torch.sum(ps_large_p).item() / ps_size
-        pseudo_weight = pseudo_weight * torch.ones(
-            pseudo_prob.shape, device=dev)
-
-        if self.psweight_ignore_top > 0:
-            # Don't trust pseudo-labels in regions with potential
-            # rectification artifacts. This can lead to a pseudo-label
-            # drift from sky towards building or traffic light.
-            pseudo_weight[:, :self.psweight_ignore_top, :] = 0
-        if self.psweight_ignore_bottom > 0:
-            pseudo_weight[:, -self.psweight_ignore_bottom:, :] = 0
-        gt_pixel_weight = torch.ones((pseudo_weight.shape), device=dev)
-
-        # Apply mixing
-        # mixed_img, mixed_lbl = [None] * batch_size, [None] * batch_size
-        # mix_masks = get_class_masks(gt_semantic_seg)
-
-        # for i in range(batch_size):
-        #     strong_parameters['mix'] = mix_masks[i]
-        #     mixed_img[i], mixed_lbl[i] = strong_transform(
-        #         strong_parameters,
-        #         data=torch.stack((img[i], target_img[i])),
-        #         target=torch.stack((gt_semantic_seg[i][0], pseudo_label[i])))
-        #     _, pseudo_weight[i] = strong_transform(
-        #         strong_parameters,
-        #         target=torch.stack((gt_pixel_weight[i], pseudo_weight[i])))
-        # mixed_img = torch.cat(mixed_img)
-        # mixed_lbl = torch.cat(mixed_lbl)
-
-
-        # Train on mixed images
-        # mix_losses = self.get_model().forward_train(
-        #     mixed_img, img_metas, mixed_lbl, pseudo_weight, return_feat=True)
-        # mix_losses.pop('features')
-        # mix_losses = add_prefix(mix_losses, 'mix')
-        # mix_loss, mix_log_vars = self._parse_losses(mix_losses)
-        # log_vars.update(mix_log_vars)
-        # mix_loss.backward()
-
-        aug_trg_img, aug_trg_lbl = [None] * batch_size, [None] * batch_size
-        for i in range(batch_size):
-            aug_trg_img[i], aug_trg_lbl[i] = strong_transform(
-                strong_parameters,
-                data=target_img[i:i+1],
-                target=pseudo_label[i:i+1])
-        aug_trg_img = torch.cat(aug_trg_img)
-        aug_trg_lbl = torch.cat(aug_trg_lbl).unsqueeze(1)
-
-        trg_losses = self.get_model().forward_train(
-            aug_trg_img, target_img_metas, aug_trg_lbl, pseudo_weight, return_feat=True, return_logits=True)
+            trg_losses = self.get_model().forward_train(
+                aug_trg_img, target_img_metas, aug_trg_lbl, pseudo_weight, return_feat=True, return_logits=True)
         trg_logits = trg_losses.pop('decode.logits')
         trg_feats = trg_losses.pop('features')
         trg_losses = add_prefix(trg_losses, 'trg')
@@ -373,7 +393,7 @@ class FMDA(UDADecorator):
         # aux_losses.backward()
 
         total_loss += aux_losses
-        total_loss.backward()
+        self._backward(total_loss)
 
         vis_states.update({
             'vis|seg_mask_src': (img, gt_semantic_seg, src_logits.max(dim=1)[1].unsqueeze(1)),
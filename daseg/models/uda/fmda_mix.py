@@ -26,8 +26,9 @@ import torch.nn.functional as F
 from daseg.core import add_prefix
 from daseg.models import UDA, build_segmentor, builder
 from daseg.models.uda.uda_decorator import UDADecorator, get_module
-from daseg.models.utils.dacs_transforms import (denorm, get_class_masks,
-                                                get_mean_std, strong_transform)
+from daseg.models.utils.dacs_transforms import (BatchStrongTransform, denorm,
+                                                get_class_masks, get_mean_std)
+from daseg.models.utils.ema import EMAUpdater
 from daseg.models.utils.visualization import subplotimg
 from daseg.utils.utils import downscale_label_ratio
 
@@ -60,6 +61,7 @@ class FMDAMix(UDADecorator):
         self.local_iter = 0
         self.max_iters = cfg['max_iters']
         self.alpha = cfg['alpha']
+        self.ema = EMAUpdater(self.alpha, **cfg.get('ema_cfg', {}))
         self.pseudo_threshold = cfg['pseudo_threshold']
         self.psweight_ignore_top = cfg['pseudo_weight_ignore_top']
         self.psweight_ignore_bottom = cfg['pseudo_weight_ignore_bottom']
@@ -71,6 +73,9 @@ class FMDAMix(UDADecorator):
         self.blur = cfg['blur']
         self.color_jitter_s = cfg['color_jitter_strength']
         self.color_jitter_p = cfg['color_jitter_probability']
+        self.batch_strong_transform = BatchStrongTransform(
+            self.color_jitter_s, self.color_jitter_p,
+            seed=cfg.get('strong_transform_seed'))
         self.debug_img_interval = cfg['debug_img_interval']
         self.print_grad_magnitude = cfg['print_grad_magnitude']
         self.trg_loss_weight = cfg.get('trg_loss_weight', 1.)
@@ -103,28 +108,10 @@ class FMDAMix(UDADecorator):
         return get_module(self.imnet_model)
 
     def _init_ema_weights(self):
-        for param in self.get_ema_model().parameters():
-            param.detach_()
-        mp = list(self.get_model().parameters())
-        mcp = list(self.get_ema_model().parameters())
-        for i in range(0, len(mp)):
-            if not mcp[i].data.shape:  # scalar tensor
-                mcp[i].data = mp[i].data.clone()
-            else:
-                mcp[i].data[:] = mp[i].data[:].clone()
+        self.ema.init_weights(self.get_ema_model(), self.get_model())
 
     def _update_ema(self, iter):
-        alpha_teacher = min(1 - 1 / (iter + 1), self.alpha)
-        for ema_param, param in zip(self.get_ema_model().parameters(),
-                                    self.get_model().parameters()):
-            if not param.data.shape:  # scalar tensor
-                ema_param.data = \
-                    alpha_teacher * ema_param.data + \
-                    (1 - alpha_teacher) * param.data
-            else:
-                ema_param.data[:] = \
-                    alpha_teacher * ema_param[:].data[:] + \
-                    (1 - alpha_teacher) * param[:].data[:]
+        self.ema.update(self.get_ema_model(), self.get_model(), iter)
 
     def train_step(self, data_batch, optimizer, **kwargs):
         """The iteration step during training.
@@ -154,8 +141,9 @@ class FMDAMix(UDADecorator):
         """
 
         optimizer.zero_grad()
-        log_vars, vis_states = self(**data_batch)
-        optimizer.step()
+        with self._autocast():
+            log_vars, vis_states = self(**data_batch)
+        self._optimizer_step(optimizer, log_vars)
 
         log_vars.pop('loss', None)  # remove the unnecessary 'loss'
         outputs = dict(
@@ -274,7 +262,7 @@ class FMDAMix(UDADecorator):
         ema_logits, ema_feats = self.get_ema_model().encode_decode(
             target_img, target_img_metas, return_feats=True)
 
-        ema_softmax = torch.softmax(ema_logits.detach(), dim=1)
+        ema_softmax = torch.softmax(ema_logits.detach().float(), dim=1)
         pseudo_prob, pseudo_label = torch.max(ema_softmax, dim=1)
         ps_large_p = pseudo_prob.ge(self.pseudo_threshold).long() == 1
         ps_size = np.size(np.array(pseudo_label.cpu()))
@@ -291,28 +279,20 @@ class FMDAMix(UDADecorator):
         gt_pixel_weight = torch.ones((pseudo_weight.shape), device=dev)
 
         # Apply mixing
-        mixed_img, mixed_lbl = [None] * batch_size, [None] * batch_size
-        mixed_ema_feats = [None] * batch_size
         mix_masks = get_class_masks(gt_semantic_seg)
-
-        for i in range(batch_size):
-            strong_parameters['mix'] = mix_masks[i]
-            mixed_img[i], mixed_lbl[i] = strong_transform(
-                strong_parameters,
-                data=torch.stack((img[i], target_img[i])),
-                target=torch.stack((gt_semantic_seg[i][0], pseudo_label[i]))
-            )
-            _, pseudo_weight[i] = strong_transform(
-                strong_parameters,
-                target=torch.stack((gt_pixel_weight[i], pseudo_weight[i]))
-            )
-            _, mixed_ema_feats[i] = strong_transform(
-                strong_parameters,
-                target=torch.stack((src_feats[self.feat_level][i].detach(), ema_feats[self.feat_level][i]))
-            )
-        mixed_img = torch.cat(mixed_img)
-        mixed_lbl = torch.cat(mixed_lbl)
-        mixed_ema_feats = torch.cat(mixed_ema_feats)
+        strong_parameters['mix'] = mix_masks
+        mixed_img, mixed_lbl = self.batch_strong_transform(
+            strong_parameters,
+            data=torch.stack((img, target_img)),
+            target=torch.stack((gt_semantic_seg[:, 0], pseudo_label)))
+        _, pseudo_weight = self.batch_strong_transform(
+            strong_parameters,
+            target=torch.stack((gt_pixel_weight, pseudo_weight)))
+        pseudo_weight = pseudo_weight[:, 0]
+        _, mixed_ema_feats = self.batch_strong_transform(
+            strong_parameters,
+            target=torch.stack((src_feats[self.feat_level].detach(),
+                                ema_feats[self.feat_level])))
         mixed_ema_feats = [None] * self.feat_level + [mixed_ema_feats]
 
         # Train on mixed images
@@ -369,7 +349,7 @@ class FMDAMix(UDADecorator):
         # aux_losses.backward()
 
         total_loss += aux_losses
-        total_loss.backward()
+        self._backward(total_loss)
 
         vis_states.update({
             'vis|seg_mask_src': (img, gt_semantic_seg, src_logits.max(dim=1)[1].unsqueeze(1)),
@@ -3,11 +3,13 @@
 # Licensed under the Apache License, Version 2.0
 # ---------------------------------------------------------------
 
+from contextlib import contextmanager
 from copy import deepcopy
 
 from mmcv.parallel import MMDistributedDataParallel
 
 from daseg.models import BaseSegmentor, build_segmentor
+from daseg.models.utils.mixed_precision import MixedPrecision
 
 
 def get_module(module):
@@ -35,10 +37,35 @@ class UDADecorator(BaseSegmentor):
         self.train_cfg = cfg['model']['train_cfg']
         self.test_cfg = cfg['model']['test_cfg']
         self.num_classes = cfg['model']['decode_head']['num_classes']
+        mp_cfg = cfg.get('mixed_precision')
+        self.mixed_precision = MixedPrecision(
+            **mp_cfg) if mp_cfg is not None else None
 
     def get_model(self):
         return get_module(self.model)
 
+    @contextmanager
+    def _autocast(self):
+        """Context of the forward pass of the training step."""
+        if self.mixed_precision is None:
+            yield
+        else:
+            with self.mixed_precision.autocast(self):
+                yield
+
+    def _backward(self, loss, **kwargs):
+        if self.mixed_precision is None:
+            loss.backward(**kwargs)
+        else:
+            self.mixed_precision.backward(loss, **kwargs)
+
+    def _optimizer_step(self, optimizer, log_vars):
+        if self.mixed_precision is None:
+            optimizer.step()
+        else:
+            self.mixed_precision.step(optimizer)
+            log_vars.update(self.mixed_precision.get_log_vars())
+
     def extract_feat(self, img):
         """Extract features from images."""
         return self.get_model().extract_feat(img)
@@ -26,6 +26,117 @@ def strong_transform(param, data=None, target=None):
     return data, target
 
 
+class BatchStrongTransform(object):
+    """Batched :func:`strong_transform`, built once.
+
+    ClassMix, color jitter and Gaussian blur are applied to a whole batch at
+    once. As in the per-sample loop it replaces, whether the color jitter and
+    the blur are applied is decided once per batch by ``param``, and the
+    jitter factors and blur sigmas are drawn per sample. The blur is a
+    separable convolution with one kernel per sample, like
+    ``kornia.filters.GaussianBlur2d`` with reflect padding.
+
+    The ``param`` dict is the one of :func:`strong_transform`, with ``mix``
+    the list or the ``(B, 1, H, W)`` stack of the mix masks, but the jitter
+    strength and probability are the ones given at construction. With
+    mixing, ``data`` and ``target`` are the stacks ``(2, B, ...)`` of the
+    batches to mix, e.g. ``torch.stack((img, target_img))``, and the mixed
+    ``target`` has shape ``(B, 1, H, W)`` for ``(B, H, W)`` maps.
+
+    Args:
+        color_jitter_s (float | dict): Strength of the color jitter, or the
+            arguments of ``kornia.augmentation.ColorJitter``. Default: 0.25.
+        color_jitter_p (float): Threshold of ``param['color_jitter']`` above
+            which the color jitter is applied. Default: 0.2.
+        seed (int, optional): Seed of the random factors and sigmas, which
+            leaves the global random state untouched. Default: None.
+    """
+
+    def __init__(self, color_jitter_s=.25, color_jitter_p=.2, seed=None):
+        if isinstance(color_jitter_s, dict):
+            self.color_jitter = kornia.augmentation.ColorJitter(
+                **color_jitter_s)
+        else:
+            s = color_jitter_s
+            self.color_jitter = kornia.augmentation.ColorJitter(
+                brightness=s, contrast=s, saturation=s, hue=s)
+        self.color_jitter_p = color_jitter_p
+        self.rng = np.random.RandomState(seed) \
+            if seed is not None else np.random
+
+    def __call__(self, param, data=None, target=None):
+        assert ((data is not None) or (target is not None))
+        if param.get('mix') is not None:
+            data, target = self.one_mix(param['mix'], data, target)
+        if data is not None and data.shape[1] == 3:
+            if param['color_jitter'] > self.color_jitter_p:
+                data = self._color_jitter(data, param['mean'], param['std'])
+            if param['blur'] > 0.5:
+                data = self._gaussian_blur(data)
+        return data, target
+
+    @staticmethod
+    def one_mix(mask, data=None, target=None):
+        """Batched :func:`one_mix` of the stacks ``data`` and ``target``."""
+        if isinstance(mask, (list, tuple)):
+            mask = torch.cat(mask)
+        if data is not None:
+            data = mask * data[0] + (1 - mask) * data[1]
+        if target is not None:
+            if target.dim() == 3 + 1:
+                # (2, B, H, W) maps
+                target = target.unsqueeze(2)
+            H, W = mask.shape[-2:]
+            if target.shape[-2:] != (H, W):
+                target = F.interpolate(
+                    target.flatten(0, 1), (H, W)).view(
+                        *target.shape[:3], H, W)
+            target = mask * target[0] + (1 - mask) * target[1]
+        return data, target
+
+    def _call_seeded(self, fn, data):
+        if self.rng is np.random:
+            return fn(data)
+        devices = [data.device.index] if data.is_cuda else []
+        with torch.random.fork_rng(devices=devices):
+            torch.manual_seed(self.rng.randint(2**31))
+            return fn(data)
+
+    def _color_jitter(self, data, mean, std):
+        data = denorm(data, mean, std)
+        data = self._call_seeded(self.color_jitter, data)
+        renorm_(data, mean, std)
+        return data
+
+    def _gaussian_blur(self, data):
+        B, C, H, W = data.shape
+        sigmas = torch.as_tensor(
+            self.rng.uniform(0.15, 1.15, B),
+            dtype=data.dtype,
+            device=data.device)
+        # same kernel sizes as gaussian_blur
+        for dim, size in [(2, H), (3, W)]:
+            kernel_size = int(
+                np.floor(np.ceil(0.1 * size) - 0.5 + np.ceil(0.1 * size) % 2))
+            x = torch.arange(
+                kernel_size, dtype=data.dtype,
+                device=data.device) - kernel_size // 2
+            kernels = torch.exp(-x**2 / (2 * sigmas.view(B, 1)**2))
+            kernels = kernels / kernels.sum(1, keepdim=True)
+            kernels = kernels.repeat_interleave(C, dim=0).unsqueeze(1)
+            pad = [0, 0, kernel_size // 2, kernel_size // 2]
+            if dim == 2:
+                kernels = kernels.unsqueeze(3)
+            else:
+                kernels = kernels.unsqueeze(2)
+                pad = pad[2:] + pad[:2]
+            data = F.conv2d(
+                F.pad(data.reshape(1, B * C, H, W), pad, mode='reflect'),
+                kernels,
+                groups=B * C).view(B, C, H, W)
+        return data
+
+
 def get_mean_std(img_metas, dev):
     mean = [
         torch.as_tensor(img_metas[i]['img_norm_cfg']['mean'], device=dev)
@@ -91,15 +202,32 @@ def gaussian_blur(blur, data=None, target=None):
 
 
 def get_class_masks(labels):
-    class_masks = []
-    for label in labels:
-        classes = torch.unique(labels)
-        nclasses = classes.shape[0]
-        class_choice = np.random.choice(
-            nclasses, int((nclasses + nclasses % 2) / 2), replace=False)
-        classes = classes[torch.Tensor(class_choice).long()]
-        class_masks.append(generate_class_mask(label, classes).unsqueeze(0))
-    return class_masks
+    """Get the ClassMix masks of a batch of (B, 1, H, W) labels.
+
+    Half of the classes present in every label, rounded up, are chosen at
+    random and the mask of a label is 1 where it has one of them. The
+    classes of all labels are found with one bincount, and all masks are
+    gathered from a (B, num_values) lookup table at once.
+
+    Returns:
+        list[Tensor]: The (1, 1, H, W) mask of every label.
+    """
+    B = labels.shape[0]
+    flat = labels.reshape(B, -1).long()
+    num_values = int(flat.max()) + 1
+    # index of (sample, class) pairs in the lookup table
+    flat = flat + torch.arange(
+        B, device=flat.device).unsqueeze(1) * num_values
+    present = torch.bincount(
+        flat.view(-1), minlength=B * num_values).view(B, num_values) > 0
+    nclasses = present.sum(1, keepdim=True)
+    # a random permutation of the present classes of every sample
+    scores = torch.rand(B, num_values, device=labels.device)
+    scores[~present] = 2
+    ranks = scores.argsort(1).argsort(1)
+    lut = present & (ranks < (nclasses + nclasses % 2) // 2)
+    class_masks = lut.view(-1)[flat].view(labels.shape).long()
+    return list(class_masks.split(1))
 
 
 def generate_class_mask(label, classes):
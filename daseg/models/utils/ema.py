@@ -0,0 +1,79 @@
+import torch
+
+
+class EMAUpdater(object):
+    """Update the weights of an EMA teacher from its student in place.
+
+    The tensors of both models are collected once, and every update is one
+    multi-tensor ``torch._foreach_mul_`` and ``torch._foreach_add_`` over all
+    of them, instead of two kernels and two temporaries per parameter. The
+    teacher keeps the ``alpha_teacher = min(1 - 1 / (iter + 1), alpha)``
+    schedule of the per-parameter loop it replaces.
+
+    With ``update_buffers``, the floating point buffers, e.g. the running
+    statistics of the norm layers, are averaged like the parameters and the
+    other buffers, e.g. ``num_batches_tracked``, are copied. Otherwise the
+    buffers of the teacher are left untouched, as before.
+
+    With an ``interval`` k > 1, the teacher is only updated every k
+    iterations, with ``alpha_teacher ** k`` so that it averages over the
+    same number of iterations.
+
+    Args:
+        alpha (float): Maximal EMA decay.
+        update_buffers (bool): Whether to also average the buffers.
+            Default: False.
+        interval (int): Number of iterations between two updates.
+            Default: 1.
+    """
+
+    def __init__(self, alpha, update_buffers=False, interval=1):
+        self.alpha = alpha
+        self.update_buffers = update_buffers
+        self.interval = interval
+        self._tensors = None
+
+    def _get_tensors(self, ema_model, model):
+        if self._tensors is None:
+            ema_tensors = [p.data for p in ema_model.parameters()]
+            tensors = [p.data for p in model.parameters()]
+            ema_copy, copy = [], []
+            if self.update_buffers:
+                for ema_buf, buf in zip(ema_model.buffers(), model.buffers()):
+                    if buf.is_floating_point():
+                        ema_tensors.append(ema_buf)
+                        tensors.append(buf)
+                    else:
+                        ema_copy.append(ema_buf)
+                        copy.append(buf)
+            self._tensors = ema_tensors, tensors, ema_copy, copy
+        return self._tensors
+
+    @torch.no_grad()
+    def init_weights(self, ema_model, model):
+        """Copy the weights of ``model`` to ``ema_model``."""
+        for param in ema_model.parameters():
+            param.detach_()
+        ema_tensors, tensors, ema_copy, copy = self._get_tensors(
+            ema_model, model)
+        for ema_tensor, tensor in zip(ema_tensors + ema_copy, tensors + copy):
+            ema_tensor.copy_(tensor)
+
+    @torch.no_grad()
+    def update(self, ema_model, model, iter):
+        """Average the weights of ``model`` into ``ema_model`` at iteration
+        ``iter``."""
+        if iter % self.interval != 0:
+            return
+        alpha_teacher = min(1 - 1 / (iter + 1), self.alpha)**self.interval
+        ema_tensors, tensors, ema_copy, copy = self._get_tensors(
+            ema_model, model)
+        if hasattr(torch, '_foreach_mul_'):
+            torch._foreach_mul_(ema_tensors, alpha_teacher)
+            torch._foreach_add_(ema_tensors, tensors, alpha=1 - alpha_teacher)
+        else:
+            for ema_tensor, tensor in zip(ema_tensors, tensors):
+                ema_tensor.mul_(alpha_teacher).add_(
+                    tensor, alpha=1 - alpha_teacher)
+        for ema_tensor, tensor in zip(ema_copy, copy):
+            ema_tensor.copy_(tensor)
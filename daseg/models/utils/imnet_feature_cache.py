@@ -0,0 +1,69 @@
+import torch
+
+from daseg.utils import get_shared_cache
+
+
+class ImnetFeatureCache(object):
+    """Cache of the last stage features of the frozen ImageNet model.
+
+    The features of every source crop are stored as float16 in a
+    :class:`SharedArrayCache` under the ``aug_key`` of its image meta, which
+    :class:`DeterministicAug` adds to identify the image and its crop, flip,
+    scale and color augmentation. Crops without ``aug_key`` are never
+    cached. The features of the crops that are not cached are computed in
+    one batch and cached. The cache keeps the decoded features in
+    ``cache_dir``, by default in host memory, and evicts the least recently
+    used ones beyond ``max_bytes``. The ranks of a distributed run on a node
+    share the cache, so ``max_bytes`` is the budget of the node and the
+    crops cached by one rank are hits for the others.
+
+    The cached features are rounded to float16. The computed ones are
+    rounded as well, so that hits and misses agree, but the feature distance
+    loss therefore differs slightly from the one without the cache.
+
+    Args:
+        max_bytes (int): Byte budget of the cache per node.
+        name (str): Name of the cache. Default: 'imnet_feat'.
+        cache_dir (str): Directory of the cache, e.g. a local disk instead
+            of the default tmpfs. Default: '/dev/shm'.
+    """
+
+    def __init__(self, max_bytes, name='imnet_feat', cache_dir='/dev/shm'):
+        self.cache = get_shared_cache(name, max_bytes, cache_dir=cache_dir)
+
+    @torch.no_grad()
+    def extract_feat(self, model, img, img_metas):
+        """Get the last stage features of ``model`` for the batch ``img``.
+
+        Args:
+            model (nn.Module): The frozen segmentor.
+            img (Tensor): (N, 3, H, W) source images.
+            img_metas (list[dict]): Meta information of the images.
+
+        Returns:
+            Tensor: (N, C, h, w) features.
+        """
+        keys = [img_meta.get('aug_key') for img_meta in img_metas]
+        feats = [None] * len(keys)
+        for i, key in enumerate(keys):
+            if key is not None:
+                feat = self.cache.get(key)
+                if feat is not None:
+                    feats[i] = torch.from_numpy(feat).to(img.device)
+        misses = [i for i, feat in enumerate(feats) if feat is None]
+        if len(misses) > 0:
+            miss_feats = model.extract_feat(img[misses])[-1]
+            for i, feat in zip(misses, miss_feats):
+                feats[i] = feat.half()
+                if keys[i] is not None:
+                    self.cache.put(keys[i], feats[i].cpu().numpy())
+        dtype = miss_feats.dtype if len(misses) > 0 else img.dtype
+        return torch.stack([feat.to(dtype) for feat in feats])
+
+    def get_log_vars(self):
+        """Get the hit rate and the size in MB of the cache."""
+        stats = self.cache.get_stats()
+        return {
+            'imnet_cache.hit_rate': stats['hit_rate'],
+            'imnet_cache.mb': stats['bytes'] / 1024**2
+        }
@@ -0,0 +1,114 @@
+import functools
+from fnmatch import fnmatch
+
+import torch
+from mmcv.runner.fp16_utils import cast_tensor_type
+
+_DTYPES = dict(float16=torch.float16, bfloat16=torch.bfloat16)
+
+
+def _autocast(device_type, dtype, enabled=True):
+    if hasattr(torch, 'autocast'):
+        return torch.autocast(device_type, dtype=dtype, enabled=enabled)
+    # torch < 1.10 only autocasts CUDA to float16
+    assert device_type == 'cuda' and dtype == torch.float16, \
+        f'{dtype} autocast on {device_type} needs torch >= 1.10'
+    return torch.cuda.amp.autocast(enabled=enabled)
+
+
+class MixedPrecision(object):
+    """Autocast and loss scaling of the training step of a UDA decorator.
+
+    The UDA decorators run their whole forward pass, i.e. the student, the
+    EMA teacher and the ImageNet model, in :meth:`autocast`, and call the
+    backward passes and the optimizer step themselves. These go through
+    :meth:`backward` and :meth:`step`, which scale the loss and unscale the
+    gradients with a ``GradScaler`` for float16. bfloat16 has the range of
+    float32 and is not scaled by default. The parameters, the gradients
+    and the EMA update stay in float32.
+
+    The forward of the submodules whose names match one of
+    ``fp32_modules``, e.g. the losses, runs outside of autocast with its
+    float16 and bfloat16 inputs cast to float32.
+
+    Args:
+        dtype (str): 'float16' or 'bfloat16'. Default: 'float16'.
+        grad_scaler (dict | bool, optional): Arguments of the
+            ``GradScaler``, or False to disable it. Default: None, i.e. a
+            default ``GradScaler`` for float16 only.
+        fp32_modules (list[str]): ``fnmatch`` patterns of the names of the
+            modules to run in float32. Default: the decode head and auxiliary
+            losses.
+    """
+
+    def __init__(self,
+                 dtype='float16',
+                 grad_scaler=None,
+                 fp32_modules=('*.loss_decode', 'aux_losses.*')):
+        assert dtype in _DTYPES, f'Unsupported autocast dtype {dtype}'
+        self.dtype = _DTYPES[dtype]
+        if grad_scaler is None:
+            grad_scaler = self.dtype == torch.float16
+        if grad_scaler is True:
+            grad_scaler = dict()
+        self.grad_scaler_cfg = grad_scaler
+        self.fp32_modules = list(fp32_modules)
+        self.scaler = None
+        self.device_type = None
+
+    def _init(self, model):
+        self.device_type = next(model.parameters()).device.type
+        for name, module in model.named_modules():
+            if any(fnmatch(name, pattern) for pattern in self.fp32_modules):
+                module.forward = self._fp32_forward(module.forward)
+        if self.grad_scaler_cfg is not False:
+            if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+                self.scaler = torch.amp.GradScaler(self.device_type,
+                                                   **self.grad_scaler_cfg)
+            else:
+                self.scaler = torch.cuda.amp.GradScaler(
+                    **self.grad_scaler_cfg)
+
+    def _fp32_forward(self, forward):
+
+        @functools.wraps(forward)
+        def wrapper(*args, **kwargs):
+            for dtype in _DTYPES.values():
+                args = cast_tensor_type(args, dtype, torch.float32)
+                kwargs = cast_tensor_type(kwargs, dtype, torch.float32)
+            with _autocast(self.device_type, self.dtype, enabled=False):
+                return forward(*args, **kwargs)
+
+        return wrapper
+
+    def autocast(self, model):
+        """Get the autocast context of the forward pass of ``model``.
+
+        The modules of ``model`` are patched on the first call, once all of
+        them were built and moved to their device.
+        """
+        if self.device_type is None:
+            self._init(model)
+        return _autocast(self.device_type, self.dtype)
+
+    def backward(self, loss, **kwargs):
+        """Back-propagate the scaled ``loss`` outside of autocast."""
+        if self.scaler is not None:
+            loss = self.scaler.scale(loss)
+        with _autocast(self.device_type, self.dtype, enabled=False):
+            loss.backward(**kwargs)
+
+    def step(self, optimizer):
+        """Step ``optimizer`` with the unscaled gradients, skipping the steps
+        with infinite gradients, and update the loss scale."""
+        if self.scaler is None:
+            optimizer.step()
+            return
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
+    def get_log_vars(self):
+        """Get the loss scale."""
+        if self.scaler is None:
+            return {}
+        return {'loss_scale': self.scaler.get_scale()}
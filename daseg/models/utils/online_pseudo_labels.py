@@ -0,0 +1,155 @@
+import numpy as np
+import torch
+import torch.distributed as dist
+from mmcv.runner import get_dist_info
+
+from daseg.core import ClassEntropyHistogram
+from daseg.utils import (PIXEL_INDEX_OFFSET, OnlinePseudoLabelStore,
+                         PseudoLabelStore)
+
+
+class OnlinePseudoLabeler(object):
+    """Refresh the pseudo labels of the target images with the EMA teacher
+    predictions of the training iterations.
+
+    The argmax and entropy maps of the teacher logits of every target crop
+    are written back to the pixels of the image the crop was taken from, in
+    an :class:`OnlinePseudoLabelStore`. The pixels are located with the
+    ``pixel_index`` map of the :class:`AddPixelIndex` transform, which must
+    come right after the loading in the target pipeline. The per-class
+    entropy thresholds are computed from histograms that decay by
+    ``momentum`` every iteration, so they follow the teacher as it improves.
+    The target pipeline reads the refreshed labels by passing ``store_dir``
+    as ``updated_pseudo_labels_dir`` of
+    :class:`LoadAnnotationsPseudoLabelsV2`.
+
+    The store is created from the offline store in ``base_dir`` if it does
+    not exist yet. Its maps must have the full size of the target images,
+    like the pixel indices, i.e. be generated with ``down_scale=1``. An
+    image is copied from the offline store the first time it is refreshed,
+    before its crop pixels are overwritten. When resuming, the existing
+    store is refreshed further.
+
+    Args:
+        store_dir (str): Directory of the online store.
+        base_dir (str, optional): Directory of the offline
+            :class:`PseudoLabelStore` with full size ``pred`` and
+            ``entropy`` maps. Default: None.
+        ratios (list[float], optional): Ratios of the ``thre@{ratio}``
+            thresholds, by default the ones of the offline store.
+        momentum (float): Decay of the histograms per iteration.
+            Default: 0.999.
+        num_bins (int): Number of histogram bins per class. Default: 1000.
+        thre_interval (int): Number of iterations between two updates of the
+            stored thresholds. Default: 10.
+    """
+
+    def __init__(self,
+                 store_dir,
+                 base_dir=None,
+                 ratios=None,
+                 momentum=0.999,
+                 num_bins=1000,
+                 thre_interval=10):
+        self.momentum = momentum
+        self.num_bins = num_bins
+        self.thre_interval = thre_interval
+        self.base_store = PseudoLabelStore(base_dir) \
+            if base_dir is not None else None
+        self.rank, world_size = get_dist_info()
+        if self.rank == 0 and not OnlinePseudoLabelStore.exists(store_dir):
+            self._create_store(store_dir, ratios)
+        if world_size > 1:
+            dist.barrier()
+        self.store = OnlinePseudoLabelStore(store_dir, mode='r+')
+        self.hist = None
+        self.num_updates = 0
+
+    def _create_store(self, store_dir, ratios):
+        base = self.base_store
+        assert base is not None, \
+            f'{store_dir} does not exist, creating it needs the base_dir ' \
+            'of an offline pseudo label store'
+        assert base.has('pred') and base.has('entropy'), \
+            'The offline store must have pred and entropy maps'
+        if 'down_scale' in base.file['global']:
+            down_scale = float(base.get_global('down_scale'))
+            assert down_scale == 1, \
+                f'The online pseudo labels need the full size maps, but ' \
+                f'the offline store was generated with down_scale=' \
+                f'{down_scale}'
+        names = list(base.name_to_row)
+        thre_keys = [
+            key for key in base.file['global'] if key.startswith('thre@')
+        ]
+        if ratios is None:
+            ratios = [float(key[len('thre@'):]) for key in thre_keys]
+        store = OnlinePseudoLabelStore.create(
+            store_dir,
+            names,
+            shape=base.get(names[0], 'pred').shape,
+            num_classes=len(base.get_global(thre_keys[0])),
+            ratios=ratios)
+        store.set_thresholds(
+            {f'thre@{ratio}': base.get_global(f'thre@{ratio}')
+             for ratio in store.meta['ratios']})
+
+    def _init_row(self, name):
+        if self.base_store is not None and name in self.base_store:
+            self.store.set_row(name, self.base_store.get(name, 'pred'),
+                               self.base_store.get(name, 'entropy'))
+
+    def _update_thresholds(self):
+        counts = self.hist.hist.view(self.hist.num_classes, -1).sum(1)
+        thre_map = self.hist.get_thresholds(self.store.meta['ratios'])
+        for key, thres in thre_map.items():
+            # keep the thresholds of the classes that were not predicted
+            old = self.store.get_global(key)
+            thre_map[key] = np.where(counts.cpu().numpy() > 0, thres, old)
+        self.store.set_thresholds(thre_map)
+
+    @torch.no_grad()
+    def update(self, seg_logits, img_metas, pixel_index):
+        """Refresh the pseudo labels of a batch of target crops.
+
+        Args:
+            seg_logits (Tensor): (N, C, H, W) teacher logits of the crops.
+            img_metas (list[dict]): Meta information of the crops.
+            pixel_index (Tensor): (N, 1, H, W) pixel index maps of the crops.
+
+        Returns:
+            dict: The log variables.
+        """
+        preds, ent_maps = ClassEntropyHistogram.get_pred_entropy(
+            seg_logits.detach())
+        index = pixel_index[:, 0].long() - PIXEL_INDEX_OFFSET
+        valid = index >= 0
+        if self.hist is None:
+            self.hist = ClassEntropyHistogram(
+                seg_logits.shape[1],
+                self.num_bins,
+                device=seg_logits.device,
+                momentum=self.momentum)
+        self.hist.update_maps(preds[valid], ent_maps[valid], all_reduce=True)
+
+        preds = preds.to(torch.uint8).cpu().numpy()
+        ent_maps = ent_maps.half().cpu().numpy()
+        index = index.cpu().numpy()
+        valid = valid.cpu().numpy()
+        shape = tuple(self.store.meta['shape'])
+        for i, img_meta in enumerate(img_metas):
+            assert tuple(img_meta['ori_shape'][:2]) == shape, \
+                f'{img_meta["filename"]} has shape {img_meta["ori_shape"]}, ' \
+                f'but the online pseudo labels have shape {shape}'
+            name = img_meta['filename'].split('/')[-1].split('.')[0]
+            if name not in self.store:
+                self._init_row(name)
+            mask = valid[i]
+            self.store.update_pixels(name, index[i][mask], preds[i][mask],
+                                     ent_maps[i][mask])
+
+        self.num_updates += 1
+        if self.rank == 0 and self.num_updates % self.thre_interval == 0:
+            self._update_thresholds()
+        seen = len(self.store) / len(self.store.name_to_row)
+        return {'online_pl.seen': seen}
@@ -1,4 +1,9 @@
 from .encoding import Encoding
+from .neighborhood import (neighborhood_dot, neighborhood_sim,
+                           neighborhood_sq_dist, neighborhood_values)
 from .wrappers import Upsample, resize
 
-__all__ = ['Upsample', 'resize', 'Encoding']
+__all__ = [
+    'Upsample', 'resize', 'Encoding', 'neighborhood_dot', 'neighborhood_sim',
+    'neighborhood_sq_dist', 'neighborhood_values'
+]
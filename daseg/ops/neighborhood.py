@@ -0,0 +1,144 @@
+import torch
+import torch.nn.functional as F
+from torch.autograd.function import once_differentiable
+
+
+def _neighbor_slices(x, kernel_size, dilation):
+    """Yield the (B, C, H, W) maps of every dilated neighbor of the pixels of
+    ``x``, in the order of the ``nn.Unfold`` channels.
+
+    The maps are views of a single zero padded copy of ``x``, like the
+    padding of ``nn.Unfold(kernel_size, padding=kernel_size // 2 *
+    dilation, dilation=dilation)``.
+    """
+    assert kernel_size % 2 == 1, 'kernel_size must be odd'
+    H, W = x.shape[-2:]
+    pad = kernel_size // 2 * dilation
+    x_pad = F.pad(x, (pad, pad, pad, pad))
+    for i in range(kernel_size):
+        for j in range(kernel_size):
+            top, left = i * dilation, j * dilation
+            yield x_pad[..., top:top + H, left:left + W]
+
+
+def neighborhood_values(x, kernel_size, dilation=1):
+    """Get the values of the neighbors of every pixel.
+
+    Equal to ``nn.Unfold`` viewed as (B, C, k*k, H, W), for the small
+    channel counts of label or probability sum maps.
+
+    Args:
+        x (Tensor): (B, C, H, W) maps.
+        kernel_size (int): Odd size k of the neighborhood.
+        dilation (int): Dilation of the neighborhood. Default: 1.
+
+    Returns:
+        Tensor: (B, C, k*k, H, W) neighbor values.
+    """
+    return torch.stack(list(_neighbor_slices(x, kernel_size, dilation)), 2)
+
+
+def neighborhood_dot(x, y, kernel_size, dilation=1):
+    """Get the dot products over the channels between every pixel of ``x``
+    and each of its neighbors in ``y``.
+
+    Every neighbor is a shifted slice of ``y``, so only one (B, C, H, W)
+    product is alive at a time, instead of the (B, C * k*k, H * W) unfolded
+    maps, and the backward pass keeps ``x`` and the padded ``y``.
+
+    Args:
+        x (Tensor): (B, C, H, W) maps.
+        y (Tensor): (B, C, H, W) maps of the neighbors.
+        kernel_size (int): Odd size k of the neighborhood.
+        dilation (int): Dilation of the neighborhood. Default: 1.
+
+    Returns:
+        Tensor: (B, k*k, H, W) dot products, zero for the neighbors outside
+            of the maps.
+    """
+    return torch.stack([(x * y_shift).sum(dim=1) for y_shift in
+                        _neighbor_slices(y, kernel_size, dilation)], 1)
+
+
+class _NeighborhoodSqDist(torch.autograd.Function):
+    """Squared distances to the neighbors, with a backward pass that only
+    keeps the features."""
+
+    @staticmethod
+    def forward(ctx, feats, kernel_size, dilation):
+        ctx.save_for_backward(feats)
+        ctx.kernel_size = kernel_size
+        ctx.dilation = dilation
+        return torch.stack([((feats - neighbor)**2).sum(dim=1)
+                            for neighbor in _neighbor_slices(
+                                feats, kernel_size, dilation)], 1)
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_output):
+        feats, = ctx.saved_tensors
+        H, W = feats.shape[-2:]
+        pad = ctx.kernel_size // 2 * ctx.dilation
+        # the gradients of the neighbors, including the padding
+        grad_pad = feats.new_zeros(feats.shape[:-2] +
+                                   (H + 2 * pad, W + 2 * pad))
+        grad_feats = torch.zeros_like(feats)
+        neighbors = _neighbor_slices(feats, ctx.kernel_size, ctx.dilation)
+        for k, neighbor in enumerate(neighbors):
+            top = k // ctx.kernel_size * ctx.dilation
+            left = k % ctx.kernel_size * ctx.dilation
+            grad = 2 * (feats - neighbor) * grad_output[:, k:k + 1]
+            grad_feats += grad
+            grad_pad[..., top:top + H, left:left + W] -= grad
+        grad_feats += grad_pad[..., pad:pad + H, pad:pad + W]
+        return grad_feats, None, None
+
+
+def neighborhood_sq_dist(feats, kernel_size, dilation=1):
+    """Get the squared euclidean distances between the features of every
+    pixel and the ones of its neighbors.
+
+    The differences to every neighbor, a shifted slice of the features, are
+    squared and summed one neighbor at a time, which keeps the precision of
+    the ``nn.Unfold`` differences without their (B, C * k*k, H * W) maps.
+    The backward pass only keeps the features and recomputes the
+    differences. The neighbors outside of the maps are zero features, like
+    with ``nn.Unfold``.
+
+    Args:
+        feats (Tensor): (B, C, H, W) features.
+        kernel_size (int): Odd size k of the neighborhood.
+        dilation (int): Dilation of the neighborhood. Default: 1.
+
+    Returns:
+        Tensor: (B, k*k, H, W) squared distances.
+    """
+    return _NeighborhoodSqDist.apply(feats, kernel_size, dilation)
+
+
+def neighborhood_sim(feats, kernel_size, dilation=1, sim_type='gaussian',
+                     sigma=None, eps=1e-8):
+    """Get the similarities between the features of every pixel and the ones
+    of its neighbors.
+
+    Args:
+        feats (Tensor): (B, C, H, W) features.
+        kernel_size (int): Odd size k of the neighborhood.
+        dilation (int): Dilation of the neighborhood. Default: 1.
+        sim_type (str): 'gaussian' for ``exp(-d^2 / sigma^2)`` of the
+            squared distances d^2, or 'cosine'. Default: 'gaussian'.
+        sigma (float, optional): Bandwidth of the gaussian similarity.
+        eps (float): Minimal feature norm of the cosine similarity.
+            Default: 1e-8.
+
+    Returns:
+        Tensor: (B, k*k, H, W) similarities.
+    """
+    if sim_type == 'gaussian':
+        sq_dist = neighborhood_sq_dist(feats, kernel_size, dilation)
+        return torch.exp(-sq_dist / sigma**2)
+    elif sim_type == 'cosine':
+        feats = F.normalize(feats, dim=1, eps=eps)
+        return neighborhood_dot(feats, feats, kernel_size, dilation)
+    else:
+        raise ValueError(f'Unknown sim_type {sim_type}')
@@ -1,4 +1,17 @@
+from .async_writer import AsyncWriter
 from .collect_env import collect_env
 from .logger import get_root_logger
+from .online_pseudo_label_store import (PIXEL_INDEX_OFFSET,
+                                        OnlinePseudoLabelStore)
+from .packed_shards import (PackedShardReader, PackedShardWriter,
+                            get_packed_reader)
+from .pseudo_label_store import PseudoLabelStore
+from .shared_cache import (SharedArrayCache, get_shared_cache,
+                           get_shared_caches)
 
-__all__ = ['get_root_logger', 'collect_env']
+__all__ = [
+    'get_root_logger', 'collect_env', 'SharedArrayCache', 'get_shared_cache',
+    'get_shared_caches', 'PackedShardWriter', 'PackedShardReader',
+    'get_packed_reader', 'PseudoLabelStore', 'AsyncWriter',
+    'OnlinePseudoLabelStore', 'PIXEL_INDEX_OFFSET'
+]
@@ -0,0 +1,77 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncWriter(object):
+    """Run write jobs in a thread pool with a bounded number of pending jobs.
+
+    :meth:`submit` blocks while ``max_pending`` jobs are queued or running,
+    so the memory held by pending jobs stays bounded when the producer is
+    faster than the disk. :meth:`flush` waits until every submitted job has
+    finished and re-raises the first error of a job. With ``num_workers=0``
+    the jobs run synchronously in :meth:`submit`. Used as a context manager,
+    the writer is closed on exit, also when the producer raises, in which
+    case the error of the producer takes precedence over the ones of the
+    jobs.
+
+    Args:
+        num_workers (int): Number of writer threads. Default: 2.
+        max_pending (int): Maximal number of queued or running jobs.
+            Default: 8.
+    """
+
+    def __init__(self, num_workers=2, max_pending=8):
+        self.num_workers = num_workers
+        self._pool = ThreadPoolExecutor(
+            num_workers) if num_workers > 0 else None
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._futures = []
+        self._error = None
+
+    def _run(self, fn, args, kwargs):
+        try:
+            fn(*args, **kwargs)
+        except BaseException as e:
+            if self._error is None:
+                self._error = e
+            raise
+        finally:
+            self._slots.release()
+
+    def submit(self, fn, *args, **kwargs):
+        """Run ``fn(*args, **kwargs)`` in a writer thread."""
+        if self._error is not None:
+            raise self._error
+        if self._pool is None:
+            fn(*args, **kwargs)
+            return
+        self._slots.acquire()
+        self._futures.append(self._pool.submit(self._run, fn, args, kwargs))
+
+    def flush(self):
+        """Wait for all submitted jobs."""
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.exception()
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        """Flush and stop the writer threads."""
+        try:
+            self.flush()
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        try:
+            self.close()
+        except Exception:
+            pass
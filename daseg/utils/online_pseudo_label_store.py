@@ -0,0 +1,134 @@
+import json
+import os
+import os.path as osp
+
+import numpy as np
+
+META_FILENAME = 'online_meta.json'
+# offset of the pixel indices added by the AddPixelIndex transform
+PIXEL_INDEX_OFFSET = 256
+
+
+class OnlinePseudoLabelStore(object):
+    """Pseudo labels refreshed in place during training.
+
+    The uint8 ``pred`` and float16 ``entropy`` maps of all images are rows of
+    two ``(N, H, W)`` ``.npy`` files, the per-class ``thre@{ratio}``
+    thresholds rows of a ``(R, num_classes)`` file, and ``seen`` flags the
+    rows that were written at least once. All of them are memory mapped, so
+    the rows written by the training process are visible right away to the
+    dataloader workers reading the store, without reopening any file. The
+    read methods are the ones of :class:`PseudoLabelStore`, except that an
+    image is only contained in the store once its row was written, and that
+    the thresholds are not cached.
+
+    Args:
+        path (str): Directory of the store.
+        mode (str): 'r' to read, 'r+' to also write. Default: 'r'.
+    """
+
+    def __init__(self, path, mode='r'):
+        assert mode in ('r', 'r+')
+        self.path = path
+        self.mode = mode
+        with open(osp.join(path, META_FILENAME), 'r') as f:
+            self.meta = json.load(f)
+        self.name_to_row = {
+            name: row
+            for row, name in enumerate(self.meta['names'])
+        }
+        self.ratio_to_row = {
+            ratio: row
+            for row, ratio in enumerate(self.meta['ratios'])
+        }
+        self._arrays = None
+        self._pid = None
+
+    @classmethod
+    def create(cls, path, names, shape, num_classes, ratios):
+        """Create an empty store for the images ``names`` whose pseudo labels
+        have shape ``shape``, and open it for writing."""
+        os.makedirs(path, exist_ok=True)
+        num = len(names)
+        for key, dtype, array_shape in [
+            ('pred', np.uint8, (num, *shape)),
+            ('entropy', np.float16, (num, *shape)),
+            ('seen', np.uint8, (num, )),
+            ('thresholds', np.float32, (len(ratios), num_classes)),
+        ]:
+            np.lib.format.open_memmap(
+                osp.join(path, f'{key}.npy'),
+                mode='w+',
+                dtype=dtype,
+                shape=array_shape).flush()
+        # pixels that were never written are ignored
+        entropy = np.load(osp.join(path, 'entropy.npy'), mmap_mode='r+')
+        entropy.fill(np.inf)
+        entropy.flush()
+        with open(osp.join(path, META_FILENAME), 'w') as f:
+            json.dump(
+                dict(
+                    names=list(names),
+                    shape=list(shape),
+                    num_classes=num_classes,
+                    ratios=[float(ratio) for ratio in ratios]), f)
+        return cls(path, mode='r+')
+
+    @staticmethod
+    def exists(path):
+        return osp.isfile(osp.join(path, META_FILENAME))
+
+    @property
+    def arrays(self):
+        if self._arrays is None or self._pid != os.getpid():
+            self._arrays = {
+                key: np.load(
+                    osp.join(self.path, f'{key}.npy'), mmap_mode=self.mode)
+                for key in ('pred', 'entropy', 'seen', 'thresholds')
+            }
+            self._pid = os.getpid()
+        return self._arrays
+
+    def __len__(self):
+        return int(self.arrays['seen'].sum())
+
+    def __contains__(self, name):
+        row = self.name_to_row.get(name)
+        return row is not None and bool(self.arrays['seen'][row])
+
+    def has(self, key):
+        return key in ('pred', 'entropy')
+
+    def get(self, name, key):
+        return np.array(self.arrays[key][self.name_to_row[name]])
+
+    def get_global(self, key):
+        assert key.startswith('thre@'), f'{key} is not stored'
+        ratio = float(key[len('thre@'):])
+        return np.array(self.arrays['thresholds'][self.ratio_to_row[ratio]])
+
+    def set_row(self, name, pred, entropy):
+        """Overwrite the whole row of image ``name``."""
+        row = self.name_to_row[name]
+        self.arrays['pred'][row] = pred
+        self.arrays['entropy'][row] = entropy
+        self.arrays['seen'][row] = 1
+
+    def update_pixels(self, name, index, pred, entropy):
+        """Overwrite the pixels of image ``name`` at the flat ``index``."""
+        row = self.name_to_row[name]
+        self.arrays['pred'][row].reshape(-1)[index] = pred
+        self.arrays['entropy'][row].reshape(-1)[index] = entropy
+        self.arrays['seen'][row] = 1
+
+    def set_thresholds(self, thre_map):
+        """Set the thresholds from a ``thre@{ratio}`` dict."""
+        for ratio, row in self.ratio_to_row.items():
+            self.arrays['thresholds'][row] = thre_map[f'thre@{ratio}']
+
+    def __getstate__(self):
+        # memory maps are reopened in every worker
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        state['_pid'] = None
+        return state
@@ -0,0 +1,139 @@
+import json
+import os
+import os.path as osp
+
+import numpy as np
+
+_READERS = {}
+
+
+class PackedShardWriter(object):
+    """Write decoded numpy arrays into large flat shard files.
+
+    Every array is appended as raw C-contiguous bytes, aligned to
+    ``ALIGNMENT`` bytes, to the current shard ``shard_{i:05d}.bin``. A new
+    shard is started when the current one would grow beyond ``shard_bytes``.
+    On :meth:`close`, a fixed-width structured index sorted by key is saved to
+    ``index.npy`` so that :class:`PackedShardReader` finds an array with a
+    binary search instead of a python dict.
+
+    Args:
+        out_dir (str): Directory of the shards and the index.
+        shard_bytes (int): Maximal size of a shard. Default: 1 GiB.
+        meta (dict, optional): Extra information stored in ``meta.json``.
+    """
+
+    ALIGNMENT = 64
+    MAX_NDIM = 4
+
+    def __init__(self, out_dir, shard_bytes=1024**3, meta=None):
+        self.out_dir = out_dir
+        self.shard_bytes = shard_bytes
+        self.meta = dict(meta) if meta is not None else dict()
+        os.makedirs(out_dir, exist_ok=True)
+        self._records = []
+        self._shard_id = -1
+        self._shard = None
+        self._offset = 0
+
+    def _next_shard(self):
+        if self._shard is not None:
+            self._shard.close()
+        self._shard_id += 1
+        self._shard = open(
+            osp.join(self.out_dir, f'shard_{self._shard_id:05d}.bin'), 'wb')
+        self._offset = 0
+
+    def add(self, key, array):
+        """Append ``array`` under ``key``."""
+        array = np.ascontiguousarray(array)
+        assert array.ndim <= self.MAX_NDIM, \
+            f'arrays with more than {self.MAX_NDIM} dims are not supported'
+        if self._shard is None or (self._offset > 0 and self._offset +
+                                   array.nbytes > self.shard_bytes):
+            self._next_shard()
+        shape = np.zeros(self.MAX_NDIM, dtype=np.int64)
+        shape[:array.ndim] = array.shape
+        self._records.append((key.encode(), self._shard_id, self._offset,
+                              array.nbytes, array.dtype.str, array.ndim,
+                              shape))
+        self._shard.write(array.tobytes())
+        self._offset += array.nbytes
+        pad = -self._offset % self.ALIGNMENT
+        if pad:
+            self._shard.write(b'\0' * pad)
+            self._offset += pad
+
+    def close(self):
+        """Finish the last shard and write the index."""
+        if self._shard is not None:
+            self._shard.close()
+            self._shard = None
+        key_len = max([len(r[0]) for r in self._records], default=1)
+        index = np.array(
+            self._records,
+            dtype=[('key', f'S{key_len}'), ('shard', np.int32),
+                   ('offset', np.int64), ('nbytes', np.int64),
+                   ('dtype', 'S8'), ('ndim', np.int8),
+                   ('shape', np.int64, (self.MAX_NDIM, ))])
+        index = index[np.argsort(index['key'], kind='stable')]
+        assert len(np.unique(index['key'])) == len(index), \
+            'keys of packed arrays must be unique'
+        np.save(osp.join(self.out_dir, 'index.npy'), index)
+        meta = dict(
+            self.meta,
+            num_arrays=len(index),
+            num_shards=self._shard_id + 1)
+        with open(osp.join(self.out_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+
+class PackedShardReader(object):
+    """Read arrays written by :class:`PackedShardWriter` as zero-copy views.
+
+    The shards are memory-mapped copy-on-write on first access in each
+    process, so dataloader workers share the page cache and in-place writes
+    of the pipeline stay private to the reader.
+
+    Args:
+        packed_dir (str): Directory of the shards and the index.
+    """
+
+    def __init__(self, packed_dir):
+        self.packed_dir = packed_dir
+        self.index = np.load(osp.join(packed_dir, 'index.npy'))
+        with open(osp.join(packed_dir, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def _get_shard(self, shard_id):
+        if shard_id not in self._shards:
+            self._shards[shard_id] = np.memmap(
+                osp.join(self.packed_dir, f'shard_{shard_id:05d}.bin'),
+                dtype=np.uint8,
+                mode='c')
+        return self._shards[shard_id]
+
+    def get(self, key):
+        """Get the array packed under ``key`` or None if there is none."""
+        key = key.encode()
+        i = int(np.searchsorted(self.index['key'], key))
+        if i == len(self.index) or self.index['key'][i] != key:
+            return None
+        record = self.index[i]
+        shard = self._get_shard(int(record['shard']))
+        offset = int(record['offset'])
+        buf = shard[offset:offset + int(record['nbytes'])]
+        shape = tuple(record['shape'][:int(record['ndim'])])
+        return np.asarray(buf).view(record['dtype'].decode()).reshape(shape)
+
+
+def get_packed_reader(packed_dir):
+    """Get the :class:`PackedShardReader` of ``packed_dir``, sharing it
+    between the loaders of a process."""
+    if packed_dir not in _READERS:
+        _READERS[packed_dir] = PackedShardReader(packed_dir)
+    return _READERS[packed_dir]
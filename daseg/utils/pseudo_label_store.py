@@ -0,0 +1,192 @@
+import os
+import os.path as osp
+import threading
+
+import h5py
+import numpy as np
+
+STORE_FILENAME = 'pseudo_labels.h5'
+
+
+class PseudoLabelStore(object):
+    """Single HDF5 container of the pseudo labels of a target dataset.
+
+    Every per-image array, e.g. ``seg_logits`` or ``feat_{i}``, is a row of
+    one dataset of shape ``(N, *shape)`` in the ``samples`` group, chunked by
+    row so that reading the array of an image is a single random access.
+    The image names are stored in ``names`` in row order. Arrays shared by
+    all images, such as the ``thre@{ratio}`` class thresholds and the
+    similarity sigmas, are stored once in the ``global`` group. Besides or
+    instead of the logits, the pseudo labeling hook stores the uint8
+    ``pred`` argmax and the float16 ``entropy`` maps, so that loading a
+    pseudo label needs no softmax.
+
+    In distributed generation, every rank writes the rows of its images to
+    its own part file ``pseudo_labels.part{rank:03d}.h5`` and rank 0 writes
+    the global arrays and the list of parts to ``pseudo_labels.h5``. Reading
+    a store works the same whether it has parts or not.
+
+    The files are opened lazily and reopened after a fork, so every
+    dataloader worker keeps its own open handles.
+
+    Args:
+        path (str): Path of the container, or of a directory holding
+            ``pseudo_labels.h5``.
+        mode (str): 'r' to read, 'w' to create a new container. Default: 'r'.
+        compression (str, optional): HDF5 compression filter of new
+            datasets, e.g. 'lzf' or 'gzip'. Default: None.
+        part (int, optional): Index of the part to write. Default: None.
+    """
+
+    def __init__(self, path, mode='r', compression=None, part=None):
+        if osp.isdir(path) or not path.endswith('.h5'):
+            path = osp.join(path, STORE_FILENAME)
+        if part is not None:
+            path = path[:-len('.h5')] + f'.part{part:03d}.h5'
+        assert mode in ('r', 'w')
+        self.path = path
+        self.mode = mode
+        self.compression = compression
+        self._file = None
+        self._pid = None
+        self._part_files = None
+        self._name_to_row = None
+        self._global_cache = {}
+        # rows may be added from several writer threads
+        self._lock = threading.Lock()
+        if mode == 'w':
+            os.makedirs(osp.dirname(path) or '.', exist_ok=True)
+            self._open()
+            self.file.create_dataset(
+                'names', (0, ),
+                maxshape=(None, ),
+                dtype=h5py.string_dtype())
+            self.file.create_group('samples')
+            self.file.create_group('global')
+
+    @staticmethod
+    def exists(path):
+        """Whether ``path`` is a container or a directory holding one."""
+        return osp.isfile(path) or osp.isfile(osp.join(path, STORE_FILENAME))
+
+    def _open(self):
+        self._file = h5py.File(self.path, self.mode)
+        self._pid = os.getpid()
+        self._part_files = None
+
+    @property
+    def file(self):
+        if self._file is None or self._pid != os.getpid():
+            self._open()
+        return self._file
+
+    @property
+    def sample_files(self):
+        """The files holding the rows, the parts if there are any."""
+        file = self.file
+        if self._part_files is None:
+            if 'parts' in file.attrs:
+                self._part_files = [
+                    h5py.File(osp.join(osp.dirname(self.path), part), 'r')
+                    for part in file.attrs['parts']
+                ]
+            else:
+                self._part_files = [file]
+        return self._part_files
+
+    @property
+    def name_to_row(self):
+        """Map from image name to the file index and the row."""
+        if self._name_to_row is None:
+            self._name_to_row = {}
+            for i, file in enumerate(self.sample_files):
+                for row, name in enumerate(file['names'][:]):
+                    name = name.decode() if isinstance(name, bytes) else name
+                    self._name_to_row[name] = (i, row)
+        return self._name_to_row
+
+    def __len__(self):
+        return len(self.name_to_row)
+
+    def __contains__(self, name):
+        return name in self.name_to_row
+
+    def add(self, name, **arrays):
+        """Append the arrays of image ``name`` as a new row."""
+        with self._lock:
+            self._add(name, arrays)
+
+    def _add(self, name, arrays):
+        samples = self.file['samples']
+        row = len(self.file['names'])
+        for key, array in arrays.items():
+            array = np.asarray(array)
+            if key not in samples:
+                samples.create_dataset(
+                    key, (0, *array.shape),
+                    maxshape=(None, *array.shape),
+                    dtype=array.dtype,
+                    chunks=(1, *array.shape),
+                    compression=self.compression)
+            dataset = samples[key]
+            assert dataset.shape[1:] == array.shape, \
+                f'{key} of {name} has shape {array.shape}, but the ' \
+                f'store holds arrays of shape {dataset.shape[1:]}'
+            dataset.resize(row + 1, axis=0)
+            dataset[row] = array
+        self.file['names'].resize(row + 1, axis=0)
+        self.file['names'][row] = name
+        if self._name_to_row is not None:
+            self._name_to_row[name] = (0, row)
+
+    def set_parts(self, num_parts):
+        """Point the store to the part files written by ``num_parts``
+        ranks."""
+        name = osp.basename(self.path)[:-len('.h5')]
+        self.file.attrs['parts'] = [
+            f'{name}.part{part:03d}.h5' for part in range(num_parts)
+        ]
+
+    def set_global(self, key, value):
+        """Store ``value`` under ``key`` once for all images."""
+        group = self.file['global']
+        if key in group:
+            del group[key]
+        group.create_dataset(key, data=np.asarray(value))
+
+    def get_global(self, key):
+        """Get the array stored once under ``key``."""
+        if key not in self._global_cache:
+            self._global_cache[key] = self.file['global'][key][()]
+        return self._global_cache[key]
+
+    def has(self, key):
+        """Whether the store holds the per-image array ``key``."""
+        return key in self.sample_files[0]['samples']
+
+    def get(self, name, key):
+        """Get the array ``key`` of image ``name``."""
+        i, row = self.name_to_row[name]
+        return self.sample_files[i]['samples'][key][row]
+
+    def close(self):
+        if self._file is not None and self._pid == os.getpid():
+            for file in self._part_files or []:
+                if file is not self._file:
+                    file.close()
+            self._file.close()
+        self._file = None
+        self._part_files = None
+
+    def __getstate__(self):
+        # h5py handles cannot be pickled, workers reopen the files
+        state = self.__dict__.copy()
+        state['_file'] = None
+        state['_pid'] = None
+        state['_part_files'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
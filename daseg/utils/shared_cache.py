@@ -0,0 +1,194 @@
+import atexit
+import fcntl
+import hashlib
+import os
+import os.path as osp
+import shutil
+from contextlib import contextmanager
+
+import numpy as np
+
+_CACHES = {}
+
+
+def _get_run_id():
+    """Identify the run of this process, so that the ranks of a distributed
+    run on a node share their caches."""
+    if 'MASTER_PORT' in os.environ:
+        # the ranks of a node are the children of the same launcher
+        return f'{os.getppid()}_{os.environ["MASTER_PORT"]}'
+    return str(os.getpid())
+
+
+class SharedArrayCache(object):
+    """LRU cache of decoded numpy arrays shared between processes.
+
+    Arrays are stored as ``.npy`` files in a tmpfs directory and read back
+    memory-mapped copy-on-write, so a hit costs neither a decode nor a copy
+    and in-place writes of the pipeline stay private to the reader. The byte
+    count and the hit/miss/eviction counters are memory-mapped from a file
+    of the cache directory, guarded by a ``flock`` on another one. The cache
+    is therefore fully described by its directory: it is shared by the
+    dataloader workers whether they are forked or spawned, and by the
+    persistent workers that unpickle their pipeline again. The directory is
+    named after the run rather than the process, so the ranks of a
+    distributed run on a node also share the cache and its budget: the
+    cache holds at most ``max_bytes`` per node, whatever the number of
+    ranks, and every rank hits the samples cached by the others. When the
+    cache grows beyond ``max_bytes``, the least recently used files are
+    evicted down to ``low_watermark * max_bytes``. The directory is removed
+    by the first local rank at exit.
+
+    Args:
+        name (str): Name of the cache, used in the directory name and logs.
+        max_bytes (int): Byte budget of the cache.
+        cache_dir (str): Directory to create the cache in. Default:
+            '/dev/shm'.
+        low_watermark (float): Fraction of ``max_bytes`` to evict down to.
+            Default: 0.9.
+    """
+
+    HITS, MISSES, EVICTIONS, BYTES = range(4)
+
+    def __init__(self, name, max_bytes, cache_dir='/dev/shm',
+                 low_watermark=0.9):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.low_watermark = low_watermark
+        self.cache_dir = osp.join(cache_dir,
+                                  f'daseg_cache_{name}_{_get_run_id()}')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        counters_path = osp.join(self.cache_dir, 'counters')
+        tmp_path = f'{counters_path}.{os.getpid()}.tmp'
+        np.zeros(4, dtype=np.int64).tofile(tmp_path)
+        try:
+            # atomically create the counters unless another process did
+            os.link(tmp_path, counters_path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+        # the other processes using the cache may outlive this one
+        self._owner = os.getpid() if int(os.environ.get(
+            'LOCAL_RANK', 0)) == 0 else None
+        self._open()
+        atexit.register(self._cleanup)
+
+    def _open(self):
+        self._counters = np.memmap(
+            osp.join(self.cache_dir, 'counters'),
+            dtype=np.int64,
+            mode='r+',
+            shape=(4, ))
+        self._lock_file = None
+        self._lock_pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_counters'], state['_lock_file'], state['_lock_pid']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    @contextmanager
+    def _lock(self):
+        # a flock is held by the open file, so every process opens its own
+        if self._lock_pid != os.getpid():
+            self._lock_file = open(osp.join(self.cache_dir, 'lock'), 'a')
+            self._lock_pid = os.getpid()
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _cleanup(self):
+        if os.getpid() == self._owner:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def _get_path(self, key):
+        return osp.join(self.cache_dir,
+                        hashlib.sha1(key.encode()).hexdigest() + '.npy')
+
+    def get(self, key):
+        """Get the array cached under ``key`` or None on a miss."""
+        path = self._get_path(key)
+        try:
+            array = np.load(path, mmap_mode='c')
+        except FileNotFoundError:
+            with self._lock():
+                self._counters[self.MISSES] += 1
+            return None
+        try:
+            # mark as recently used for the LRU eviction
+            os.utime(path)
+        except FileNotFoundError:
+            # evicted meanwhile, the mapping stays valid
+            pass
+        with self._lock():
+            self._counters[self.HITS] += 1
+        return np.asarray(array)
+
+    def put(self, key, array):
+        """Cache ``array`` under ``key``, evicting old entries if needed."""
+        if array.nbytes > self.max_bytes:
+            return
+        path = self._get_path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.save(f, array)
+        except FileNotFoundError:
+            # removed at the exit of the first local rank
+            return
+        size = osp.getsize(tmp_path)
+        with self._lock():
+            if osp.exists(path):
+                os.remove(tmp_path)
+                return
+            os.replace(tmp_path, path)
+            self._counters[self.BYTES] += size
+            if self._counters[self.BYTES] > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Remove the least recently used entries, with the lock held."""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npy'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        target = self.max_bytes * self.low_watermark
+        for _, size, path in sorted(entries):
+            if self._counters[self.BYTES] <= target:
+                break
+            os.remove(path)
+            self._counters[self.BYTES] -= size
+            self._counters[self.EVICTIONS] += 1
+
+    def get_stats(self):
+        """Get the hit, miss and eviction counters and the cached bytes."""
+        with self._lock():
+            hits, misses, evictions, nbytes = self._counters.tolist()
+        return dict(
+            hits=hits,
+            misses=misses,
+            evictions=evictions,
+            bytes=nbytes,
+            hit_rate=hits / max(hits + misses, 1))
+
+
+def get_shared_cache(name, max_bytes, cache_dir='/dev/shm', **kwargs):
+    """Get the :class:`SharedArrayCache` called ``name``, creating it on the
+    first call so that loaders configured with the same name share it."""
+    if name not in _CACHES:
+        _CACHES[name] = SharedArrayCache(
+            name, max_bytes, cache_dir=cache_dir, **kwargs)
+    return _CACHES[name]
+
+
+def get_shared_caches():
+    """Get all caches created in this process, by name."""
+    return dict(_CACHES)
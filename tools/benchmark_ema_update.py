@@ -0,0 +1,70 @@
+import argparse
+import copy
+import time
+
+import torch
+
+from daseg.models.backbones.mix_transformer import mit_b5
+from daseg.models.utils.ema import EMAUpdater
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the EMA teacher update on a MiT-B5 against '
+        'the per-parameter loop')
+    parser.add_argument(
+        '--iters', type=int, default=20, help='number of updates')
+    parser.add_argument('--alpha', type=float, default=0.999)
+    parser.add_argument('--device', default='cpu')
+    return parser.parse_args()
+
+
+def loop_update(ema_model, model, iter, alpha):
+    """The loop used by the UDA decorators before."""
+    alpha_teacher = min(1 - 1 / (iter + 1), alpha)
+    for ema_param, param in zip(ema_model.parameters(), model.parameters()):
+        if not param.data.shape:  # scalar tensor
+            ema_param.data = \
+                alpha_teacher * ema_param.data + \
+                (1 - alpha_teacher) * param.data
+        else:
+            ema_param.data[:] = \
+                alpha_teacher * ema_param[:].data[:] + \
+                (1 - alpha_teacher) * param[:].data[:]
+
+
+def main():
+    args = parse_args()
+    model = mit_b5().to(args.device)
+    ref_model = copy.deepcopy(model)
+    ema_model = copy.deepcopy(model)
+    num_params = sum(1 for _ in model.parameters())
+    num_elements = sum(p.numel() for p in model.parameters())
+    print(f'{num_params} parameters, {num_elements / 1e6:.1f}M elements')
+
+    ema = EMAUpdater(args.alpha)
+    ema.init_weights(ema_model, model)
+    ref_model.load_state_dict(ema_model.state_dict())
+    # perturb the student so that the teachers change
+    with torch.no_grad():
+        for p in model.parameters():
+            p.add_(torch.randn_like(p), alpha=1e-2)
+    for name, fn in [
+        ('loop', lambda i: loop_update(ref_model, model, i, args.alpha)),
+        ('foreach', lambda i: ema.update(ema_model, model, i)),
+    ]:
+        start = time.perf_counter()
+        for i in range(1, args.iters + 1):
+            fn(i)
+        if args.device != 'cpu':
+            torch.cuda.synchronize()
+        elapsed = (time.perf_counter() - start) / args.iters
+        print(f'{name}: {elapsed * 1e3:.1f} ms per update')
+    max_diff = max((p - q).abs().max().item() for p, q in zip(
+        ref_model.parameters(), ema_model.parameters()))
+    print(f'max abs diff of the teachers: {max_diff:.2e}')
+
+
+# Run: python -m tools.benchmark_ema_update
+if __name__ == '__main__':
+    main()
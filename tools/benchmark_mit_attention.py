@@ -0,0 +1,119 @@
+import argparse
+import time
+import types
+
+import torch
+
+from daseg.models import build_backbone
+from daseg.models.backbones.mix_transformer import Attention
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Compare the attention backends of MiT with its former '
+        'attention')
+    parser.add_argument('--backbone', default='mit_b5')
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--device', default='cpu')
+    return parser.parse_args()
+
+
+def legacy_forward(self, x, H, W):
+    """The attention of MiT before the backends, with its contiguous
+    copies."""
+    B, N, C = x.shape
+    q = self.q(x).reshape(B, N, self.num_heads,
+                          C // self.num_heads).permute(0, 2, 1,
+                                                       3).contiguous()
+
+    if self.sr_ratio > 1:
+        x_ = x.permute(0, 2, 1).contiguous().reshape(B, C, H, W)
+        x_ = self.sr(x_).reshape(B, C, -1).permute(0, 2, 1).contiguous()
+        x_ = self.norm(x_)
+        kv = self.kv(x_).reshape(B, -1, 2, self.num_heads,
+                                 C // self.num_heads).permute(2, 0, 3, 1,
+                                                              4).contiguous()
+    else:
+        kv = self.kv(x).reshape(B, -1, 2, self.num_heads,
+                                C // self.num_heads).permute(2, 0, 3, 1,
+                                                             4).contiguous()
+    k, v = kv[0], kv[1]
+
+    attn = (q @ k.transpose(-2, -1).contiguous()) * self.scale
+    attn = attn.softmax(dim=-1)
+    attn = self.attn_drop(attn)
+
+    x = (attn @ v).transpose(1, 2).contiguous().reshape(B, N, C)
+    x = self.proj(x)
+    x = self.proj_drop(x)
+
+    return x
+
+
+def measure(model, img, device):
+    """Run a forward and backward pass and get its time, peak memory,
+    outputs and gradients."""
+    model.zero_grad()
+    peak = None
+    if device != 'cpu':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    start = time.perf_counter()
+    outs = model(img)
+    sum(out.pow(2).mean() for out in outs).backward()
+    if device != 'cpu':
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() - base
+    elapsed = time.perf_counter() - start
+    grads = [p.grad.clone() for p in model.parameters()]
+    return elapsed, peak, [out.detach() for out in outs], grads
+
+
+def main():
+    args = parse_args()
+    torch.manual_seed(args.seed)
+    img = torch.randn(
+        args.batch_size, 3, args.size, args.size, device=args.device)
+    ref = build_backbone(dict(type=args.backbone)).to(args.device)
+    ref.init_weights()
+    models = dict(legacy=ref)
+    for attn_backend in ['matmul', 'sdpa']:
+        model = build_backbone(
+            dict(type=args.backbone, attn_backend=attn_backend))
+        # the backends share the parameters of the former attention
+        model.load_state_dict(ref.state_dict(), strict=True)
+        models[attn_backend] = model.to(args.device)
+    for m in ref.modules():
+        if isinstance(m, Attention):
+            m.forward = types.MethodType(legacy_forward, m)
+
+    results = {}
+    for name, model in models.items():
+        # eval mode to disable dropout and drop path
+        model.eval()
+        # warmup
+        measure(model, img, args.device)
+        results[name] = measure(model, img, args.device)
+        if args.device != 'cpu':
+            torch.cuda.empty_cache()
+
+    print(f'{args.backbone} {args.batch_size}x3x{args.size}x{args.size}')
+    print('attention | forward and backward ms | peak MB | '
+          'max abs diff to legacy (outputs, grads)')
+    _, _, ref_outs, ref_grads = results['legacy']
+    for name, (elapsed, peak, outs, grads) in results.items():
+        mem = f'{peak / 2**20:.0f}' if peak is not None else '-'
+        out_diff = max((a - b).abs().max().item()
+                       for a, b in zip(ref_outs, outs))
+        grad_diff = max((a - b).abs().max().item()
+                        for a, b in zip(ref_grads, grads))
+        print(f'{name} | {elapsed * 1e3:.0f} | {mem} | '
+              f'{out_diff:.1e}, {grad_diff:.1e}')
+
+
+# Run: python -m tools.benchmark_mit_attention
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import argparse
+import time
+from contextlib import contextmanager
+
+import torch
+
+from daseg.models import build_backbone
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the activation memory of the MiT stages with '
+        'and without gradient checkpointing')
+    parser.add_argument('--backbone', default='mit_b5')
+    parser.add_argument('--batch-size', type=int, default=2)
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument(
+        '--with-cp',
+        type=int,
+        nargs=4,
+        default=[1, 1, 1, 1],
+        help='stages to checkpoint, e.g. 1 1 0 0')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--device', default='cpu')
+    return parser.parse_args()
+
+
+def _storage(tensor):
+    if hasattr(tensor, 'untyped_storage'):
+        return tensor.untyped_storage()
+    return tensor.storage()
+
+
+@contextmanager
+def track_saved_tensors(model):
+    """Sum the bytes of the tensors saved for backward per stage.
+
+    The tensors saved by the parameters themselves, e.g. the weights of the
+    linear layers, are not counted, and storages shared by several saved
+    tensors are counted once.
+    """
+    param_ptrs = {_storage(p).data_ptr() for p in model.parameters()}
+    stage_bytes = [0] * len(model.depths)
+    seen = set()
+    stage = [0]
+
+    def set_stage(i):
+
+        def hook(module, inputs):
+            stage[0] = i
+
+        return hook
+
+    def pack(tensor):
+        storage = _storage(tensor)
+        ptr = storage.data_ptr()
+        if ptr not in param_ptrs and ptr not in seen:
+            seen.add(ptr)
+            stage_bytes[stage[0]] += storage.nbytes()
+        return tensor
+
+    handles = [
+        getattr(model, f'patch_embed{i + 1}').register_forward_pre_hook(
+            set_stage(i)) for i in range(len(model.depths))
+    ]
+    try:
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda x: x):
+            yield stage_bytes
+    finally:
+        for handle in handles:
+            handle.remove()
+
+
+def measure(model, img, device):
+    """Run a forward and backward pass and get its saved bytes per stage,
+    time, peak memory and gradients."""
+    model.zero_grad()
+    peak = None
+    if device != 'cpu':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    start = time.perf_counter()
+    with track_saved_tensors(model) as stage_bytes:
+        outs = model(img)
+    sum(out.float().pow(2).mean() for out in outs).backward()
+    if device != 'cpu':
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() - base
+    elapsed = time.perf_counter() - start
+    grads = [p.grad.clone() for p in model.parameters() if p.grad is not None]
+    return stage_bytes, elapsed, peak, grads
+
+
+def main():
+    args = parse_args()
+    img = torch.randn(
+        args.batch_size, 3, args.size, args.size, device=args.device)
+    results = []
+    for with_cp in [False, [bool(c) for c in args.with_cp]]:
+        torch.manual_seed(args.seed)
+        model = build_backbone(
+            dict(type=args.backbone, with_cp=with_cp)).to(args.device)
+        model.train()
+        # warmup
+        measure(model, img, args.device)
+        torch.manual_seed(args.seed)
+        results.append(measure(model, img, args.device))
+        del model
+        if args.device != 'cpu':
+            torch.cuda.empty_cache()
+
+    print(f'{args.backbone} {args.batch_size}x3x{args.size}x{args.size}, '
+          f'checkpointed stages {args.with_cp}')
+    print('stage | saved activations MB | checkpointed MB')
+    for i, (ref, cp) in enumerate(zip(results[0][0], results[1][0])):
+        print(f'{i + 1} | {ref / 2**20:.1f} | {cp / 2**20:.1f}')
+    print(f'total | {sum(results[0][0]) / 2**20:.1f} | '
+          f'{sum(results[1][0]) / 2**20:.1f}')
+    for name, (_, elapsed, peak, _) in zip(['default', 'checkpointed'],
+                                           results):
+        mem = f', peak memory {peak / 2**20:.0f} MB' if peak is not None \
+            else ''
+        print(f'{name}: forward and backward {elapsed * 1e3:.0f} ms{mem}')
+    grad_diff = max((a - b).abs().max().item()
+                    for a, b in zip(results[0][3], results[1][3]))
+    print(f'max abs grad diff {grad_diff:.1e}')
+
+
+# Run: python -m tools.benchmark_mit_checkpoint
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import argparse
+import itertools
+import time
+
+import torch
+import torch.nn as nn
+
+from daseg.ops import neighborhood_sim
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the shifted-slice neighborhood similarity '
+        'against the nn.Unfold one of the similarity losses')
+    parser.add_argument(
+        '--kernel-sizes', type=int, nargs='+', default=[3, 5, 7])
+    parser.add_argument('--dilations', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument(
+        '--channels', type=int, nargs='+', default=[64, 256, 2048])
+    parser.add_argument('--batch-size', type=int, default=2)
+    parser.add_argument('--size', type=int, default=128)
+    parser.add_argument('--sigma', type=float, default=30)
+    parser.add_argument(
+        '--iters', type=int, default=5, help='number of timed iterations')
+    parser.add_argument('--device', default='cpu')
+    return parser.parse_args()
+
+
+def unfold_sim(feats, kernel_size, dilation, sigma):
+    """The gaussian similarity computed by the losses before."""
+    B, C, H, W = feats.shape
+    unfold_fun = nn.Unfold(
+        kernel_size=kernel_size,
+        padding=kernel_size // 2 * dilation,
+        dilation=dilation)
+    unf_feats = unfold_fun(feats).view(B, C, kernel_size**2, H, W)
+    temp_dis = ((unf_feats - feats.unsqueeze(2))**2).sum(dim=1)
+    return torch.exp(-temp_dis / sigma**2)
+
+
+def measure(fn, feats, iters, device):
+    """Get the time and the peak memory of a forward and backward pass."""
+    times = []
+    peak = None
+    for _ in range(iters + 1):
+        feats.grad = None
+        if device != 'cpu':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            base = torch.cuda.memory_allocated()
+        start = time.perf_counter()
+        out = fn(feats)
+        out.sum().backward()
+        if device != 'cpu':
+            torch.cuda.synchronize()
+            peak = torch.cuda.max_memory_allocated() - base
+        times.append(time.perf_counter() - start)
+    # the first iteration is a warmup
+    return sum(times[1:]) / iters, peak, out.detach(), feats.grad.clone()
+
+
+def main():
+    args = parse_args()
+    print('kernel dilation channels | unfold ms (MB) | shifted ms (MB) | '
+          'max abs diff (sim, grad)')
+    for kernel_size, dilation, channels in itertools.product(
+            args.kernel_sizes, args.dilations, args.channels):
+        feats = torch.randn(
+            args.batch_size,
+            channels,
+            args.size,
+            args.size,
+            device=args.device,
+            requires_grad=True)
+        results = []
+        for fn in [
+                lambda x: unfold_sim(x, kernel_size, dilation, args.sigma),
+                lambda x: neighborhood_sim(x, kernel_size, dilation,
+                                           'gaussian', args.sigma)
+        ]:
+            try:
+                results.append(measure(fn, feats, args.iters, args.device))
+            except RuntimeError as e:  # out of memory
+                print(f'{kernel_size} {dilation} {channels}: {e}')
+                results.append(None)
+            if args.device != 'cpu':
+                torch.cuda.empty_cache()
+        cols = []
+        for result in results:
+            if result is None:
+                cols.append('failed')
+                continue
+            elapsed, peak, _, _ = result
+            mem = f' ({peak / 2**20:.0f})' if peak is not None else ''
+            cols.append(f'{elapsed * 1e3:.1f}{mem}')
+        if None not in results:
+            sim_diff = (results[0][2] - results[1][2]).abs().max().item()
+            grad_diff = (results[0][3] - results[1][3]).abs().max().item()
+            cols.append(f'{sim_diff:.1e}, {grad_diff:.1e}')
+        print(f'{kernel_size} {dilation} {channels} | ' + ' | '.join(cols))
+
+
+# Run: python -m tools.benchmark_neighborhood_sim
+if __name__ == '__main__':
+    main()
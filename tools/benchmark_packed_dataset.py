@@ -0,0 +1,89 @@
+import argparse
+import time
+
+import mmcv
+from mmcv.utils import DictAction
+from torch.utils.data import DataLoader
+
+from daseg.datasets import build_dataset
+
+LOADERS = ('LoadImageFromFile', 'LoadAnnotations')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Compare the samples/s of a dataset read from files and '
+        'from packed shards')
+    parser.add_argument('config', help='config file path')
+    parser.add_argument('packed_dir', help='directory of the shards')
+    parser.add_argument(
+        '--data-key',
+        default='train.source',
+        help='dot separated key of the dataset config in cfg.data')
+    parser.add_argument(
+        '--num-samples', default=500, type=int, help='samples per run')
+    parser.add_argument(
+        '--workers', default=0, type=int, help='dataloader workers')
+    parser.add_argument(
+        '--load-only',
+        action='store_true',
+        help='only run the loading transforms of the pipeline')
+    parser.add_argument(
+        '--options', nargs='+', action=DictAction, help='custom options')
+    return parser.parse_args()
+
+
+def build_benchmark_dataset(data_cfg, packed_dir, load_only):
+    data_cfg = mmcv.ConfigDict(data_cfg.copy())
+    pipeline = [dict(t) for t in data_cfg.pipeline]
+    if load_only:
+        pipeline = [t for t in pipeline if t['type'] in LOADERS]
+    if packed_dir is not None:
+        for t in pipeline:
+            if t['type'] in LOADERS:
+                t['packed_dir'] = packed_dir
+        if 'gt_seg_map_loader_cfg' in data_cfg:
+            data_cfg.gt_seg_map_loader_cfg = dict(
+                data_cfg.gt_seg_map_loader_cfg or {}, packed_dir=packed_dir)
+    data_cfg.pipeline = pipeline
+    return build_dataset(data_cfg)
+
+
+def run(dataset, num_samples, workers):
+    num_samples = min(num_samples, len(dataset))
+    loader = DataLoader(
+        dataset,
+        batch_size=None,
+        sampler=range(num_samples),
+        num_workers=workers,
+        collate_fn=lambda x: x)
+    start = time.perf_counter()
+    for _ in loader:
+        pass
+    return num_samples / (time.perf_counter() - start)
+
+
+def main():
+    args = parse_args()
+    cfg = mmcv.Config.fromfile(args.config)
+    if args.options is not None:
+        cfg.merge_from_dict(args.options)
+    data_cfg = cfg.data
+    for key in args.data_key.split('.'):
+        data_cfg = data_cfg[key]
+
+    ref = None
+    for name, packed_dir in (('files', None), ('packed', args.packed_dir)):
+        dataset = build_benchmark_dataset(data_cfg, packed_dir,
+                                          args.load_only)
+        # warm up the page cache so that both runs read from memory
+        run(dataset, args.num_samples, 0)
+        samples_per_s = run(dataset, args.num_samples, args.workers)
+        ref = ref or samples_per_s
+        print(f'{name}: {samples_per_s:.1f} samples/s, '
+              f'speedup {samples_per_s / ref:.2f}x')
+
+
+# Run: python -m tools.benchmark_packed_dataset <config> <packed_dir>
+if __name__ == '__main__':
+    main()
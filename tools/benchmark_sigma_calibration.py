@@ -0,0 +1,73 @@
+import argparse
+import time
+
+import torch
+
+from daseg.core import calibrate_gaussian_sigmas
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the sigma calibration of the pseudo labeling '
+        'hook against the scalar bisection')
+    parser.add_argument(
+        '--num-images', type=int, default=64, help='number of images')
+    parser.add_argument('--size', type=int, default=128, help='feature size')
+    parser.add_argument(
+        '--kernel-size', type=int, default=3, help='neighborhood size')
+    parser.add_argument(
+        '--channels', type=int, default=64, help='feature channels')
+    parser.add_argument(
+        '--mean-sims',
+        type=float,
+        nargs='+',
+        default=[0.2, 0.3, 0.5, 0.7, 0.9])
+    parser.add_argument('--device', default='cpu')
+    return parser.parse_args()
+
+
+def scalar_bisection(dis, mean_sim):
+    """The loop used by PseudoLabelingHookV4._cal_sigmas before."""
+    left = 0
+    right = 1000
+    while abs(left - right) > 1e-6:
+        sigma = (left + right) / 2
+        sim_feat = torch.exp(-dis / sigma**2)
+        if sim_feat.mean() < mean_sim:
+            left = sigma
+        else:
+            right = sigma
+    return left
+
+
+def main():
+    args = parse_args()
+    # squared distances of random features to their neighbors, the center
+    # of every neighborhood having distance 0
+    shape = (args.num_images, args.size, args.size, args.kernel_size**2)
+    dis = torch.randn(shape, device=args.device).pow(2) * \
+        torch.rand(shape, device=args.device) * 2 * args.channels
+    dis[..., args.kernel_size**2 // 2] = 0
+    dis = dis.view(-1, args.kernel_size**2)
+    print(f'{dis.numel()} distances')
+
+    start = time.perf_counter()
+    ref = [scalar_bisection(dis, mean_sim) for mean_sim in args.mean_sims]
+    ref_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sigmas = calibrate_gaussian_sigmas(dis, args.mean_sims)
+    elapsed = time.perf_counter() - start
+
+    for mean_sim, r, s in zip(args.mean_sims, ref, sigmas):
+        print(f'mean_sim={mean_sim}: scalar {r:.6f}, calibrated {s:.6f}, '
+              f'abs diff {abs(r - s):.2e}')
+    max_diff = max(abs(r - s) for r, s in zip(ref, sigmas))
+    print(f'scalar bisection: {ref_time:.2f} s, calibration: {elapsed:.2f} '
+          f's, speedup {ref_time / elapsed:.1f}x, max abs diff '
+          f'{max_diff:.2e}')
+
+
+# Run: python -m tools.benchmark_sigma_calibration
+if __name__ == '__main__':
+    main()
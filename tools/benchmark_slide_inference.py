@@ -0,0 +1,79 @@
+import argparse
+import time
+
+import mmcv
+import torch
+from mmcv.utils import DictAction
+
+from daseg.models import build_segmentor
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark batched sliding-window inference')
+    parser.add_argument(
+        '--config',
+        default='configs/_base_/models/daformer_sepaspp_mitb5.py',
+        help='model config file path')
+    parser.add_argument(
+        '--img-size', type=int, nargs=2, default=[1024, 1024])
+    parser.add_argument(
+        '--crop-size', type=int, nargs=2, default=[512, 512])
+    parser.add_argument('--stride', type=int, nargs=2, default=[341, 341])
+    parser.add_argument(
+        '--slide-batch-sizes',
+        type=int,
+        nargs='+',
+        default=[1, 2, 4, 8],
+        help='values of test_cfg.slide_batch_size to compare')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument(
+        '--options', nargs='+', action=DictAction, help='custom options')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    cfg = mmcv.Config.fromfile(args.config)
+    if args.options is not None:
+        cfg.merge_from_dict(args.options)
+    cfg.model.pretrained = None
+    cfg.model.train_cfg = None
+    cfg.model.test_cfg = mmcv.ConfigDict(
+        mode='slide', crop_size=args.crop_size, stride=args.stride)
+    model = build_segmentor(cfg.model).to(args.device).eval()
+
+    img = torch.randn(1, 3, *args.img_size, device=args.device)
+    img_meta = [
+        dict(
+            ori_shape=(*args.img_size, 3),
+            img_shape=(*args.img_size, 3),
+            pad_shape=(*args.img_size, 3),
+            flip=False)
+    ]
+    num_windows = len(model._get_slide_windows(*args.img_size))
+    print(f'{num_windows} windows per image')
+
+    ref_logits, ref_time = None, None
+    with torch.no_grad():
+        for slide_batch_size in args.slide_batch_sizes:
+            model.test_cfg.slide_batch_size = slide_batch_size
+            # warm up
+            logits = model.slide_inference(img, img_meta, rescale=False)
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                logits = model.slide_inference(img, img_meta, rescale=False)
+            elapsed = (time.perf_counter() - start) / args.repeat
+            if ref_logits is None:
+                ref_logits, ref_time = logits, elapsed
+            max_diff = (logits - ref_logits).abs().max().item()
+            print(f'slide_batch_size={slide_batch_size}: '
+                  f'{elapsed * 1000:.1f} ms/img, '
+                  f'speedup {ref_time / elapsed:.2f}x, '
+                  f'max abs diff {max_diff:.2e}')
+
+
+# Run: python -m tools.benchmark_slide_inference --config <model config>
+if __name__ == '__main__':
+    main()
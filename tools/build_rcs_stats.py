@@ -0,0 +1,71 @@
+import argparse
+
+import mmcv
+from mmcv.utils import DictAction
+
+from daseg.datasets import build_dataset
+from daseg.datasets.rcs_stats import build_rcs_stats, rcs_index_from_json
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Build the rare class sampling statistics of a dataset')
+    parser.add_argument('config', help='config file path')
+    parser.add_argument(
+        '--data-key',
+        default='train.source',
+        help='dot separated key of the dataset config in cfg.data')
+    parser.add_argument(
+        '-o',
+        '--out-dir',
+        help='output path, defaults to the data_root of the dataset')
+    parser.add_argument(
+        '--nproc', default=8, type=int, help='number of process')
+    parser.add_argument(
+        '--chunk-size',
+        default=256,
+        type=int,
+        help='number of samples per checkpointed chunk')
+    parser.add_argument(
+        '--no-resume',
+        action='store_true',
+        help='discard the chunks of an interrupted run')
+    parser.add_argument(
+        '--from-json',
+        action='store_true',
+        help='only convert the existing sample_class_stats.json in the '
+        'output path to the memory-mapped rcs_index')
+    parser.add_argument(
+        '--options', nargs='+', action=DictAction, help='custom options')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    cfg = mmcv.Config.fromfile(args.config)
+    if args.options is not None:
+        cfg.merge_from_dict(args.options)
+
+    data_cfg = cfg.data
+    for key in args.data_key.split('.'):
+        data_cfg = data_cfg[key]
+    # only the annotations are read, the image pipeline is never run
+    data_cfg.pipeline = []
+    dataset = build_dataset(data_cfg)
+
+    out_dir = args.out_dir if args.out_dir else data_cfg.data_root
+    if args.from_json:
+        rcs_index_from_json(out_dir, dataset)
+        return
+    build_rcs_stats(
+        dataset,
+        out_dir,
+        len(dataset.CLASSES),
+        nproc=args.nproc,
+        chunk_size=args.chunk_size,
+        resume=not args.no_resume)
+
+
+if __name__ == '__main__':
+    main()
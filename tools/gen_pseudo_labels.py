@@ -0,0 +1,121 @@
+import argparse
+import os
+
+import mmcv
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from mmcv.parallel import MMDataParallel
+from mmcv.runner import load_checkpoint
+from mmcv.utils import DictAction
+
+from daseg.core.hook.pseudo_labeling_hookv4 import PseudoLabelingHookV4
+from daseg.models import build_segmentor
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Generate the pseudo labels of the target dataset with '
+        'one or several processes')
+    parser.add_argument('config', help='config file path')
+    parser.add_argument('checkpoint', help='checkpoint file')
+    parser.add_argument(
+        '--out-dir',
+        help='directory of the pseudo label store, defaults to the log_dir '
+        'of the PseudoLabelingHookV4 in custom_hooks')
+    parser.add_argument(
+        '--launcher',
+        choices=['none', 'pytorch'],
+        default='none',
+        help='job launcher, use pytorch with torchrun')
+    parser.add_argument(
+        '--nproc',
+        type=int,
+        default=1,
+        help='number of processes to spawn with the none launcher')
+    parser.add_argument(
+        '--backend',
+        help='distributed backend, defaults to nccl on GPU and gloo on CPU')
+    parser.add_argument(
+        '--port', type=int, default=29500, help='port of spawned processes')
+    parser.add_argument(
+        '--options', nargs='+', action=DictAction, help='custom options')
+    parser.add_argument('--local_rank', type=int, default=0)
+    args = parser.parse_args()
+    if 'LOCAL_RANK' not in os.environ:
+        os.environ['LOCAL_RANK'] = str(args.local_rank)
+    return args
+
+
+def build_hook(cfg, out_dir):
+    hook_cfg = dict(log_dir=out_dir, data_cfg=cfg.data)
+    for custom_hook in cfg.get('custom_hooks', []):
+        if custom_hook['type'] == 'PseudoLabelingHookV4':
+            hook_cfg = dict(custom_hook, **hook_cfg)
+            hook_cfg.pop('type')
+            if out_dir is None:
+                hook_cfg['log_dir'] = custom_hook['log_dir']
+    assert hook_cfg['log_dir'] is not None, \
+        'Specify --out-dir or a PseudoLabelingHookV4 in custom_hooks'
+    return PseudoLabelingHookV4(**hook_cfg)
+
+
+def generate(local_rank, args, rank=None, world_size=None):
+    cfg = mmcv.Config.fromfile(args.config)
+    if args.options is not None:
+        cfg.merge_from_dict(args.options)
+    cfg.model.pretrained = None
+    cfg.model.train_cfg = None
+    cfg.data.test.test_mode = True
+
+    use_gpu = torch.cuda.is_available()
+    if world_size is not None and world_size > 1:
+        if use_gpu:
+            torch.cuda.set_device(local_rank)
+        dist.init_process_group(
+            args.backend or ('nccl' if use_gpu else 'gloo'),
+            rank=rank,
+            world_size=world_size)
+
+    model = build_segmentor(cfg.model, test_cfg=cfg.get('test_cfg'))
+    load_checkpoint(
+        model,
+        args.checkpoint,
+        map_location='cpu',
+        revise_keys=[(r'^module\.', ''), ('model.', '')])
+    if use_gpu:
+        model = MMDataParallel(model.cuda(local_rank), device_ids=[local_rank])
+    else:
+        model = MMDataParallel(model)
+
+    hook = build_hook(cfg, args.out_dir)
+    hook.generate(model, hook.build_test_dataloader())
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def spawn_worker(rank, args):
+    generate(rank, args, rank=rank, world_size=args.nproc)
+
+
+def main():
+    args = parse_args()
+    if args.launcher == 'pytorch':
+        generate(
+            int(os.environ['LOCAL_RANK']),
+            args,
+            rank=int(os.environ['RANK']),
+            world_size=int(os.environ['WORLD_SIZE']))
+    elif args.nproc > 1:
+        os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+        os.environ.setdefault('MASTER_PORT', str(args.port))
+        mp.spawn(spawn_worker, args=(args, ), nprocs=args.nproc)
+    else:
+        generate(0, args)
+
+
+# Run: python tools/gen_pseudo_labels.py <config> <checkpoint> --nproc 4
+# or: torchrun --nproc_per_node 4 tools/gen_pseudo_labels.py <config> \
+#     <checkpoint> --launcher pytorch
+if __name__ == '__main__':
+    main()
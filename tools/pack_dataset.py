@@ -0,0 +1,116 @@
+import argparse
+from multiprocessing import Pool
+
+import mmcv
+from mmcv.utils import DictAction
+
+from daseg.datasets import build_dataset
+from daseg.datasets.pipelines import LoadAnnotations, LoadImageFromFile
+from daseg.utils import PackedShardWriter
+
+# set before the worker pool is forked, as the loaders may hold unpicklable
+# shared caches
+_LOADERS = {}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Pack the decoded images and label maps of a dataset '
+        'into memory-mapped shards')
+    parser.add_argument('config', help='config file path')
+    parser.add_argument('out_dir', help='directory of the shards')
+    parser.add_argument(
+        '--data-key',
+        default='train.source',
+        help='dot separated key of the dataset config in cfg.data')
+    parser.add_argument(
+        '--shard-size',
+        default=1024,
+        type=int,
+        help='maximal size of a shard in MiB')
+    parser.add_argument(
+        '--nproc', default=8, type=int, help='number of decoding processes')
+    parser.add_argument(
+        '--no-labels', action='store_true', help='only pack the images')
+    parser.add_argument(
+        '--options', nargs='+', action=DictAction, help='custom options')
+    args = parser.parse_args()
+    return args
+
+
+def get_loaders(dataset):
+    """Get the image and annotation loaders of the dataset pipeline, so that
+    the packed arrays are decoded with the same settings."""
+    img_loader, ann_loader = LoadImageFromFile(), dataset.gt_seg_map_loader
+    for transform in dataset.pipeline.transforms:
+        if isinstance(transform, LoadImageFromFile):
+            img_loader = transform
+        elif isinstance(transform, LoadAnnotations):
+            ann_loader = transform
+    return img_loader, ann_loader
+
+
+def decode_sample(files):
+    img_file, ann_file = files
+    img = _LOADERS['img'].decode(img_file)
+    ann = _LOADERS['ann'].decode(ann_file) if ann_file is not None else None
+    return img_file, img, ann_file, ann
+
+
+def main():
+    args = parse_args()
+    cfg = mmcv.Config.fromfile(args.config)
+    if args.options is not None:
+        cfg.merge_from_dict(args.options)
+
+    data_cfg = cfg.data
+    for key in args.data_key.split('.'):
+        data_cfg = data_cfg[key]
+    dataset = build_dataset(data_cfg)
+    _LOADERS['img'], _LOADERS['ann'] = get_loaders(dataset)
+
+    files = []
+    for idx, img_info in enumerate(dataset.img_infos):
+        results = dict(img_info=img_info)
+        if not args.no_labels and 'ann' in img_info:
+            results['ann_info'] = dataset.get_ann_info(idx)
+        dataset.pre_pipeline(results)
+        ann_file = LoadAnnotations.get_filename(
+            results) if 'ann_info' in results else None
+        files.append((LoadImageFromFile.get_filename(results), ann_file))
+
+    writer = PackedShardWriter(
+        args.out_dir,
+        shard_bytes=args.shard_size * 1024**2,
+        meta=dict(
+            config=args.config,
+            data_key=args.data_key,
+            num_samples=len(dataset),
+            color_type=_LOADERS['img'].color_type,
+            img_decode_backend=_LOADERS['img'].imdecode_backend,
+            ann_decode_backend=_LOADERS['ann'].imdecode_backend))
+
+    def add(sample):
+        img_file, img, ann_file, ann = sample
+        writer.add(f'img:{img_file}', img)
+        if ann is not None:
+            writer.add(f'ann:{ann_file}', ann)
+
+    prog_bar = mmcv.ProgressBar(len(files))
+    if args.nproc > 1:
+        with Pool(args.nproc) as pool:
+            for sample in pool.imap(decode_sample, files, chunksize=16):
+                add(sample)
+                prog_bar.update()
+    else:
+        for sample in map(decode_sample, files):
+            add(sample)
+            prog_bar.update()
+    writer.close()
+    print(f'\nPacked {len(files)} samples to {args.out_dir}, load them with '
+          f"packed_dir='{args.out_dir}' in LoadImageFromFile, "
+          'LoadAnnotations and gt_seg_map_loader_cfg')
+
+
+if __name__ == '__main__':
+    main()